@@ -1,17 +1,35 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_from_directory, abort
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_from_directory, abort, Response, stream_with_context, g
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, func, insert, literal, and_, or_, select, update, union, union_all, except_, inspect as sa_inspect
+from sqlalchemy.orm.attributes import set_committed_value
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import os
 import uuid
 import mimetypes
 import random
+import json
+import csv
+import io
+import re
+import bisect
+import time
+import sqlite3
+import threading
+import atexit
+from collections import OrderedDict, namedtuple
+from types import MappingProxyType
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
+from werkzeug.datastructures import MultiDict
 import secrets
+import zlib
+import hashlib
+import html
+from html.parser import HTMLParser
 from flask_mail import Mail
 from dotenv import load_dotenv
-from markupsafe import escape
+from markupsafe import escape, Markup
 from config import config
 
 # Load environment variables from .env file
@@ -27,19 +45,114 @@ app = Flask(__name__, instance_relative_config=True)
 app.config.from_object(config[env])
 config[env].init_app(app)
 
-# إضافة فلتر nl2br لتحويل السطور الجديدة إلى <br> ودعم محتوى HTML
+# تحويل نصوص الرسائل والبريد الشخصي إلى HTML آمن
+# يتم التحويل مرة واحدة عند الحفظ ويخزن الناتج مع رقم إصدار المحول؛ عند تغيير
+# قواعد التحويل يزاد BODY_RENDERER_VERSION فيعاد تحويل النصوص عند أول عرض لها
+BODY_RENDERER_VERSION = 1
+
+ALLOWED_BODY_TAGS = frozenset({
+    'a', 'b', 'blockquote', 'br', 'code', 'div', 'em', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+    'hr', 'i', 'img', 'li', 'ol', 'p', 'pre', 's', 'span', 'strong', 'sub', 'sup',
+    'table', 'tbody', 'td', 'tfoot', 'th', 'thead', 'tr', 'u', 'ul'
+})
+VOID_BODY_TAGS = frozenset({'br', 'hr', 'img'})
+# وسوم يحذف محتواها بالكامل وليس الوسم فقط
+DROPPED_BODY_TAGS = frozenset({'script', 'style', 'iframe', 'object', 'embed', 'noscript', 'template', 'svg', 'math'})
+ALLOWED_BODY_ATTRIBUTES = MappingProxyType({
+    '*': frozenset({'dir', 'align', 'title'}),
+    'a': frozenset({'href', 'target'}),
+    'img': frozenset({'src', 'alt', 'width', 'height'}),
+    'td': frozenset({'colspan', 'rowspan'}),
+    'th': frozenset({'colspan', 'rowspan'}),
+})
+URL_BODY_ATTRIBUTES = frozenset({'href', 'src'})
+ALLOWED_URL_SCHEMES = ('http:', 'https:', 'mailto:')
+
+class BodySanitizer(HTMLParser):
+    """منقي HTML بقائمة سماح للوسوم والخصائص (مكتبة Python القياسية فقط)"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.open_tags = []
+        self.dropping = 0
+
+    @staticmethod
+    def _safe_url(value):
+        value = (value or '').strip()
+        compact = re.sub(r'[\s\x00-\x1f]', '', value).lower()
+        if ':' not in compact.split('/', 1)[0] or compact.startswith(ALLOWED_URL_SCHEMES):
+            return value
+        return None
+
+    def _attributes(self, tag, attrs):
+        allowed = ALLOWED_BODY_ATTRIBUTES['*'] | ALLOWED_BODY_ATTRIBUTES.get(tag, frozenset())
+        result = []
+        for name, value in attrs:
+            if name not in allowed:
+                continue
+            if name in URL_BODY_ATTRIBUTES:
+                value = self._safe_url(value)
+                if value is None:
+                    continue
+            result.append(f' {name}="{html.escape(value or "", quote=True)}"')
+        if tag == 'a' and any(name == 'target' for name, _ in attrs):
+            result.append(' rel="noopener noreferrer"')
+        return ''.join(result)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in DROPPED_BODY_TAGS:
+            self.dropping += 1
+            return
+        if self.dropping or tag not in ALLOWED_BODY_TAGS:
+            return
+        self.parts.append(f'<{tag}{self._attributes(tag, attrs)}>')
+        if tag not in VOID_BODY_TAGS:
+            self.open_tags.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in VOID_BODY_TAGS:
+            self.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if tag in DROPPED_BODY_TAGS:
+            self.dropping = max(self.dropping - 1, 0)
+            return
+        if self.dropping or tag not in self.open_tags:
+            return
+        # إغلاق الوسوم المفتوحة داخل الوسم المغلق للحفاظ على سلامة البنية
+        while self.open_tags:
+            open_tag = self.open_tags.pop()
+            self.parts.append(f'</{open_tag}>')
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data):
+        if not self.dropping:
+            self.parts.append(html.escape(data, quote=False))
+
+    def result(self):
+        self.close()
+        return ''.join(self.parts) + ''.join(f'</{tag}>' for tag in reversed(self.open_tags))
+
+def sanitize_html(value):
+    """تنقية HTML من الوسوم والخصائص والروابط غير المسموح بها"""
+    sanitizer = BodySanitizer()
+    sanitizer.feed(value)
+    return sanitizer.result()
+
+def render_body_html(value):
+    """تحويل نص الرسالة إلى HTML آمن: تنقية محتوى HTML أو تحويل سطور النص العادي إلى <br>"""
+    if not value:
+        return ''
+    if '<' in value and '>' in value:
+        return sanitize_html(value)
+    return str(escape(value)).replace('\n', '<br>\n')
+
+# فلتر nl2br للتوافق مع القوالب القديمة؛ العرض يجب أن يستخدم HTML المحول مسبقًا (content_html)
 @app.template_filter('nl2br')
 def nl2br(value):
-    if value:
-        # التحقق مما إذا كان المحتوى يحتوي على وسوم HTML
-        if '<' in value and '>' in value:
-            # إذا كان المحتوى يحتوي على HTML، نعيده كما هو بدون escape
-            return value
-        else:
-            # إذا كان المحتوى نصًا عاديًا، نقوم بتحويل السطور الجديدة إلى <br>
-            value = escape(value)
-            return value.replace('\n', '<br>\n')
-    return value
+    return Markup(render_body_html(value)) if value else value
 
 # وظائف مساعدة للملفات المرفقة
 def allowed_file(filename):
@@ -91,6 +204,169 @@ login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 login_manager.login_message = 'الرجاء تسجيل الدخول للوصول إلى هذه الصفحة'
 
+# التعدادات المخزنة كرموز صغيرة (SmallInteger)
+# ترتيب القيم في كل صف هو رمزها في قاعدة البيانات: لا يعاد ترتيبها، وتضاف القيم الجديدة في النهاية
+MESSAGE_STATUS_NAMES = ('new', 'read', 'replied', 'processing', 'completed', 'closed', 'postponed')
+MESSAGE_PRIORITY_NAMES = ('normal', 'urgent', 'very_urgent')
+MESSAGE_CONFIDENTIALITY_NAMES = ('normal', 'confidential', 'highly_confidential')
+MESSAGE_TYPE_NAMES = ('memo', 'circular', 'request', 'notification', 'report', 'invitation', 'other', 'incoming')
+RECIPIENT_TYPE_NAMES = ('user', 'group', 'multiple', 'department', 'all')
+PERSONAL_MAIL_STATUS_NAMES = ('pending', 'in_progress', 'completed', 'cancelled')
+
+# رموز الحالات المستخدمة في سجل أحداث الحالة وملخص زمن البقاء في كل حالة
+MESSAGE_STATUS_CODES = MappingProxyType({name: code for code, name in enumerate(MESSAGE_STATUS_NAMES)})
+
+class CodedEnum(db.TypeDecorator):
+    """عمود تعداد: قيمة نصية في بايثون ورمز صغير في قاعدة البيانات"""
+    impl = db.SmallInteger
+    cache_ok = True
+
+    def __init__(self, names):
+        super().__init__()
+        self.names = tuple(names)
+        self._codes = {name: code for code, name in enumerate(self.names)}
+
+    def process_bind_param(self, value, dialect):
+        if value is None or value == '':
+            return None
+        if isinstance(value, int):
+            return value
+        try:
+            return self._codes[value]
+        except KeyError:
+            raise ValueError(f'قيمة غير معروفة: {value}')
+
+    def process_literal_param(self, value, dialect):
+        code = self.process_bind_param(value, dialect)
+        return 'NULL' if code is None else str(code)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else self.names[value]
+
+    @property
+    def python_type(self):
+        return str
+
+    def check_constraint(self, column_name, table_name):
+        """قيد CHECK يحصر الرموز المسموح بها في العمود"""
+        return db.CheckConstraint(
+            f'{column_name} BETWEEN 0 AND {len(self.names) - 1}',
+            name=f'ck_{table_name}_{column_name}'
+        )
+
+    def coerce(self, value, default=None):
+        """قيمة صالحة من مدخلات المستخدم (أو القيمة الافتراضية)"""
+        return value if value in self._codes else default
+
+MessageStatus = CodedEnum(MESSAGE_STATUS_NAMES)
+MessagePriority = CodedEnum(MESSAGE_PRIORITY_NAMES)
+MessageConfidentiality = CodedEnum(MESSAGE_CONFIDENTIALITY_NAMES)
+MessageType = CodedEnum(MESSAGE_TYPE_NAMES)
+RecipientType = CodedEnum(RECIPIENT_TYPE_NAMES)
+PersonalMailStatus = CodedEnum(PERSONAL_MAIL_STATUS_NAMES)
+
+# جداول العرض الثابتة (النص العربي واللون لكل قيمة)
+MESSAGE_STATUS_DISPLAY = MappingProxyType({
+    'new': 'جديد',
+    'read': 'مقروء',
+    'replied': 'تم الرد',
+    'processing': 'قيد المعالجة',
+    'completed': 'مكتمل',
+    'closed': 'مغلق',
+    'postponed': 'مؤجل'
+})
+MESSAGE_STATUS_COLORS = MappingProxyType({
+    'new': 'primary',
+    'read': 'success',
+    'replied': 'info',
+    'processing': 'warning',
+    'completed': 'success',
+    'closed': 'secondary',
+    'postponed': 'danger'
+})
+MESSAGE_PRIORITY_DISPLAY = MappingProxyType({
+    'normal': 'عادي',
+    'urgent': 'عاجل',
+    'very_urgent': 'هام جداً'
+})
+MESSAGE_PRIORITY_COLORS = MappingProxyType({
+    'normal': 'success',
+    'urgent': 'warning',
+    'very_urgent': 'danger'
+})
+MESSAGE_TYPE_DISPLAY = MappingProxyType({
+    'memo': 'مذكرة',
+    'circular': 'تعميم',
+    'request': 'طلب',
+    'notification': 'إخطار',
+    'report': 'تقرير',
+    'invitation': 'دعوة',
+    'other': 'أخرى',
+    'incoming': 'وارد'
+})
+MESSAGE_CONFIDENTIALITY_DISPLAY = MappingProxyType({
+    'normal': 'عام',
+    'confidential': 'سري',
+    'highly_confidential': 'سري للغاية'
+})
+MESSAGE_CONFIDENTIALITY_COLORS = MappingProxyType({
+    'normal': 'success',
+    'confidential': 'warning',
+    'highly_confidential': 'danger'
+})
+PERSONAL_MAIL_STATUS_DISPLAY = MappingProxyType({
+    'pending': 'قيد الانتظار',
+    'in_progress': 'قيد التنفيذ',
+    'completed': 'مكتمل',
+    'cancelled': 'ملغي'
+})
+PERSONAL_MAIL_STATUS_COLORS = MappingProxyType({
+    'pending': 'warning',
+    'in_progress': 'info',
+    'completed': 'success',
+    'cancelled': 'danger'
+})
+
+# تطبيع النصوص العربية للبحث ولبصمة المراسلات الواردة وللاستيراد
+# (إزالة التشكيل والتطويل وتوحيد أشكال الحروف والأرقام العربية)
+ARABIC_DIACRITICS_RE = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]')
+ARABIC_LETTER_MAP = str.maketrans({
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا', 'ة': 'ه', 'ى': 'ي', 'ؤ': 'و', 'ئ': 'ي',
+    '٠': '0', '١': '1', '٢': '2', '٣': '3', '٤': '4', '٥': '5', '٦': '6', '٧': '7', '٨': '8', '٩': '9'
+})
+
+def normalize_arabic(text, strip_punctuation=False):
+    """تطبيع النص: توحيد الألف والياء والتاء المربوطة والأرقام وإزالة التشكيل وتحويل اللاتينية إلى أحرف صغيرة
+    (مع strip_punctuation تبقى الكلمات فقط دون علامات الترقيم، للمقارنة والبصمات)"""
+    if not text:
+        return ''
+    text = ARABIC_DIACRITICS_RE.sub('', text.translate(ARABIC_LETTER_MAP)).lower()
+    if strip_punctuation:
+        return ' '.join(re.findall(r'\w+', text))
+    return ' '.join(text.split())
+
+def normalize_reference(value):
+    """رقم مرجعي مطبع: الحروف والأرقام فقط (يتجاهل المسافات والشرطات والشرطات المائلة)"""
+    return normalize_arabic(value, strip_punctuation=True).replace(' ', '').replace('_', '')
+
+def incoming_reference_key(sender_entity, reference_number):
+    """مفتاح الجهة والرقم المرجعي (فارغ إذا نقص أحدهما)"""
+    entity, reference = normalize_arabic(sender_entity, strip_punctuation=True), normalize_reference(reference_number)
+    if not entity or not reference:
+        return None
+    return hashlib.sha1(f'{entity}|{reference}'.encode('utf-8')).hexdigest()
+
+def incoming_fingerprint(sender_entity, reference_number, document_date, content):
+    """بصمة الخطاب الوارد من الجهة والرقم المرجعي والتاريخ وتجزئة المحتوى المطبع"""
+    entity = normalize_arabic(sender_entity, strip_punctuation=True)
+    if not entity:
+        return None
+    content_hash = hashlib.sha1(normalize_arabic(content, strip_punctuation=True).encode('utf-8')).hexdigest()
+    date = document_date.isoformat() if document_date else ''
+    return hashlib.sha1(
+        f'{entity}|{normalize_reference(reference_number)}|{date}|{content_hash}'.encode('utf-8')
+    ).hexdigest()
+
 # Department model
 class Department(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -99,32 +375,69 @@ class Department(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     is_active = db.Column(db.Boolean, default=True)
 
+    # الهيكل التنظيمي (إدارة عامة > إدارة > قسم)
+    parent_id = db.Column(db.Integer, db.ForeignKey('department.id'), index=True)
+    path = db.Column(db.String(255), index=True)  # المسار المادي من الجذر مثل /1/5/12/ (لاستعلامات الشجرة الفرعية بنطاق على الفهرس)
+    level = db.Column(db.Integer, default=0)  # عمق القسم في الشجرة (0 للجذر)
+
     # العلاقة مع المستخدمين
     users = db.relationship('User', backref='dept', lazy='dynamic')
 
+    # العلاقة مع الأقسام الفرعية
+    children = db.relationship('Department', backref=db.backref('parent', remote_side=[id]), lazy='dynamic')
+
     def get_users_count(self):
         """الحصول على عدد المستخدمين في القسم"""
         return self.users.count()
 
+    def set_parent(self, parent):
+        """تعيين القسم الأب وحساب المسار (يجب أن يكون للقسم معرف)"""
+        self.parent_id = parent.id if parent else None
+        self.path = (parent.path if parent else '/') + f'{self.id}/'
+        self.level = parent.level + 1 if parent else 0
+
+    def is_ancestor_of(self, other):
+        """التحقق مما إذا كان القسم أبًا (مباشرًا أو غير مباشر) للقسم الآخر أو هو نفسه"""
+        return bool(self.path and other.path and other.path.startswith(self.path))
+
+@event.listens_for(Department, 'after_insert')
+def set_department_path(mapper, connection, target):
+    """حساب المسار المادي للقسم الجديد بعد حصوله على معرف"""
+    if target.path:
+        return
+    table = Department.__table__
+    parent = None
+    if target.parent_id:
+        parent = connection.execute(
+            select(table.c.path, table.c.level).where(table.c.id == target.parent_id)
+        ).first()
+    path = (parent.path if parent and parent.path else '/') + f'{target.id}/'
+    level = (parent.level or 0) + 1 if parent else 0
+    connection.execute(table.update().where(table.c.id == target.id).values(path=path, level=level))
+    set_committed_value(target, 'path', path)
+    set_committed_value(target, 'level', level)
+
 # User model
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     password = db.Column(db.String(120), nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
-    department_id = db.Column(db.Integer, db.ForeignKey('department.id'))
+    department_id = db.Column(db.Integer, db.ForeignKey('department.id'), index=True)
     department_name = db.Column(db.String(80))  # للتوافق مع الإصدارات السابقة
     role = db.Column(db.String(20))  # للتوافق مع الإصدارات السابقة
-    role_id = db.Column(db.Integer, db.ForeignKey('role.id'))  # الدور الجديد
-    is_active = db.Column(db.Boolean, default=True)
+    role_id = db.Column(db.Integer, db.ForeignKey('role.id'), index=True)  # الدور الجديد
+    is_active = db.Column(db.Boolean, default=True, index=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)  # لتحديث فهرس المستلمين تزايديًا
+    last_login_at = db.Column(db.DateTime, index=True)  # آخر تسجيل دخول ناجح (لفرز وتصفية قائمة المستخدمين)
     reset_token = db.Column(db.String(100), unique=True)
     reset_token_expiry = db.Column(db.DateTime)
 
     # معلومات الملف الشخصي الإضافية
-    full_name = db.Column(db.String(150))
+    full_name = db.Column(db.String(150), index=True)
     phone = db.Column(db.String(20))
-    position = db.Column(db.String(100))
+    position = db.Column(db.String(100), index=True)
     bio = db.Column(db.Text)
     profile_image = db.Column(db.String(200))
     signature = db.Column(db.Text)  # توقيع المستخدم للرسائل (نص)
@@ -155,13 +468,20 @@ class User(UserMixin, db.Model):
         db.session.commit()
         return self.reset_token
 
+    def get_role_record(self):
+        """الحصول على دور المستخدم من لقطة البيانات المرجعية"""
+        if not self.role_id:
+            return None
+        return get_reference_data().get_role(self.role_id)
+
     def is_admin(self):
         """التحقق مما إذا كان المستخدم مشرفًا"""
         # للتوافق مع الإصدارات السابقة
         if self.role == 'admin':
             return True
         # التحقق من الدور الجديد
-        if self.role_obj and self.role_obj.name == 'admin':
+        role = self.get_role_record()
+        if role and role.name == 'admin':
             return True
         return False
 
@@ -171,8 +491,8 @@ class User(UserMixin, db.Model):
         if self.is_admin():
             return True
         # التحقق من صلاحيات الدور
-        if self.role_obj:
-            return self.role_obj.has_permission(permission_name)
+        if self.role_id:
+            return get_reference_data().role_has_permission(self.role_id, permission_name)
         return False
 
     def has_status_permission(self):
@@ -199,26 +519,56 @@ class User(UserMixin, db.Model):
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     subject = db.Column(db.String(200), nullable=False)
-    content = db.Column(db.Text, nullable=False)
     date = db.Column(db.DateTime, default=datetime.utcnow)
     sender_id = db.Column(db.Integer, db.ForeignKey('user.id'))
-    recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'))  # للتوافق مع الإصدارات السابقة
-    status = db.Column(db.String(20), default='new')  # للتوافق مع الإصدارات السابقة
+    recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)  # للتوافق مع الإصدارات السابقة
+    status = db.Column(MessageStatus, default='new')  # للتوافق مع الإصدارات السابقة
     category = db.Column(db.String(50))
     is_archived = db.Column(db.Boolean, default=False)  # للتوافق مع الإصدارات السابقة
     has_attachments = db.Column(db.Boolean, default=False)
 
     # حقول جديدة للمستلمين المتعددين
     is_multi_recipient = db.Column(db.Boolean, default=False)  # هل الرسالة لها مستلمين متعددين
-    recipient_type = db.Column(db.String(20), default='user')  # نوع المستلم (user, group, multiple)
+    recipient_type = db.Column(RecipientType, default='user')  # نوع المستلم (user, group, multiple, department, all)
+    delivery_mode = db.Column(db.String(20), default='direct')  # direct: صف لكل مستلم عند الإرسال، broadcast: تعريف جمهور وحالة عند التفاعل فقط
 
     # حقول أخرى
-    priority = db.Column(db.String(20), default='normal')  # عادي، عاجل، هام جداً
-    message_type = db.Column(db.String(30))  # مذكرة، تعميم، طلب، إخطار، incoming
-    confidentiality = db.Column(db.String(20), default='normal')  # عام، سري، سري للغاية
+    priority = db.Column(MessagePriority, default='normal')  # عادي، عاجل، هام جداً
+    message_type = db.Column(MessageType)  # مذكرة، تعميم، طلب، إخطار، incoming
+    confidentiality = db.Column(MessageConfidentiality, default='normal')  # عام، سري، سري للغاية
     reference_number = db.Column(db.String(50))  # رقم مرجعي للرسالة
     due_date = db.Column(db.Date)  # تاريخ الاستحقاق أو الموعد النهائي
     sender_entity = db.Column(db.String(200))  # الجهة المرسلة (للرسائل الواردة)
+    send_at = db.Column(db.DateTime)  # موعد الإرسال المجدول (فارغ للإرسال الفوري)
+
+    # الرسائل الواردة: تاريخ الخطاب الخارجي وبصمتا كشف التكرار
+    document_date = db.Column(db.Date)  # تاريخ الخطاب الوارد
+    incoming_fingerprint = db.Column(db.String(40))  # الجهة + الرقم المرجعي + التاريخ + تجزئة المحتوى
+    incoming_reference_key = db.Column(db.String(40))  # الجهة + الرقم المرجعي فقط (تكرار محتمل)
+
+    # رقم القيد الرسمي (تسلسل لكل قسم وسنة يوزع عند الإرسال) منفصل عن الرقم المرجعي الحر
+    registry_number = db.Column(db.String(50))
+    registry_department_id = db.Column(db.Integer)
+    registry_year = db.Column(db.SmallInteger)
+    registry_sequence = db.Column(db.Integer)
+
+    # المحادثات: الرسالة الأولى في المحادثة هي جذرها (thread_id = id)، والردود تشير إلى الجذر وإلى الرسالة المردود عليها
+    thread_id = db.Column(db.Integer, db.ForeignKey('message.id'))
+    parent_id = db.Column(db.Integer, db.ForeignKey('message.id'))
+
+    __table_args__ = (
+        db.Index('ix_message_thread_date', 'thread_id', 'date'),
+        db.Index('ix_message_due_status', 'due_date', 'status'),
+        db.Index('ix_message_registry_number', 'registry_number', unique=True),
+        db.Index('ix_message_incoming_fingerprint', 'incoming_fingerprint'),
+        db.Index('ix_message_incoming_reference_key', 'incoming_reference_key'),
+        db.Index('ix_message_registry_sequence', 'registry_department_id', 'registry_year', 'registry_sequence', unique=True),
+        MessageStatus.check_constraint('status', 'message'),
+        MessagePriority.check_constraint('priority', 'message'),
+        MessageType.check_constraint('message_type', 'message'),
+        MessageConfidentiality.check_constraint('confidentiality', 'message'),
+        RecipientType.check_constraint('recipient_type', 'message'),
+    )
 
     # إضافة العلاقات
     sender = db.relationship('User', foreign_keys=[sender_id], backref='sent_messages')
@@ -226,6 +576,31 @@ class Message(db.Model):
     attachments = db.relationship('Attachment', backref='message', lazy='dynamic', cascade='all, delete-orphan')
     status_changes = db.relationship('MessageStatusChange', backref='message', lazy='dynamic', cascade='all, delete-orphan')
     recipients_data = db.relationship('MessageRecipient', backref='message', cascade='all, delete-orphan')
+    audiences = db.relationship('MessageAudience', backref='message', cascade='all, delete-orphan')
+    read_events = db.relationship('MessageReadEvent', lazy='dynamic', cascade='all, delete-orphan')
+    status_events = db.relationship('MessageStatusEvent', lazy='dynamic', cascade='all, delete-orphan')
+    status_times = db.relationship('MessageStatusTime', lazy='dynamic', cascade='all, delete-orphan')
+    parent = db.relationship('Message', remote_side=[id], foreign_keys=[parent_id])
+    scheduled_send = db.relationship('ScheduledSend', uselist=False, cascade='all, delete-orphan')
+
+    # نص الرسالة في جدول منفصل (message_body) لا يحمل إلا عند الوصول إليه
+    body = db.relationship('MessageBody', uselist=False, cascade='all, delete-orphan')
+
+    @property
+    def content(self):
+        """نص الرسالة (يتم تحميله وفك ضغطه عند الطلب فقط)"""
+        return self.body.text if self.body else ''
+
+    @content.setter
+    def content(self, value):
+        if self.body is None:
+            self.body = MessageBody()
+        self.body.text = value
+
+    @property
+    def content_html(self):
+        """نص الرسالة كـ HTML آمن محول مسبقًا (يعاد تحويله فقط عند تغير إصدار المحول)"""
+        return Markup(self.body.html) if self.body else Markup('')
 
     # دوال مساعدة للمستلمين المتعددين
     def get_recipients(self):
@@ -236,6 +611,60 @@ class Message(db.Model):
         recipients_data = MessageRecipient.query.filter_by(message_id=self.id).all()
         return [r.recipient for r in recipients_data]
 
+    @property
+    def is_broadcast(self):
+        return self.delivery_mode == 'broadcast'
+
+    @property
+    def is_scheduled(self):
+        """هل الرسالة بانتظار موعد إرسالها المجدول"""
+        return self.scheduled_send is not None
+
+    def is_in_audience(self, user):
+        """التحقق مما إذا كان المستخدم ضمن جمهور التعميم"""
+        if not self.is_broadcast or user.id == self.sender_id:
+            return False
+        ancestor_ids = get_reference_data().get_department_ancestor_ids(user.department_id)
+        for audience in self.audiences:
+            if audience.audience_type == 'all':
+                return True
+            if audience.audience_type == 'department' and audience.target_id in ancestor_ids:
+                return True
+        return False
+
+    def get_recipient_state(self, user, create=False):
+        """الحصول على صف حالة المستخدم في الرسالة
+
+        في التعاميم لا يوجد صف قبل أول تفاعل؛ يعاد صف افتراضي بحالة "جديد"
+        لأعضاء الجمهور، ويضاف إلى الجلسة فقط عند create=True.
+        """
+        recipient_data = MessageRecipient.query.filter_by(
+            message_id=self.id,
+            recipient_id=user.id
+        ).first()
+
+        if recipient_data or not self.is_in_audience(user):
+            return recipient_data
+
+        recipient_data = MessageRecipient(
+            message_id=self.id,
+            recipient_id=user.id,
+            recipient_type=self.recipient_type,
+            status='new',
+            is_archived=False
+        )
+        if create:
+            db.session.add(recipient_data)
+        return recipient_data
+
+    def get_audience_users(self):
+        """استعلام معرفات المستخدمين ضمن جمهور التعميم"""
+        audience = select(User.id).where(User.is_active == True, User.id != self.sender_id)
+        if any(a.audience_type == 'all' for a in self.audiences):
+            return audience
+        department_ids = [a.target_id for a in self.audiences if a.audience_type == 'department']
+        return audience.where(User.department_id.in_(subtree_department_ids(department_ids)))
+
     def add_recipient(self, recipient_id, recipient_type='user'):
         """إضافة مستلم للرسالة"""
         # التحقق من عدم وجود المستلم بالفعل
@@ -295,78 +724,31 @@ class Message(db.Model):
 
     def get_status_display(self):
         """الحصول على النص العربي لحالة الرسالة"""
-        status_map = {
-            'new': 'جديد',
-            'read': 'مقروء',
-            'replied': 'تم الرد',
-            'processing': 'قيد المعالجة',
-            'completed': 'مكتمل',
-            'closed': 'مغلق',
-            'postponed': 'مؤجل'
-        }
-        return status_map.get(self.status, self.status)
+        return MESSAGE_STATUS_DISPLAY.get(self.status, self.status)
 
     def get_status_color(self):
         """الحصول على لون حالة الرسالة"""
-        status_colors = {
-            'new': 'primary',
-            'read': 'success',
-            'replied': 'info',
-            'processing': 'warning',
-            'completed': 'success',
-            'closed': 'secondary',
-            'postponed': 'danger'
-        }
-        return status_colors.get(self.status, 'secondary')
+        return MESSAGE_STATUS_COLORS.get(self.status, 'secondary')
 
     def get_priority_display(self):
         """الحصول على النص العربي لأولوية الرسالة"""
-        priority_map = {
-            'normal': 'عادي',
-            'urgent': 'عاجل',
-            'very_urgent': 'هام جداً'
-        }
-        return priority_map.get(self.priority, self.priority)
+        return MESSAGE_PRIORITY_DISPLAY.get(self.priority, self.priority)
 
     def get_priority_color(self):
         """الحصول على لون أولوية الرسالة"""
-        priority_colors = {
-            'normal': 'success',
-            'urgent': 'warning',
-            'very_urgent': 'danger'
-        }
-        return priority_colors.get(self.priority, 'secondary')
+        return MESSAGE_PRIORITY_COLORS.get(self.priority, 'secondary')
 
     def get_message_type_display(self):
         """الحصول على النص العربي لنوع الرسالة"""
-        type_map = {
-            'memo': 'مذكرة',
-            'circular': 'تعميم',
-            'request': 'طلب',
-            'notification': 'إخطار',
-            'report': 'تقرير',
-            'invitation': 'دعوة',
-            'other': 'أخرى'
-        }
-        return type_map.get(self.message_type, self.message_type)
+        return MESSAGE_TYPE_DISPLAY.get(self.message_type, self.message_type)
 
     def get_confidentiality_display(self):
         """الحصول على النص العربي لمستوى سرية الرسالة"""
-        confidentiality_map = {
-            'normal': 'عام',
-            'confidential': 'سري',
-            'highly_confidential': 'سري للغاية'
-        }
-        return confidentiality_map.get(self.confidentiality, self.confidentiality)
+        return MESSAGE_CONFIDENTIALITY_DISPLAY.get(self.confidentiality, self.confidentiality)
 
     def get_confidentiality_color(self):
         """الحصول على لون مستوى سرية الرسالة"""
-        confidentiality_colors = {
-            'normal': 'success',
-            'confidential': 'warning',
-            'highly_confidential': 'danger'
-        }
-        return confidentiality_colors.get(self.confidentiality, 'secondary')
+        return MESSAGE_CONFIDENTIALITY_COLORS.get(self.confidentiality, 'secondary')
 
     def change_status(self, new_status, user_id, notes=None, recipient_id=None):
         """تغيير حالة الرسالة وتسجيل التغيير"""
@@ -377,6 +759,11 @@ class Message(db.Model):
                 recipient_id=recipient_id
             ).first()
 
+            # إنشاء صف الحالة عند أول تفاعل مع التعميم
+            if not recipient_data and self.is_broadcast:
+                recipient = db.session.get(User, recipient_id)
+                recipient_data = self.get_recipient_state(recipient, create=True) if recipient else None
+
             if recipient_data:
                 if recipient_data.status == new_status:
                     return False
@@ -388,17 +775,8 @@ class Message(db.Model):
                 if new_status == 'read' and not recipient_data.read_at:
                     recipient_data.read_at = datetime.now()
 
-                # إنشاء سجل تغيير الحالة
-                status_change = MessageStatusChange(
-                    message_id=self.id,
-                    old_status=old_status,
-                    new_status=new_status,
-                    changed_by_id=user_id,
-                    notes=notes,
-                    recipient_id=recipient_id
-                )
-
-                db.session.add(status_change)
+                # تسجيل حدث تغيير الحالة وتحديث ملخص زمن البقاء في كل حالة
+                self.record_status_event(old_status, new_status, user_id, notes, recipient_id)
                 return True
             return False
 
@@ -409,30 +787,162 @@ class Message(db.Model):
         old_status = self.status
         self.status = new_status
 
-        # إنشاء سجل تغيير الحالة
-        status_change = MessageStatusChange(
+        # تسجيل حدث تغيير الحالة وتحديث ملخص زمن البقاء في كل حالة
+        self.record_status_event(old_status, new_status, user_id, notes)
+        return True
+
+    def record_status_event(self, old_status, new_status, user_id, notes=None, recipient_id=None):
+        """تسجيل حدث تغيير حالة مضغوط (رموز صغيرة) وتحديث ملخص زمن البقاء في كل حالة"""
+        changed_at = datetime.now()
+        db.session.add(MessageStatusEvent(
             message_id=self.id,
-            old_status=old_status,
-            new_status=new_status,
+            recipient_id=recipient_id,
+            old_code=MESSAGE_STATUS_CODES[old_status or 'new'],
+            new_code=MESSAGE_STATUS_CODES[new_status],
+            changed_at=changed_at,
             changed_by_id=user_id,
-            notes=notes
+            notes=notes or None
+        ))
+        record_status_transition(
+            db.session.connection(), self.id, recipient_id or self.recipient_id,
+            old_status or 'new', new_status, changed_at, utc_to_local(self.date)
+        )
+
+    def can_be_viewed_by(self, user):
+        """التحقق من حق المستخدم في الاطلاع على الرسالة (دون تعديل حالتها)"""
+        if user.id in (self.sender_id, self.recipient_id):
+            return True
+        if not self.is_multi_recipient:
+            return False
+        return self.get_recipient_state(user) is not None
+
+    def link_attachments(self, attachments):
+        """إرفاق ملفات رسالة أخرى بالإشارة إليها دون نسخ محتواها"""
+        linked = 0
+        for attachment in attachments:
+            self.attachments.append(attachment.link_copy())
+            linked += 1
+        if linked:
+            self.has_attachments = True
+        return linked
+
+    def update_incoming_fingerprint(self, content=None):
+        """حساب بصمتي كشف التكرار للرسالة الواردة (content: نص الخطاب قبل إضافة التوقيع)"""
+        if self.message_type != 'incoming':
+            self.incoming_fingerprint = self.incoming_reference_key = None
+            return
+        self.incoming_fingerprint = incoming_fingerprint(self.sender_entity, self.reference_number, self.document_date,
+                                                         self.content if content is None else content)
+        self.incoming_reference_key = incoming_reference_key(self.sender_entity, self.reference_number)
+
+    def join_thread(self, parent):
+        """ربط الرسالة بمحادثة الرسالة المردود عليها"""
+        self.parent_id = parent.id
+        self.thread_id = parent.thread_id or parent.id
+
+@event.listens_for(Message, 'after_insert')
+def set_message_thread(mapper, connection, target):
+    """الرسالة التي لا تنتمي إلى محادثة تصبح جذرًا لمحادثة جديدة
+    (يتم التحديث في قاعدة البيانات بجملة واحدة بعد انتهاء عملية الحفظ)"""
+    if target.thread_id:
+        return
+    sa_inspect(target).session.info.setdefault('message_thread_roots', []).append(target.id)
+    set_committed_value(target, 'thread_id', target.id)
+
+@event.listens_for(db.session, 'after_flush')
+def save_message_thread_roots(session, flush_context):
+    """حفظ معرفات المحادثات للرسائل الجذرية الجديدة على دفعات"""
+    roots = session.info.pop('message_thread_roots', None)
+    if not roots:
+        return
+    connection = session.connection()
+    table = Message.__table__
+    for start in range(0, len(roots), 500):
+        connection.execute(
+            table.update()
+            .where(table.c.id.in_(roots[start:start + 500]), table.c.thread_id.is_(None))
+            .values(thread_id=table.c.id)
         )
 
-        db.session.add(status_change)
+@event.listens_for(db.session, 'after_rollback')
+def discard_message_thread_roots(session):
+    session.info.pop('message_thread_roots', None)
+
+# نموذج نص الرسالة
+# يفصل النص عن ترويسة الرسالة حتى تبقى صفوف جدول الرسائل صغيرة في استعلامات القوائم والعد،
+# ويضغط بـ zlib إذا تجاوز حجمه MESSAGE_BODY_COMPRESS_THRESHOLD
+class MessageBody(db.Model):
+    __tablename__ = 'message_body'
+
+    message_id = db.Column(db.Integer, db.ForeignKey('message.id'), primary_key=True)
+    encoding = db.Column(db.String(10), nullable=False, default='utf8')  # utf8 أو zlib
+    size = db.Column(db.Integer, nullable=False, default=0)  # حجم النص قبل الضغط بالبايت
+    data = db.Column(db.LargeBinary, nullable=False, default=b'')
+
+    # HTML المحول والمنقى مسبقًا (بنفس ترميز النص) ورقم إصدار المحول الذي أنتجه
+    html_encoding = db.Column(db.String(10))
+    html_data = db.Column(db.LargeBinary)
+    html_version = db.Column(db.Integer)
+
+    @staticmethod
+    def encode(text, threshold=None):
+        """ترميز النص وضغطه إذا تجاوز الحد وكان الضغط مفيدًا، ويعاد (encoding, size, data)"""
+        raw = (text or '').encode('utf-8')
+        if threshold is None:
+            threshold = app.config['MESSAGE_BODY_COMPRESS_THRESHOLD']
+        if len(raw) >= threshold:
+            compressed = zlib.compress(raw, app.config['MESSAGE_BODY_COMPRESS_LEVEL'])
+            if len(compressed) < len(raw):
+                return 'zlib', len(raw), compressed
+        return 'utf8', len(raw), raw
+
+    @property
+    def text(self):
+        data = self.data or b''
+        if self.encoding == 'zlib':
+            data = zlib.decompress(data)
+        return data.decode('utf-8')
+
+    @text.setter
+    def text(self, value):
+        self.encoding, self.size, self.data = MessageBody.encode(value)
+        self.render_html(value)
+
+    def render_html(self, text=None):
+        """تحويل النص إلى HTML آمن وتخزينه مع إصدار المحول"""
+        rendered = render_body_html(self.text if text is None else text)
+        self.html_encoding, _, self.html_data = MessageBody.encode(rendered)
+        self.html_version = BODY_RENDERER_VERSION
+
+    def ensure_html(self):
+        """إعادة التحويل إذا كان HTML المخزن من إصدار أقدم للمحول؛ يعاد True إذا تم التحويل"""
+        if self.html_version == BODY_RENDERER_VERSION and self.html_data is not None:
+            return False
+        self.render_html()
         return True
 
+    @property
+    def html(self):
+        self.ensure_html()
+        data = self.html_data
+        if self.html_encoding == 'zlib':
+            data = zlib.decompress(data)
+        return data.decode('utf-8')
+
 # نموذج البريد الشخصي
 class PersonalMail(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)  # المستخدم المالك
     title = db.Column(db.String(200), nullable=False)  # عنوان البريد الشخصي
     content = db.Column(db.Text)  # محتوى البريد
+    content_html = db.deferred(db.Column(db.Text))  # المحتوى كـ HTML آمن محول عند الحفظ
+    content_html_version = db.Column(db.Integer)  # إصدار المحول الذي أنتج content_html
     source = db.Column(db.String(200))  # مصدر البريد (من أين)
     reference_number = db.Column(db.String(100))  # الرقم المرجعي
     date = db.Column(db.DateTime, default=datetime.utcnow)  # تاريخ الإضافة
     due_date = db.Column(db.Date)  # تاريخ الاستحقاق
-    status = db.Column(db.String(20), default='pending')  # حالة البريد (pending, in_progress, completed, cancelled)
-    priority = db.Column(db.String(20), default='normal')  # أولوية البريد (normal, urgent, very_urgent)
+    status = db.Column(PersonalMailStatus, default='pending')  # حالة البريد (pending, in_progress, completed, cancelled)
+    priority = db.Column(MessagePriority, default='normal')  # أولوية البريد (normal, urgent, very_urgent)
     notes = db.Column(db.Text)  # ملاحظات إضافية
     has_attachments = db.Column(db.Boolean, default=False)  # هل يحتوي على مرفقات
     is_archived = db.Column(db.Boolean, default=False)  # هل تم أرشفته
@@ -441,43 +951,46 @@ class PersonalMail(db.Model):
     user = db.relationship('User', backref='personal_mails')
     attachments = db.relationship('PersonalMailAttachment', backref='personal_mail', lazy='dynamic', cascade='all, delete-orphan')
 
+    __table_args__ = (
+        db.Index('ix_personal_mail_due_status', 'due_date', 'status'),
+        PersonalMailStatus.check_constraint('status', 'personal_mail'),
+        MessagePriority.check_constraint('priority', 'personal_mail'),
+    )
+
+    def ensure_content_html(self):
+        """إعادة تحويل المحتوى إذا كان HTML المخزن من إصدار أقدم للمحول؛ يعاد True إذا تم التحويل"""
+        if self.content_html_version == BODY_RENDERER_VERSION:
+            return False
+        self.content_html = render_body_html(self.content)
+        self.content_html_version = BODY_RENDERER_VERSION
+        return True
+
+    def get_content_html(self):
+        """محتوى البريد كـ HTML آمن محول مسبقًا"""
+        self.ensure_content_html()
+        return Markup(self.content_html or '')
+
     def get_status_display(self):
         """الحصول على النص العربي لحالة البريد الشخصي"""
-        status_map = {
-            'pending': 'قيد الانتظار',
-            'in_progress': 'قيد التنفيذ',
-            'completed': 'مكتمل',
-            'cancelled': 'ملغي'
-        }
-        return status_map.get(self.status, self.status)
+        return PERSONAL_MAIL_STATUS_DISPLAY.get(self.status, self.status)
 
     def get_status_color(self):
         """الحصول على لون حالة البريد الشخصي"""
-        status_colors = {
-            'pending': 'warning',
-            'in_progress': 'info',
-            'completed': 'success',
-            'cancelled': 'danger'
-        }
-        return status_colors.get(self.status, 'secondary')
+        return PERSONAL_MAIL_STATUS_COLORS.get(self.status, 'secondary')
 
     def get_priority_display(self):
         """الحصول على النص العربي لأولوية البريد الشخصي"""
-        priority_map = {
-            'normal': 'عادي',
-            'urgent': 'عاجل',
-            'very_urgent': 'هام جداً'
-        }
-        return priority_map.get(self.priority, self.priority)
+        return MESSAGE_PRIORITY_DISPLAY.get(self.priority, self.priority)
 
     def get_priority_color(self):
         """الحصول على لون أولوية البريد الشخصي"""
-        priority_colors = {
-            'normal': 'success',
-            'urgent': 'warning',
-            'very_urgent': 'danger'
-        }
-        return priority_colors.get(self.priority, 'secondary')
+        return MESSAGE_PRIORITY_COLORS.get(self.priority, 'secondary')
+
+@event.listens_for(PersonalMail.content, 'set')
+def render_personal_mail_content(target, value, oldvalue, initiator):
+    """تحويل محتوى البريد الشخصي إلى HTML عند كل تعديل عليه"""
+    target.content_html = render_body_html(value)
+    target.content_html_version = BODY_RENDERER_VERSION
 
 # نموذج مرفقات البريد الشخصي
 class PersonalMailAttachment(db.Model):
@@ -543,6 +1056,96 @@ class MessageStatusChange(db.Model):
     changed_by = db.relationship('User', foreign_keys=[changed_by_id], backref='status_changes')
     recipient = db.relationship('User', foreign_keys=[recipient_id], backref='status_changes_as_recipient')
 
+# نموذج أحداث الحالة المضغوطة (يحل محل MessageStatusChange للتغييرات الجديدة)
+# الحالات تخزن كرموز صغيرة (MESSAGE_STATUS_CODES)، والقراءات التلقائية تسجل في message_read_event
+class MessageStatusEvent(db.Model):
+    __tablename__ = 'message_status_event'
+
+    id = db.Column(db.Integer, primary_key=True)
+    message_id = db.Column(db.Integer, db.ForeignKey('message.id'), nullable=False)
+    recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'))  # المستلم المحدد (في حالة الرسائل متعددة المستلمين)
+    old_code = db.Column(db.SmallInteger, nullable=False)
+    new_code = db.Column(db.SmallInteger, nullable=False)
+    changed_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    changed_by_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    notes = db.Column(db.Text)
+
+    # فهرس سجل الحالة لكل رسالة بترتيب زمني
+    __table_args__ = (
+        db.Index('ix_message_status_event_message', 'message_id', 'changed_at'),
+    )
+
+    @property
+    def old_status(self):
+        return MESSAGE_STATUS_NAMES[self.old_code]
+
+    @property
+    def new_status(self):
+        return MESSAGE_STATUS_NAMES[self.new_code]
+
+# نموذج ملخص زمن البقاء في كل حالة (صف لكل رسالة ومستلم وحالة)
+# seconds: مجموع الفترات المغلقة، entered_at: بداية الفترة الحالية إذا كانت هذه هي الحالة الحالية
+class MessageStatusTime(db.Model):
+    __tablename__ = 'message_status_time'
+
+    message_id = db.Column(db.Integer, db.ForeignKey('message.id'), primary_key=True)
+    recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    status_code = db.Column(db.SmallInteger, primary_key=True)
+    seconds = db.Column(db.Integer, nullable=False, default=0)
+    entered_at = db.Column(db.DateTime)
+
+    @property
+    def status(self):
+        return MESSAGE_STATUS_NAMES[self.status_code]
+
+    def total_seconds(self, now=None):
+        """الزمن الكلي في الحالة (مع الفترة الجارية إن وجدت)"""
+        if self.entered_at is None:
+            return self.seconds
+        return self.seconds + max(int(((now or datetime.now()) - self.entered_at).total_seconds()), 0)
+
+def utc_to_local(value):
+    """تحويل تاريخ مخزن بالتوقيت العالمي (مثل Message.date) إلى التوقيت المحلي المستخدم في سجل الحالة"""
+    if value is None:
+        return None
+    offset = datetime.now() - datetime.utcnow()
+    return value + timedelta(minutes=round(offset.total_seconds() / 60))
+
+def record_status_transition(connection, message_id, recipient_id, old_status, new_status, changed_at, started_at=None):
+    """تحديث ملخص زمن البقاء: إغلاق فترة الحالة السابقة وفتح فترة الحالة الجديدة.
+    started_at هو بداية الحالة الأولى (تاريخ الرسالة) لأن صفها لا ينشأ إلا عند أول انتقال"""
+    old_code = MESSAGE_STATUS_CODES.get(old_status)
+    new_code = MESSAGE_STATUS_CODES.get(new_status)
+    if old_code is None or new_code is None or old_code == new_code or recipient_id is None:
+        return
+
+    table = MessageStatusTime.__table__
+    key = and_(table.c.message_id == message_id, table.c.recipient_id == recipient_id)
+    rows = dict(connection.execute(select(table.c.status_code, table.c.entered_at).where(key)).all())
+
+    # إغلاق فترة الحالة السابقة
+    entered_at = rows.get(old_code) if old_code in rows else started_at
+    elapsed = max(int((changed_at - entered_at).total_seconds()), 0) if entered_at else 0
+    if old_code in rows:
+        connection.execute(
+            table.update().where(key, table.c.status_code == old_code)
+            .values(seconds=table.c.seconds + elapsed, entered_at=None)
+        )
+    else:
+        connection.execute(table.insert().values(
+            message_id=message_id, recipient_id=recipient_id, status_code=old_code, seconds=elapsed, entered_at=None
+        ))
+
+    # فتح فترة الحالة الجديدة
+    if new_code in rows:
+        connection.execute(
+            table.update().where(key, table.c.status_code == new_code).values(entered_at=changed_at)
+        )
+    else:
+        connection.execute(table.insert().values(
+            message_id=message_id, recipient_id=recipient_id, status_code=new_code, seconds=0, entered_at=changed_at
+        ))
+
 # نموذج سجل تغييرات الصلاحيات
 class PermissionChange(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -575,8 +1178,9 @@ class PermissionChange(db.Model):
         }
 
         # إذا كان التغيير متعلق بصلاحية محددة وتم تحديدها
-        if self.permission_id and self.permission:
-            return f"{permission_map.get(self.permission_type, self.permission_type)}: {self.permission.get_display_name()}"
+        permission = get_reference_data().get_permission(self.permission_id) if self.permission_id else None
+        if permission:
+            return f"{permission_map.get(self.permission_type, self.permission_type)}: {permission.get_display_name()}"
 
         return permission_map.get(self.permission_type, self.permission_type)
 
@@ -590,14 +1194,9 @@ class PermissionChange(db.Model):
                 return 'بدون دور'
 
             # محاولة الحصول على اسم الدور
-            try:
-                role_id = int(value)
-                from app import Role
-                role = Role.query.get(role_id)
-                if role:
-                    return role.name
-            except:
-                pass
+            role = get_reference_data().get_role(value)
+            if role:
+                return role.name
 
             return value
 
@@ -629,6 +1228,7 @@ class Permission(db.Model):
     description = db.Column(db.String(255))  # وصف الصلاحية
     group_id = db.Column(db.Integer, db.ForeignKey('permission_group.id'))  # مجموعة الصلاحية
     is_critical = db.Column(db.Boolean, default=False)  # هل هي صلاحية حساسة
+    bit = db.Column(db.Integer, unique=True)  # موقع الصلاحية في مجموعة بتات الدور
 
     # العلاقة مع الأدوار
     roles = db.relationship('Role', secondary='role_permissions', back_populates='permissions')
@@ -645,6 +1245,7 @@ class Role(db.Model):
     name = db.Column(db.String(50), unique=True, nullable=False)  # اسم الدور (مثل: admin, user, manager)
     description = db.Column(db.String(255))  # وصف الدور
     is_system = db.Column(db.Boolean, default=False)  # هل هو دور نظام (لا يمكن حذفه)
+    permission_bits = db.Column(db.BigInteger, default=0, nullable=False)  # صلاحيات الدور كمجموعة بتات (مشتقة من role_permissions)
 
     # العلاقة مع المستخدمين
     users = db.relationship('User', backref='role_obj', lazy='dynamic')
@@ -654,6 +1255,8 @@ class Role(db.Model):
 
     def has_permission(self, permission_name):
         """التحقق مما إذا كان الدور يملك صلاحية معينة"""
+        if self.id is not None:
+            return get_reference_data().role_has_permission(self.id, permission_name)
         for permission in self.permissions:
             if permission.name == permission_name:
                 return True
@@ -667,6 +1270,10 @@ role_permissions = db.Table('role_permissions',
 
 # نموذج سجل دخول المستخدمين
 class UserLoginLog(db.Model):
+    __table_args__ = (
+        db.Index('ix_user_login_log_user_date', 'user_id', 'login_date'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)  # المستخدم الذي قام بتسجيل الدخول
     login_date = db.Column(db.DateTime, default=datetime.now)  # تاريخ ووقت تسجيل الدخول
@@ -687,18 +1294,33 @@ class UserGroup(db.Model):
     is_active = db.Column(db.Boolean, default=True)  # حالة المجموعة
     is_public = db.Column(db.Boolean, default=True)  # هل المجموعة عامة (يمكن للجميع رؤيتها)
 
+    # المجموعات الديناميكية: العضوية تحسب من قواعد (JSON) على القسم والدور والمسمى الوظيفي والحالة
+    is_dynamic = db.Column(db.Boolean, default=False)
+    rules = db.Column(db.Text)
+
     # العلاقات
     created_by = db.relationship('User', backref='created_groups')
     members = db.relationship('UserGroupMembership', back_populates='group', cascade='all, delete-orphan')
 
+    def member_ids_query(self):
+        """استعلام معرفات أعضاء المجموعة (من القواعد أو من جدول العضوية)"""
+        if self.is_dynamic:
+            return select(User.id).where(compile_group_rules(self.rules))
+        return select(UserGroupMembership.user_id).where(UserGroupMembership.group_id == self.id)
+
     def get_members_count(self):
         """الحصول على عدد أعضاء المجموعة"""
+        if self.is_dynamic:
+            return count_audience(self.member_ids_query())
         return UserGroupMembership.query.filter_by(group_id=self.id).count()
 
     def get_members(self):
         """الحصول على قائمة أعضاء المجموعة"""
-        memberships = UserGroupMembership.query.filter_by(group_id=self.id).all()
-        return [membership.user for membership in memberships]
+        if self.is_dynamic:
+            return User.query.filter(User.id.in_(self.member_ids_query())).all()
+        # استعلام واحد بدل تحميل مستخدم كل عضوية على حدة
+        return User.query.join(UserGroupMembership, UserGroupMembership.user_id == User.id)\
+            .filter(UserGroupMembership.group_id == self.id).all()
 
     def add_member(self, user_id, role='member'):
         """إضافة عضو إلى المجموعة"""
@@ -724,6 +1346,8 @@ class UserGroup(db.Model):
 
     def is_member(self, user_id):
         """التحقق مما إذا كان المستخدم عضوًا في المجموعة"""
+        if self.is_dynamic:
+            return db.session.query(User.id).filter(User.id == user_id, compile_group_rules(self.rules)).first() is not None
         return UserGroupMembership.query.filter_by(group_id=self.id, user_id=user_id).first() is not None
 
     def is_admin(self, user_id):
@@ -765,8 +1389,8 @@ class MessageRecipient(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     message_id = db.Column(db.Integer, db.ForeignKey('message.id'), nullable=False)
     recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    recipient_type = db.Column(db.String(20), default='user')  # نوع المستلم (user, group)
-    status = db.Column(db.String(20), default='new')  # حالة الرسالة لهذا المستلم
+    recipient_type = db.Column(RecipientType, default='user')  # نوع المستلم (user, group, department, all)
+    status = db.Column(MessageStatus, default='new')  # حالة الرسالة لهذا المستلم
     is_archived = db.Column(db.Boolean, default=False)  # هل تم أرشفة الرسالة من قبل هذا المستلم
     read_at = db.Column(db.DateTime)  # تاريخ قراءة الرسالة
 
@@ -774,33 +1398,77 @@ class MessageRecipient(db.Model):
     recipient = db.relationship('User', backref='received_message_data')
 
     # تعريف مفتاح فريد مركب لضمان عدم تكرار المستلم للرسالة
-    __table_args__ = (db.UniqueConstraint('message_id', 'recipient_id', name='_message_recipient_uc'),)
+    # وفهرس لصندوق الوارد لكل مستلم (يستخدم في العدادات وقوائم الرسائل)
+    __table_args__ = (
+        db.UniqueConstraint('message_id', 'recipient_id', name='_message_recipient_uc'),
+        db.Index('ix_message_recipient_inbox', 'recipient_id', 'is_archived', 'status'),
+        MessageStatus.check_constraint('status', 'message_recipient'),
+        RecipientType.check_constraint('recipient_type', 'message_recipient'),
+    )
 
     def get_status_display(self):
         """الحصول على النص العربي لحالة الرسالة"""
-        status_map = {
-            'new': 'جديد',
-            'read': 'مقروء',
-            'replied': 'تم الرد',
-            'processing': 'قيد المعالجة',
-            'completed': 'مكتمل',
-            'closed': 'مغلق',
-            'postponed': 'مؤجل'
-        }
-        return status_map.get(self.status, self.status)
+        return MESSAGE_STATUS_DISPLAY.get(self.status, self.status)
 
     def get_status_color(self):
         """الحصول على لون حالة الرسالة"""
-        status_colors = {
-            'new': 'primary',
-            'read': 'success',
-            'replied': 'info',
-            'processing': 'warning',
-            'completed': 'success',
-            'closed': 'secondary',
-            'postponed': 'danger'
-        }
-        return status_colors.get(self.status, 'secondary')
+        return MESSAGE_STATUS_COLORS.get(self.status, 'secondary')
+
+# نموذج قائمة الإرسال المجدول (صف لكل رسالة لم يحن موعد إرسالها، يحذف عند الإرسال)
+# delivery: مواصفات المستلمين بصيغة JSON، يتم حلها إلى مستلمين عند الإرسال
+class ScheduledSend(db.Model):
+    __tablename__ = 'scheduled_send'
+
+    message_id = db.Column(db.Integer, db.ForeignKey('message.id'), primary_key=True)
+    send_at = db.Column(db.DateTime, nullable=False, index=True)  # موعد الإرسال (أو انتهاء حجز المحاولة الجارية)
+    delivery = db.Column(db.Text, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)  # عدد محاولات الإرسال
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+# نموذج عداد أرقام القيد (صف لكل قسم وسنة؛ next_value أول رقم لم يحجز بعد)
+class RegistrySequence(db.Model):
+    __tablename__ = 'registry_sequence'
+
+    department_id = db.Column(db.Integer, primary_key=True)  # 0 للمرسلين بلا قسم
+    year = db.Column(db.SmallInteger, primary_key=True)
+    next_value = db.Column(db.Integer, nullable=False, default=1)
+
+# نموذج كتل أرقام القيد المحجوزة لكل عملية (لحساب الفجوات)
+class RegistryBlock(db.Model):
+    __tablename__ = 'registry_block'
+
+    id = db.Column(db.Integer, primary_key=True)
+    department_id = db.Column(db.Integer, nullable=False)
+    year = db.Column(db.SmallInteger, nullable=False)
+    start = db.Column(db.Integer, nullable=False)  # أول رقم في الكتلة
+    end = db.Column(db.Integer, nullable=False)  # آخر رقم في الكتلة
+    reserved_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    released_at = db.Column(db.DateTime)  # وقت إعادة الكتلة عند إيقاف العملية
+    last_used = db.Column(db.Integer)  # آخر رقم وزع من الكتلة قبل إعادتها (ما بعده فجوة)
+
+    __table_args__ = (
+        db.Index('ix_registry_block_sequence', 'department_id', 'year', 'start'),
+    )
+
+# نموذج جمهور التعميم (تعريف المستلمين بدل صف لكل مستلم)
+class MessageAudience(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    message_id = db.Column(db.Integer, db.ForeignKey('message.id'), nullable=False, index=True)
+    audience_type = db.Column(db.String(20), nullable=False)  # department, all
+    target_id = db.Column(db.Integer)  # معرف القسم (فارغ عند الإرسال لجميع المستخدمين)
+
+    # فهرس للبحث عن التعاميم الموجهة لقسم المستخدم
+    __table_args__ = (
+        db.Index('ix_message_audience_target', 'audience_type', 'target_id', 'message_id'),
+    )
+
+# نموذج أحداث القراءة (صف صغير لكل رسالة ومستخدم بدل سجل تغيير حالة كامل)
+class MessageReadEvent(db.Model):
+    __tablename__ = 'message_read_event'
+
+    message_id = db.Column(db.Integer, db.ForeignKey('message.id'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    read_at = db.Column(db.DateTime, nullable=False)
 
 # نموذج الإشعارات
 class Notification(db.Model):
@@ -817,17 +1485,60 @@ class Notification(db.Model):
     # العلاقة مع المستخدم
     user = db.relationship('User', backref='notifications')
 
+# نموذج سجل التصعيد حسب تاريخ الاستحقاق (صف واحد لكل عنصر ومستوى، فلا يتكرر التصعيد)
+ESCALATION_ITEM_NAMES = ('message', 'personal_mail')
+ESCALATION_LEVEL_NAMES = ('due_soon', 'overdue', 'manager')
+
+class DueDateEscalation(db.Model):
+    __tablename__ = 'due_date_escalation'
+
+    id = db.Column(db.Integer, primary_key=True)
+    item_type = db.Column(CodedEnum(ESCALATION_ITEM_NAMES), nullable=False)  # نوع العنصر (رسالة أو بريد شخصي)
+    item_id = db.Column(db.Integer, nullable=False)  # معرف الرسالة أو البريد الشخصي
+    level = db.Column(CodedEnum(ESCALATION_LEVEL_NAMES), nullable=False)  # مستوى التصعيد
+    due_date = db.Column(db.Date)  # تاريخ الاستحقاق وقت التصعيد
+    escalated_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    notified = db.Column(db.Integer, nullable=False, default=0)  # عدد الإشعارات المرسلة
+
+    __table_args__ = (
+        db.UniqueConstraint('item_type', 'item_id', 'level', name='uq_due_date_escalation_item_level'),
+    )
+
+# نموذج عدادات صناديق البريد (غير المقروء لكل مجلد ولكل مستخدم)
+class MailboxCounter(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)  # المستخدم صاحب العداد
+    folder = db.Column(db.String(30), primary_key=True)  # اسم المجلد (inbox_unread, archive_unread, personal_pending ...)
+    count = db.Column(db.Integer, nullable=False, default=0)  # قيمة العداد
+
+# نموذج إصدار البيانات المرجعية (الأقسام والأدوار والصلاحيات ومجموعاتها)
+# يتم زيادة الإصدار عند كل تعديل على هذه الجداول لتعيد العمليات تحميل اللقطة المخزنة في الذاكرة
+class ReferenceDataVersion(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=1)  # رقم الإصدار الحالي
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)  # تاريخ آخر تعديل
+
 # Attachment model
 class Attachment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(255), nullable=False)
     original_filename = db.Column(db.String(255), nullable=False)
-    file_path = db.Column(db.String(500), nullable=False)
+    file_path = db.Column(db.String(500), nullable=False, index=True)  # قد يشترك فيه أكثر من مرفق (التحويل والرد مع المرفقات)
     file_size = db.Column(db.Integer)  # حجم الملف بالبايت
     file_type = db.Column(db.String(100))  # نوع الملف (MIME type)
     upload_date = db.Column(db.DateTime, default=datetime.utcnow)
     message_id = db.Column(db.Integer, db.ForeignKey('message.id'), nullable=False)
 
+    def link_copy(self):
+        """مرفق جديد يشير إلى نفس الملف على القرص دون نسخ محتواه"""
+        return Attachment(
+            filename=self.filename,
+            original_filename=self.original_filename,
+            file_path=self.file_path,
+            file_size=self.file_size,
+            file_type=self.file_type,
+            upload_date=self.upload_date
+        )
+
     def get_file_icon(self):
         """تحديد أيقونة الملف بناءً على نوعه"""
         if self.file_type:
@@ -871,6 +1582,2778 @@ class Attachment(db.Model):
         ]
         return self.file_type in viewable_types
 
+# حذف ملفات المرفقات مع مراعاة المشاركة
+# الملف على القرص قد يشترك فيه أكثر من مرفق؛ يحذف فقط بعد تأكيد المعاملة
+# وعندما لا يبقى أي مرفق يشير إليه
+@event.listens_for(db.session, 'after_flush')
+def collect_orphaned_attachment_files(session, flush_context):
+    pending = session.info.setdefault('orphaned_attachment_files', set())
+    for obj in session.deleted:
+        if isinstance(obj, Attachment) and obj.file_path:
+            pending.add(obj.file_path)
+    for obj in session.new:
+        if isinstance(obj, Attachment):
+            pending.discard(obj.file_path)
+    if pending:
+        # استبعاد الملفات التي ما زالت مرفقات أخرى تشير إليها
+        still_referenced = session.execute(
+            select(Attachment.__table__.c.file_path).where(Attachment.__table__.c.file_path.in_(pending))
+        ).scalars().all()
+        pending.difference_update(still_referenced)
+
+@event.listens_for(db.session, 'after_commit')
+def remove_orphaned_attachment_files(session):
+    for file_path in session.info.pop('orphaned_attachment_files', ()):
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_orphaned_attachment_files(session):
+    session.info.pop('orphaned_attachment_files', None)
+
+# عدادات صناديق البريد
+# يتم تحديث العدادات بشكل تزايدي عند كل تغيير في حالة الرسائل، ويعاد بناؤها
+# بالكامل فقط عند أول قراءة للمستخدم (أو من خلال سكربت التحديث)
+PERSONAL_MAIL_STATUSES = ('pending', 'in_progress', 'completed', 'cancelled')
+MAILBOX_COUNTER_FOLDERS = ('inbox_unread', 'archive_unread') + tuple(f'personal_{s}' for s in PERSONAL_MAIL_STATUSES)
+
+# الحالات التي لا تعتبر فيها الرسالة متأخرة حتى لو تجاوزت تاريخ الاستحقاق
+MESSAGE_DONE_STATUSES = ('completed', 'closed')
+PERSONAL_MAIL_DONE_STATUSES = ('completed', 'cancelled')
+
+def _attribute_value(obj, attr, previous=False):
+    """الحصول على القيمة الحالية أو السابقة (قبل التعديل) لحقل في كائن"""
+    if previous:
+        history = sa_inspect(obj).attrs[attr].history
+        if history.has_changes():
+            # لا توجد قيمة محذوفة إذا كانت القيمة السابقة فارغة
+            return history.deleted[0] if history.deleted else None
+    return getattr(obj, attr)
+
+def _mailbox_counter_key(session, obj, previous=False, cache=None):
+    """تحديد العداد (المستخدم، المجلد) الذي يساهم فيه الكائن، أو None"""
+    value = lambda attr: _attribute_value(obj, attr, previous)
+
+    if isinstance(obj, Message):
+        # الرسائل بمستلم واحد (الإصدار القديم) تحسب من جدول الرسائل مباشرة
+        if not value('recipient_id') or value('is_multi_recipient') or value('status') != 'new':
+            return None
+        return (value('recipient_id'), 'archive_unread' if value('is_archived') else 'inbox_unread')
+
+    if isinstance(obj, MessageRecipient):
+        if value('status') != 'new':
+            return None
+        # حالة المستلم تؤخذ في الاعتبار فقط للرسائل متعددة المستلمين
+        # (التعاميم لا تخزن في العدادات؛ تحسب من تعريف الجمهور عند القراءة)
+        message_id = value('message_id')
+        if cache is not None and message_id in cache:
+            is_counted = cache[message_id]
+        else:
+            message = session.get(Message, message_id)
+            is_counted = bool(message and message.is_multi_recipient and not message.is_broadcast)
+            if cache is not None:
+                cache[message_id] = is_counted
+        if not is_counted:
+            return None
+        return (value('recipient_id'), 'archive_unread' if value('is_archived') else 'inbox_unread')
+
+    if isinstance(obj, PersonalMail):
+        if value('is_archived'):
+            return None
+        return (value('user_id'), f"personal_{value('status')}")
+
+    return None
+
+@event.listens_for(db.session, 'after_flush')
+def update_mailbox_counters(session, flush_context):
+    """تحديث عدادات صناديق البريد بناءً على التغييرات التي تمت في عملية الحفظ"""
+    deltas = {}
+    # الرسائل الجديدة في نفس عملية الحفظ لا تكون في خريطة الهوية بعد، فتسجل مسبقًا
+    # لتجنب استعلام لكل صف مستلم (الاستيراد الجماعي والإرسال لمستلمين متعددين)
+    cache = {
+        obj.id: bool(obj.is_multi_recipient and not obj.is_broadcast)
+        for obj in session.new if isinstance(obj, Message)
+    }
+
+    def add(key, delta):
+        if key and key[0]:
+            deltas[key] = deltas.get(key, 0) + delta
+
+    for obj in session.new:
+        add(_mailbox_counter_key(session, obj, cache=cache), 1)
+
+    for obj in session.dirty:
+        if not isinstance(obj, (Message, MessageRecipient, PersonalMail)) or not session.is_modified(obj):
+            continue
+        old_key = _mailbox_counter_key(session, obj, previous=True, cache=cache)
+        new_key = _mailbox_counter_key(session, obj, cache=cache)
+        if old_key != new_key:
+            add(old_key, -1)
+            add(new_key, 1)
+
+    for obj in session.deleted:
+        add(_mailbox_counter_key(session, obj, previous=True, cache=cache), -1)
+
+    apply_mailbox_counter_deltas(session.connection(), deltas)
+
+def apply_mailbox_counter_deltas(connection, deltas):
+    """تطبيق الفروقات على العدادات المخزنة
+
+    يتم تحديث الصفوف الموجودة فقط؛ المستخدم الذي لم تُبنَ عداداته بعد
+    سيحصل على قيم صحيحة عند إعادة البناء في أول قراءة.
+    """
+    params = [
+        {'u': user_id, 'f': folder, 'd': delta}
+        for (user_id, folder), delta in deltas.items() if delta
+    ]
+    if not params:
+        return
+
+    table = MailboxCounter.__table__
+    connection.execute(
+        table.update()
+        .where(table.c.user_id == db.bindparam('u'), table.c.folder == db.bindparam('f'))
+        .values(count=table.c.count + db.bindparam('d')),
+        params
+    )
+
+def rebuild_mailbox_counters(user_id):
+    """إعادة حساب جميع عدادات المستخدم من البيانات الفعلية
+
+    تتم إعادة البناء في معاملة قصيرة على اتصال مستقل، فلا تؤكد ولا تلغي ما في جلسة
+    الطلب. إذا تعذر الحفظ (إعادة بناء متزامنة أو قاعدة بيانات مقفلة) تعاد القيم
+    المحسوبة دون تخزين، ويعاد البناء في القراءة التالية.
+    """
+    counts = dict.fromkeys(MAILBOX_COUNTER_FOLDERS, 0)
+
+    try:
+        with db.engine.begin() as connection:
+            # الرسائل بمستلم واحد (الإصدار القديم)
+            legacy_rows = connection.execute(
+                select(Message.is_archived, func.count(Message.id))
+                .where(Message.recipient_id == user_id,
+                       Message.is_multi_recipient.isnot(True),
+                       Message.status == 'new')
+                .group_by(Message.is_archived)
+            ).all()
+
+            # الرسائل متعددة المستلمين
+            multi_rows = connection.execute(
+                select(MessageRecipient.is_archived, func.count(MessageRecipient.id))
+                .join(Message, Message.id == MessageRecipient.message_id)
+                .where(MessageRecipient.recipient_id == user_id,
+                       MessageRecipient.status == 'new',
+                       Message.is_multi_recipient == True,
+                       func.coalesce(Message.delivery_mode, 'direct') != 'broadcast')
+                .group_by(MessageRecipient.is_archived)
+            ).all()
+
+            for is_archived, count in legacy_rows + multi_rows:
+                counts['archive_unread' if is_archived else 'inbox_unread'] += count
+
+            # البريد الشخصي حسب الحالة
+            personal_rows = connection.execute(
+                select(PersonalMail.status, func.count(PersonalMail.id))
+                .where(PersonalMail.user_id == user_id, PersonalMail.is_archived.isnot(True))
+                .group_by(PersonalMail.status)
+            ).all()
+
+            for status, count in personal_rows:
+                folder = f'personal_{status}'
+                if folder in counts:
+                    counts[folder] = count
+
+            table = MailboxCounter.__table__
+            connection.execute(table.delete().where(table.c.user_id == user_id))
+            connection.execute(table.insert(), [
+                {'user_id': user_id, 'folder': folder, 'count': count}
+                for folder, count in counts.items()
+            ])
+    except Exception as e:
+        # قد يقوم طلب آخر بإعادة البناء في نفس الوقت
+        app.logger.warning(f'تعذر حفظ عدادات المستخدم {user_id}: {str(e)}')
+
+    return counts
+
+def get_mailbox_counters(user_id):
+    """الحصول على عدادات المستخدم المخزنة (مع إعادة البناء عند الحاجة)"""
+    read_receipts.flush_for(user_id)
+    rows = db.session.query(MailboxCounter.folder, MailboxCounter.count)\
+        .filter(MailboxCounter.user_id == user_id)\
+        .all()
+
+    if len(rows) < len(MAILBOX_COUNTER_FOLDERS):
+        counts = dict(rebuild_mailbox_counters(user_id))
+    else:
+        counts = dict(rows)
+
+    for folder, count in get_broadcast_counters(user_id).items():
+        counts[folder] = counts.get(folder, 0) + count
+
+    return counts
+
+# إيصالات القراءة المجمعة
+# فتح رسالة جديدة لا يكتب في قاعدة البيانات الرئيسية مباشرة؛ تسجل القراءة في سجل SQLite
+# مشترك بين العمليات ثم تحفظ القراءات المتراكمة في معاملة واحدة بعد لحظات (أو فورًا عند
+# امتلاء الدفعة أو عند قراءة المستخدم نفسه لصناديقه أو عداداته من أي عملية)
+class SqliteReadReceiptJournal:
+    """سجل مشترك على القرص للقراءات المعلقة؛ يبقى بعد توقف العملية المفاجئ
+
+    يتم حجز القراءات قبل حفظها ولا تحذف من السجل إلا بعد تأكيد حفظها، والحجز الذي
+    تجاوز claim_timeout (عملية توقفت أثناء الحفظ) يعاد حجزه. إعادة الحفظ لا تكرر الأثر
+    لأن القراءات المحفوظة لم تعد في حالة "جديد".
+    """
+
+    def __init__(self, path, claim_timeout=60):
+        self.path = path
+        self.claim_timeout = claim_timeout
+        self._local = threading.local()
+
+        connection = self._connection()
+        connection.execute('CREATE TABLE IF NOT EXISTS pending_read (message_id INTEGER NOT NULL, user_id INTEGER NOT NULL, '
+                           'read_at TEXT NOT NULL, claim TEXT, claimed_at REAL, PRIMARY KEY (message_id, user_id))')
+        connection.execute('CREATE INDEX IF NOT EXISTS ix_pending_read_user_id ON pending_read (user_id)')
+        connection.execute('CREATE INDEX IF NOT EXISTS ix_pending_read_claim ON pending_read (claim)')
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def add(self, message_id, user_id, read_at):
+        self._connection().execute(
+            'INSERT OR IGNORE INTO pending_read (message_id, user_id, read_at) VALUES (?, ?, ?)',
+            (message_id, user_id, read_at.isoformat())
+        )
+
+    def has_user(self, user_id):
+        return self._connection().execute(
+            'SELECT 1 FROM pending_read WHERE user_id = ? LIMIT 1', (user_id,)
+        ).fetchone() is not None
+
+    def claim(self):
+        """حجز القراءات غير المحجوزة؛ يعاد رمز الحجز والقراءات"""
+        token = uuid.uuid4().hex
+        now = time.time()
+        rows = self._connection().execute(
+            'UPDATE pending_read SET claim = ?, claimed_at = ? WHERE claim IS NULL OR claimed_at < ? '
+            'RETURNING message_id, user_id, read_at',
+            (token, now, now - self.claim_timeout)
+        ).fetchall()
+        return token, {(message_id, user_id): datetime.fromisoformat(read_at) for message_id, user_id, read_at in rows}
+
+    def release(self, token):
+        self._connection().execute('UPDATE pending_read SET claim = NULL, claimed_at = NULL WHERE claim = ?', (token,))
+
+    def remove(self, token):
+        self._connection().execute('DELETE FROM pending_read WHERE claim = ?', (token,))
+
+
+class ReadReceiptBuffer:
+    """مخزن مؤقت لإيصالات القراءة يحفظ على دفعات
+
+    بدون سجل مشترك تبقى القراءات في ذاكرة العملية: لا تراها العمليات الأخرى حتى تحفظ،
+    وتفقد عند إيقاف العملية بالقوة (بحد أقصى max_pending قراءة أو ما يسجل خلال flush_interval).
+    """
+
+    def __init__(self, flush_interval, max_pending, journal=None):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.journal = journal
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}  # (message_id, user_id) -> read_at
+        self._recorded = 0
+        self._timer = None
+
+    def record(self, message_id, user_id, read_at=None):
+        """تسجيل قراءة (يتم تجاهل تكرار نفس القراءة قبل الحفظ)"""
+        read_at = read_at or datetime.now()
+        if self.journal is not None:
+            self.journal.add(message_id, user_id, read_at)
+        with self._lock:
+            if self.journal is None:
+                self._pending.setdefault((message_id, user_id), read_at)
+                full = len(self._pending) >= self.max_pending
+            else:
+                self._recorded += 1
+                full = self._recorded >= self.max_pending
+            if not full and self._timer is None:
+                self._timer = threading.Timer(self.flush_interval, self._flush_in_background)
+                self._timer.daemon = True
+                self._timer.start()
+        if full:
+            self.flush()
+
+    def flush_for(self, user_id):
+        """حفظ الإيصالات المعلقة إذا كان بينها إيصال للمستخدم (قبل قراءة صناديقه)"""
+        if self.journal is not None:
+            pending = self.journal.has_user(user_id)
+        else:
+            pending = any(pending_user == user_id for _, pending_user in list(self._pending))
+        if pending:
+            self.flush()
+
+    def flush(self):
+        """حفظ جميع الإيصالات المعلقة في معاملة واحدة، ويعاد عددها"""
+        with self._flush_lock:
+            with self._lock:
+                if self.journal is None:
+                    entries, self._pending = self._pending, {}
+                self._recorded = 0
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            if self.journal is not None:
+                token, entries = self.journal.claim()
+            if not entries:
+                return 0
+            try:
+                apply_read_receipts(entries)
+            except Exception:
+                # إعادة الإيصالات إلى المخزن لمحاولة الحفظ لاحقًا
+                if self.journal is not None:
+                    self.journal.release(token)
+                else:
+                    with self._lock:
+                        for key, read_at in entries.items():
+                            self._pending.setdefault(key, read_at)
+                raise
+            if self.journal is not None:
+                self.journal.remove(token)
+            return len(entries)
+
+    def _flush_in_background(self):
+        with app.app_context():
+            try:
+                self.flush()
+            except Exception as e:
+                app.logger.error(f'تعذر حفظ إيصالات القراءة: {str(e)}')
+
+def apply_read_receipts(entries):
+    """حفظ القراءات: تحديث الحالات الجديدة إلى مقروءة، إنشاء صفوف حالة التعاميم،
+    تسجيل أحداث القراءة وتعديل العدادات، في معاملة واحدة عبر اتصال مستقل عن جلسة الطلب"""
+    messages = Message.__table__
+    recipients = MessageRecipient.__table__
+    read_events = MessageReadEvent.__table__
+    message_ids = {message_id for message_id, _ in entries}
+    user_ids = {user_id for _, user_id in entries}
+
+    with db.engine.begin() as connection:
+        # الرسائل بمستلم واحد التي ما زالت جديدة
+        legacy = connection.execute(
+            select(messages.c.id, messages.c.recipient_id, messages.c.is_archived, messages.c.date)
+            .where(messages.c.id.in_(message_ids), messages.c.recipient_id.in_(user_ids),
+                   messages.c.status == 'new', messages.c.is_multi_recipient.isnot(True))
+        ).all()
+        legacy = [row for row in legacy if (row.id, row.recipient_id) in entries]
+
+        # صفوف المستلمين الموجودة
+        states = connection.execute(
+            select(recipients.c.message_id, recipients.c.recipient_id, recipients.c.status,
+                   recipients.c.is_archived, messages.c.delivery_mode, messages.c.is_multi_recipient,
+                   messages.c.date)
+            .join(messages, messages.c.id == recipients.c.message_id)
+            .where(recipients.c.message_id.in_(message_ids), recipients.c.recipient_id.in_(user_ids))
+        ).all()
+        existing_states = {(row.message_id, row.recipient_id) for row in states}
+        unread_states = [row for row in states
+                         if row.status == 'new' and (row.message_id, row.recipient_id) in entries]
+
+        # التعاميم التي لم يتفاعل معها المستخدم بعد (تنشأ لها صفوف حالة مقروءة)
+        broadcasts = {row.id: row for row in connection.execute(
+            select(messages.c.id, messages.c.recipient_type, messages.c.date)
+            .where(messages.c.id.in_(message_ids), messages.c.delivery_mode == 'broadcast')
+        )}
+        new_states = [
+            {'message_id': message_id, 'recipient_id': user_id, 'recipient_type': broadcasts[message_id].recipient_type,
+             'status': 'read', 'is_archived': False, 'read_at': read_at}
+            for (message_id, user_id), read_at in entries.items()
+            if message_id in broadcasts and (message_id, user_id) not in existing_states
+        ]
+
+        if legacy:
+            connection.execute(
+                messages.update()
+                .where(messages.c.id == db.bindparam('m'), messages.c.status == 'new')
+                .values(status='read'),
+                [{'m': row.id} for row in legacy]
+            )
+        if unread_states:
+            connection.execute(
+                recipients.update()
+                .where(recipients.c.message_id == db.bindparam('m'), recipients.c.recipient_id == db.bindparam('u'),
+                       recipients.c.status == 'new')
+                .values(status='read', read_at=db.bindparam('t')),
+                [{'m': row.message_id, 'u': row.recipient_id, 't': entries[(row.message_id, row.recipient_id)]}
+                 for row in unread_states]
+            )
+        if new_states:
+            connection.execute(recipients.insert(), new_states)
+
+        # أحداث القراءة (القراءة الأولى فقط لكل رسالة ومستخدم)
+        connection.execute(
+            read_events.insert().prefix_with('OR IGNORE'),
+            [{'message_id': message_id, 'user_id': user_id, 'read_at': read_at}
+             for (message_id, user_id), read_at in entries.items()]
+        )
+
+        # ملخص زمن البقاء في حالة "جديد" لكل قراءة فعلية
+        # (الرسالة بمستلم واحد قد يكون لها صف مستلم أيضًا، فتحسب مرة واحدة)
+        transitions = {(row.id, row.recipient_id): row.date for row in legacy}
+        transitions.update(((row.message_id, row.recipient_id), row.date) for row in unread_states)
+        transitions.update(((state['message_id'], state['recipient_id']), broadcasts[state['message_id']].date)
+                           for state in new_states)
+        for (message_id, user_id), date in transitions.items():
+            record_status_transition(connection, message_id, user_id, 'new', 'read',
+                                     entries[(message_id, user_id)], utc_to_local(date))
+
+        # العدادات المخزنة (التعاميم لا تخزن في العدادات)
+        deltas = {}
+        for row in legacy:
+            key = (row.recipient_id, 'archive_unread' if row.is_archived else 'inbox_unread')
+            deltas[key] = deltas.get(key, 0) - 1
+        for row in unread_states:
+            if row.is_multi_recipient and row.delivery_mode != 'broadcast':
+                key = (row.recipient_id, 'archive_unread' if row.is_archived else 'inbox_unread')
+                deltas[key] = deltas.get(key, 0) - 1
+        apply_mailbox_counter_deltas(connection, deltas)
+
+    # إبطال أجزاء HTML للرسائل التي تغيرت حالتها
+    for message_id in message_ids:
+        fragment_cache.invalidate('message_row', message_id)
+
+def read_receipt_journal():
+    """سجل القراءات المعلقة: افتراضيًا ملف SQLite في مجلد instance مشترك بين العمليات.
+    القيمة memory تبقي القراءات في ذاكرة العملية (لعملية واحدة فقط)"""
+    path = app.config.get('READ_RECEIPT_JOURNAL_PATH') or os.path.join(app.instance_path, 'read_receipts.db')
+    if path == 'memory':
+        return None
+    return SqliteReadReceiptJournal(path)
+
+read_receipts = ReadReceiptBuffer(
+    flush_interval=app.config['READ_RECEIPT_FLUSH_INTERVAL'],
+    max_pending=app.config['READ_RECEIPT_MAX_PENDING'],
+    journal=read_receipt_journal()
+)
+
+@atexit.register
+def flush_read_receipts_on_exit():
+    with app.app_context():
+        try:
+            read_receipts.flush()
+        except Exception:
+            pass
+
+def broadcast_audience_condition(user_id):
+    """شرط انتماء المستخدم لجمهور التعميم (جميع المستخدمين أو قسم المستخدم أو أحد الأقسام الأعلى منه)"""
+    department_id = db.session.query(User.department_id).filter(User.id == user_id).scalar()
+    ancestor_ids = get_reference_data().get_department_ancestor_ids(department_id)
+    return or_(
+        MessageAudience.audience_type == 'all',
+        (MessageAudience.audience_type == 'department') & MessageAudience.target_id.in_(ancestor_ids)
+    )
+
+def pending_broadcasts_query(user_id):
+    """التعاميم الموجهة للمستخدم التي لم يتفاعل معها بعد (لا يوجد لها صف حالة)"""
+    has_state = db.session.query(MessageRecipient.id)\
+        .filter(MessageRecipient.message_id == Message.id, MessageRecipient.recipient_id == user_id)\
+        .exists()
+    return Message.query\
+        .join(MessageAudience, MessageAudience.message_id == Message.id)\
+        .filter(Message.delivery_mode == 'broadcast',
+                Message.sender_id != user_id,
+                broadcast_audience_condition(user_id),
+                ~has_state)\
+        .distinct()
+
+# صفوف قوائم الرسائل
+# صفحات القوائم تحتاج أعمدة العرض فقط؛ يتم جلبها بإسقاط (projection) إلى صفوف ثابتة
+# خفيفة بدل كائنات Message الكاملة (دون المحتوى ودون خريطة الهوية في الجلسة)
+SenderRecord = namedtuple('SenderRecord', 'id username full_name')
+
+class MessageListRow(namedtuple('MessageListRow', 'id subject date sender_id sender_username sender_full_name '
+                                'priority message_type confidentiality reference_number due_date has_attachments '
+                                'is_multi_recipient delivery_mode thread_id status status_text status_color '
+                                'priority_text priority_color thread_count')):
+    __slots__ = ()
+
+    @classmethod
+    def from_row(cls, row):
+        status = row.status or 'new'
+        return cls(
+            row.id, row.subject, row.date, row.sender_id, row.sender_username, row.sender_full_name,
+            row.priority, row.message_type, row.confidentiality, row.reference_number, row.due_date,
+            bool(row.has_attachments), bool(row.is_multi_recipient), row.delivery_mode, row.thread_id,
+            status, MESSAGE_STATUS_DISPLAY.get(status, status), MESSAGE_STATUS_COLORS.get(status, 'secondary'),
+            MESSAGE_PRIORITY_DISPLAY.get(row.priority, row.priority), MESSAGE_PRIORITY_COLORS.get(row.priority, 'secondary'),
+            1
+        )
+
+    # واجهة متوافقة مع كائن Message في القوالب
+    @property
+    def recipient_status(self):
+        return self.status
+
+    @property
+    def is_broadcast(self):
+        return self.delivery_mode == 'broadcast'
+
+    @property
+    def sender(self):
+        return SenderRecord(self.sender_id, self.sender_username, self.sender_full_name) if self.sender_id else None
+
+    def get_status_display(self):
+        return self.status_text
+
+    def get_status_color(self):
+        return self.status_color
+
+    def get_priority_display(self):
+        return self.priority_text
+
+    def get_priority_color(self):
+        return self.priority_color
+
+    def get_message_type_display(self):
+        return MESSAGE_TYPE_DISPLAY.get(self.message_type, self.message_type)
+
+    def get_confidentiality_display(self):
+        return MESSAGE_CONFIDENTIALITY_DISPLAY.get(self.confidentiality, self.confidentiality)
+
+    def get_confidentiality_color(self):
+        return MESSAGE_CONFIDENTIALITY_COLORS.get(self.confidentiality, 'secondary')
+
+def _message_list_columns(status_column):
+    """أعمدة الإسقاط المشتركة لقوائم الرسائل"""
+    return (
+        Message.id, Message.subject, Message.date, Message.sender_id,
+        User.username.label('sender_username'), User.full_name.label('sender_full_name'),
+        Message.priority, Message.message_type, Message.confidentiality, Message.reference_number,
+        Message.due_date, Message.has_attachments, Message.is_multi_recipient, Message.delivery_mode,
+        Message.thread_id, status_column.label('status')
+    )
+
+def mailbox_rows(user_id, archived=False, limit=None):
+    """رسائل الوارد أو الأرشيف للمستخدم كصفوف MessageListRow مرتبة تنازليًا حسب التاريخ
+
+    تجمع الرسائل القديمة (مستلم واحد) وصفوف المستلمين والتعاميم المعلقة في استعلام UNION ALL واحد.
+    """
+    read_receipts.flush_for(user_id)
+    legacy = select(*_message_list_columns(Message.status))\
+        .outerjoin(User, User.id == Message.sender_id)\
+        .where(Message.recipient_id == user_id, Message.is_archived == archived)
+
+    multi = select(*_message_list_columns(MessageRecipient.status))\
+        .join(MessageRecipient, MessageRecipient.message_id == Message.id)\
+        .outerjoin(User, User.id == Message.sender_id)\
+        .where(MessageRecipient.recipient_id == user_id, MessageRecipient.is_archived == archived,
+               Message.is_multi_recipient == True)
+
+    parts = [legacy, multi]
+
+    if not archived:
+        # التعاميم التي لم يتفاعل معها المستخدم بعد (حالتها جديد)
+        in_audience = select(MessageAudience.id)\
+            .where(MessageAudience.message_id == Message.id, broadcast_audience_condition(user_id))\
+            .exists()
+        has_state = select(MessageRecipient.id)\
+            .where(MessageRecipient.message_id == Message.id, MessageRecipient.recipient_id == user_id)\
+            .exists()
+        parts.append(
+            select(*_message_list_columns(literal('new', MessageStatus)))
+            .outerjoin(User, User.id == Message.sender_id)
+            .where(Message.delivery_mode == 'broadcast', Message.sender_id != user_id, in_audience, ~has_state)
+        )
+
+    rows = union_all(*parts).subquery()
+    query = select(rows).order_by(rows.c.date.desc(), rows.c.id.desc())
+    if limit:
+        query = query.limit(limit)
+    return [MessageListRow.from_row(row) for row in db.session.execute(query)]
+
+def get_broadcast_counters(user_id):
+    """عدادات غير المقروء للتعاميم (التعاميم المعلقة + صفوف الحالة التي ما زالت جديدة)"""
+    counts = {'inbox_unread': pending_broadcasts_query(user_id).count(), 'archive_unread': 0}
+
+    state_rows = db.session.query(MessageRecipient.is_archived, func.count(MessageRecipient.id))\
+        .join(Message, Message.id == MessageRecipient.message_id)\
+        .filter(MessageRecipient.recipient_id == user_id,
+                MessageRecipient.status == 'new',
+                Message.delivery_mode == 'broadcast')\
+        .group_by(MessageRecipient.is_archived)\
+        .all()
+
+    for is_archived, count in state_rows:
+        counts['archive_unread' if is_archived else 'inbox_unread'] += count
+
+    return counts
+
+def get_due_counters(user_id, today=None):
+    """عدد الرسائل والبريد الشخصي المستحقة اليوم والمتأخرة (باستخدام فهرس تاريخ الاستحقاق)"""
+    today = today or datetime.now().date()
+
+    def due_bucket(column):
+        return db.case((column == today, 'due_today'), else_='overdue')
+
+    result = {
+        'due_today': {'messages': 0, 'personal_mail': 0},
+        'overdue': {'messages': 0, 'personal_mail': 0}
+    }
+
+    legacy_rows = db.session.query(due_bucket(Message.due_date), func.count(Message.id))\
+        .filter(Message.recipient_id == user_id,
+                Message.is_multi_recipient.isnot(True),
+                Message.is_archived.isnot(True),
+                Message.due_date <= today,
+                Message.status.notin_(MESSAGE_DONE_STATUSES))\
+        .group_by(due_bucket(Message.due_date))\
+        .all()
+
+    multi_rows = db.session.query(due_bucket(Message.due_date), func.count(MessageRecipient.id))\
+        .join(Message, Message.id == MessageRecipient.message_id)\
+        .filter(MessageRecipient.recipient_id == user_id,
+                MessageRecipient.is_archived.isnot(True),
+                MessageRecipient.status.notin_(MESSAGE_DONE_STATUSES),
+                Message.is_multi_recipient == True,
+                Message.due_date <= today)\
+        .group_by(due_bucket(Message.due_date))\
+        .all()
+
+    # التعاميم التي لم يتفاعل معها المستخدم (صفوف الحالة محسوبة أعلاه)
+    broadcast_rows = db.session.query(due_bucket(Message.due_date), func.count(Message.id))\
+        .filter(Message.id.in_(pending_broadcasts_query(user_id).with_entities(Message.id)),
+                Message.due_date <= today)\
+        .group_by(due_bucket(Message.due_date))\
+        .all()
+
+    for bucket, count in legacy_rows + multi_rows + broadcast_rows:
+        result[bucket]['messages'] += count
+
+    personal_rows = db.session.query(due_bucket(PersonalMail.due_date), func.count(PersonalMail.id))\
+        .filter(PersonalMail.user_id == user_id,
+                PersonalMail.is_archived.isnot(True),
+                PersonalMail.due_date <= today,
+                PersonalMail.status.notin_(PERSONAL_MAIL_DONE_STATUSES))\
+        .group_by(due_bucket(PersonalMail.due_date))\
+        .all()
+
+    for bucket, count in personal_rows:
+        result[bucket]['personal_mail'] += count
+
+    return result
+
+def get_mailbox_badges(user_id):
+    """تجميع شارات التنقل (غير المقروء والمستحق) في قاموس واحد"""
+    counters = get_mailbox_counters(user_id)
+    badges = {
+        'inbox_unread': counters.get('inbox_unread', 0),
+        'archive_unread': counters.get('archive_unread', 0),
+        'personal_mail': {s: counters.get(f'personal_{s}', 0) for s in PERSONAL_MAIL_STATUSES}
+    }
+    badges.update(get_due_counters(user_id))
+    return badges
+
+# ذاكرة التخزين المؤقت لأجزاء HTML المعروضة
+# المفتاح يتكون من نوع الجزء ومعرف الكيان والإصدار الذي يمرره القالب، بالإضافة إلى
+# رقم جيل يتم زيادته عند حفظ تغييرات على الكيان (بعد تأكيد المعاملة)
+class SqliteFragmentBackend:
+    """تخزين مشترك على القرص لأجزاء HTML بين عدة عمليات (workers)"""
+
+    def __init__(self, path, max_entries=20000):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes = 0
+
+        connection = self._connection()
+        connection.execute('CREATE TABLE IF NOT EXISTS fragment (key TEXT PRIMARY KEY, html TEXT NOT NULL, stored_at REAL NOT NULL)')
+        connection.execute('CREATE INDEX IF NOT EXISTS ix_fragment_stored_at ON fragment (stored_at)')
+
+        # ملف من إصدار سابق بدون عمود التسلسل: تحذف الأجيال والأجزاء المخزنة بمفاتيحها
+        columns = [row[1] for row in connection.execute('PRAGMA table_info(fragment_generation)')]
+        if columns and 'seq' not in columns:
+            connection.execute('DROP TABLE fragment_generation')
+            connection.execute('DELETE FROM fragment')
+
+        # الصف ذو الاسم الفارغ هو العداد العام؛ seq لكل جيل هو قيمة العداد عند آخر زيادة له
+        connection.execute('CREATE TABLE IF NOT EXISTS fragment_generation '
+                           '(name TEXT PRIMARY KEY, value INTEGER NOT NULL, seq INTEGER NOT NULL DEFAULT 0)')
+        connection.execute('CREATE INDEX IF NOT EXISTS ix_fragment_generation_seq ON fragment_generation (seq)')
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def get(self, key):
+        row = self._connection().execute('SELECT html FROM fragment WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, html):
+        connection = self._connection()
+        connection.execute('INSERT OR REPLACE INTO fragment (key, html, stored_at) VALUES (?, ?, ?)', (key, html, time.time()))
+
+        # حذف الأجزاء الأقدم بشكل دوري للحفاظ على الحجم
+        self._writes += 1
+        if self._writes % 500 == 0:
+            connection.execute(
+                'DELETE FROM fragment WHERE key IN (SELECT key FROM fragment ORDER BY stored_at DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,)
+            )
+
+    def generation_changes(self, since):
+        """قيمة العداد العام والأجيال التي تغيرت بعد القيمة since: (العداد، [(الاسم، الجيل)])"""
+        connection = self._connection()
+        row = connection.execute("SELECT value FROM fragment_generation WHERE name = ''").fetchone()
+        current = row[0] if row else 0
+        if current == since:
+            return current, []
+        if current < since:
+            # ملف التخزين أعيد إنشاؤه
+            since = 0
+        return current, connection.execute(
+            "SELECT name, value FROM fragment_generation WHERE seq > ? AND name != ''", (since,)
+        ).fetchall()
+
+    def bump_generation(self, name):
+        """زيادة جيل الاسم والعداد العام في معاملة واحدة، ويعاد الجيل الجديد"""
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            seq = connection.execute(
+                "INSERT INTO fragment_generation (name, value) VALUES ('', 1) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + 1 RETURNING value"
+            ).fetchone()[0]
+            value = connection.execute(
+                'INSERT INTO fragment_generation (name, value, seq) VALUES (?, 1, ?) '
+                'ON CONFLICT(name) DO UPDATE SET value = value + 1, seq = excluded.seq RETURNING value',
+                (name, seq)
+            ).fetchone()[0]
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return value
+
+
+class FragmentCache:
+    """ذاكرة LRU داخل العملية لأجزاء HTML مع تخزين مشترك اختياري"""
+
+    def __init__(self, max_entries=4096, max_bytes=16 * 1024 * 1024, backend=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.backend = backend
+        self._entries = OrderedDict()
+        self._size = 0
+        self._generations = {}
+        self._generations_seq = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _generation_name(kind, entity_id=None):
+        return kind if entity_id is None else f'{kind}:{entity_id}'
+
+    def refresh_generations(self):
+        """جلب الأجيال التي غيرتها العمليات الأخرى من التخزين المشترك (استعلام واحد على العداد
+        العام، ثم قراءة الأجيال المتغيرة فقط إذا تغير)"""
+        if self.backend is None:
+            return
+        seq, changes = self.backend.generation_changes(self._generations_seq)
+        with self._lock:
+            if seq < self._generations_seq:
+                self._generations.clear()
+            self._generations.update(changes)
+            self._generations_seq = seq
+
+    def generation(self, kind, entity_id=None):
+        """رقم الجيل الحالي للنوع أو للكيان (من ذاكرة العملية)"""
+        return self._generations.get(self._generation_name(kind, entity_id), 0)
+
+    def make_key(self, kind, entity_id=None, version=None):
+        return '{}:{}:{}:{}.{}'.format(
+            kind, entity_id, version,
+            self.generation(kind),
+            self.generation(kind, entity_id) if entity_id is not None else 0
+        )
+
+    def get(self, key):
+        with self._lock:
+            html = self._entries.get(key)
+            if html is not None:
+                self._entries.move_to_end(key)
+                return html
+
+        if self.backend is not None:
+            html = self.backend.get(key)
+            if html is not None:
+                self._store_local(key, html)
+            return html
+
+        return None
+
+    def set(self, key, html):
+        self._store_local(key, html)
+        if self.backend is not None:
+            self.backend.set(key, html)
+
+    def _store_local(self, key, html):
+        size = len(html)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._size -= len(previous)
+
+            self._entries[key] = html
+            self._size += size
+
+            # إخراج الأجزاء الأقل استخدامًا عند تجاوز الحدود
+            while self._entries and (len(self._entries) > self.max_entries or self._size > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def get_or_render(self, kind, entity_id, version, render):
+        """إرجاع الجزء المخزن أو عرضه وتخزينه"""
+        key = self.make_key(kind, entity_id, version)
+        html = self.get(key)
+        if html is None:
+            html = str(render())
+            self.set(key, html)
+        return html
+
+    def invalidate(self, kind, entity_id=None):
+        """إبطال جميع أجزاء الكيان (أو جميع أجزاء النوع إذا لم يحدد الكيان)"""
+        name = self._generation_name(kind, entity_id)
+        if self.backend is not None:
+            value = self.backend.bump_generation(name)
+            with self._lock:
+                self._generations[name] = max(self._generations.get(name, 0), value)
+        else:
+            with self._lock:
+                self._generations[name] = self._generations.get(name, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+
+def fragment_cache_backend():
+    """التخزين المشترك للأجزاء: افتراضيًا ملف SQLite في مجلد instance حتى تصل الإبطالات
+    إلى جميع العمليات. القيمة memory تبقي الأجزاء والأجيال في ذاكرة العملية (لعملية واحدة فقط)"""
+    path = app.config.get('FRAGMENT_CACHE_PATH') or os.path.join(app.instance_path, 'fragment_cache.db')
+    if path == 'memory':
+        return None
+    return SqliteFragmentBackend(path)
+
+fragment_cache = FragmentCache(
+    max_entries=app.config['FRAGMENT_CACHE_MAX_ENTRIES'],
+    max_bytes=app.config['FRAGMENT_CACHE_MAX_BYTES'],
+    backend=fragment_cache_backend()
+)
+
+@app.template_global()
+def cached_fragment(kind, entity_id=None, version=None, caller=None):
+    """استخدام الذاكرة المؤقتة من القوالب:
+
+    {% call cached_fragment('message_row', message.id, message.status) %}
+        ...
+    {% endcall %}
+
+    المفتاح لا يتضمن المستخدم الحالي، لذا يستخدم فقط للأجزاء المتطابقة لجميع المستخدمين
+    (ما يختلف حسب المستخدم يوضع خارج الجزء أو يمرر ضمن version). يتم التحقق من الأجيال
+    المشتركة مرة واحدة لكل طلب.
+    """
+    if caller is None:
+        return ''
+    if not g.get('fragment_generations_checked'):
+        fragment_cache.refresh_generations()
+        g.fragment_generations_checked = True
+    return Markup(fragment_cache.get_or_render(kind, entity_id, version, caller))
+
+def _fragment_invalidations(obj):
+    """الأجزاء التي يجب إبطالها عند تغير الكائن"""
+    if isinstance(obj, Message):
+        return [('message_row', obj.id)]
+    if isinstance(obj, MessageRecipient):
+        return [('message_row', obj.message_id)]
+    if isinstance(obj, Department):
+        return [('departments', None)]
+    if isinstance(obj, Role):
+        return [('roles', None)]
+    if isinstance(obj, (Permission, PermissionGroup)):
+        return [('permissions', None), ('roles', None)]
+    return []
+
+@event.listens_for(db.session, 'after_flush')
+def collect_fragment_invalidations(session, flush_context):
+    """جمع الأجزاء المتأثرة بالتغييرات لإبطالها بعد تأكيد المعاملة"""
+    pending = session.info.setdefault('fragment_invalidations', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        pending.update(_fragment_invalidations(obj))
+
+@event.listens_for(db.session, 'after_commit')
+def apply_fragment_invalidations(session):
+    for kind, entity_id in session.info.pop('fragment_invalidations', ()):
+        fragment_cache.invalidate(kind, entity_id)
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_fragment_invalidations(session):
+    session.info.pop('fragment_invalidations', None)
+
+# لقطة البيانات المرجعية في الذاكرة
+# يتم تحميلها مرة واحدة لكل عملية وتحفظ كقواميس ثابتة، ويعاد تحميلها عند تغير الإصدار في قاعدة البيانات
+class RecordList(tuple):
+    """قائمة سجلات ثابتة تدعم أسلوب العلاقات الديناميكية (all/count) المستخدم في القوالب"""
+
+    def all(self):
+        return list(self)
+
+    def count(self, *args):
+        if args:
+            return tuple.count(self, *args)
+        return len(self)
+
+
+class DepartmentRecord(namedtuple('DepartmentRecord', 'id name description created_at is_active parent_id path level')):
+    __slots__ = ()
+
+    @property
+    def users(self):
+        return User.query.filter_by(department_id=self.id)
+
+    def get_users_count(self):
+        """الحصول على عدد المستخدمين في القسم"""
+        return self.users.count()
+
+    @property
+    def ancestor_ids(self):
+        """معرفات الأقسام من الجذر حتى هذا القسم (مستخرجة من المسار دون استعلام)"""
+        return tuple(int(part) for part in (self.path or f'/{self.id}/').strip('/').split('/'))
+
+    def get_subtree_users_count(self):
+        """عدد المستخدمين في القسم وجميع أقسامه الفرعية"""
+        return User.query.filter(User.department_id.in_(subtree_department_ids([self.id]))).count()
+
+
+class PermissionRecord(namedtuple('PermissionRecord', 'id name display_name description group_id is_critical bit')):
+    __slots__ = ()
+
+    def get_display_name(self):
+        """الحصول على اسم العرض بالعربية، أو اسم الصلاحية إذا لم يكن متوفرًا"""
+        return self.display_name or self.name
+
+
+class PermissionGroupRecord(namedtuple('PermissionGroupRecord', 'id name display_name description icon order permissions')):
+    __slots__ = ()
+
+
+class RoleRecord(namedtuple('RoleRecord', 'id name description is_system permissions permission_names permission_bits')):
+    __slots__ = ()
+
+    @property
+    def users(self):
+        return User.query.filter_by(role_id=self.id)
+
+    def has_permission(self, permission_name):
+        """التحقق مما إذا كان الدور يملك صلاحية معينة"""
+        return permission_name in self.permission_names
+
+
+class ReferenceDataSnapshot:
+    """لقطة ثابتة من البيانات المرجعية مفهرسة بالمعرف والاسم"""
+
+    def __init__(self, version, departments, roles, permissions, permission_groups):
+        self.version = version
+        self.departments = RecordList(departments)
+        self.roles = RecordList(roles)
+        self.permissions = RecordList(permissions)
+        self.permission_groups = RecordList(permission_groups)
+
+        self.departments_by_id = MappingProxyType({d.id: d for d in departments})
+        self.departments_by_name = MappingProxyType({d.name: d for d in departments})
+        self.departments_tree = RecordList(sorted(departments, key=lambda d: d.ancestor_ids))
+        self.roles_by_id = MappingProxyType({r.id: r for r in roles})
+        self.roles_by_name = MappingProxyType({r.name: r for r in roles})
+        self.permissions_by_id = MappingProxyType({p.id: p for p in permissions})
+        self.permissions_by_name = MappingProxyType({p.name: p for p in permissions})
+        self.permission_groups_by_id = MappingProxyType({group.id: group for group in permission_groups})
+        self.permission_masks = MappingProxyType({p.name: 1 << p.bit for p in permissions if p.bit is not None})
+
+    @staticmethod
+    def _lookup(mapping, record_id):
+        try:
+            return mapping.get(int(record_id))
+        except (TypeError, ValueError):
+            return None
+
+    def get_department(self, department_id):
+        return self._lookup(self.departments_by_id, department_id)
+
+    def get_role(self, role_id):
+        return self._lookup(self.roles_by_id, role_id)
+
+    def get_department_ancestor_ids(self, department_id):
+        """معرفات القسم وجميع الأقسام الأعلى منه"""
+        department = self.get_department(department_id)
+        return department.ancestor_ids if department else ()
+
+    def get_permission(self, permission_id):
+        return self._lookup(self.permissions_by_id, permission_id)
+
+    def permission_mask(self, permission_name):
+        """الحصول على قناع البت الخاص بصلاحية (0 إذا لم تكن معروفة)"""
+        return self.permission_masks.get(permission_name, 0)
+
+    def role_has_permission(self, role_id, permission_name):
+        """التحقق من صلاحية الدور بعملية AND واحدة على مجموعة البتات"""
+        role = self._lookup(self.roles_by_id, role_id)
+        if role is None:
+            return False
+        mask = self.permission_mask(permission_name)
+        if not mask:
+            # صلاحية لم يعين لها موقع بت بعد (أضيفت خارج sync_permission_bits)
+            return permission_name in role.permission_names
+        return bool(role.permission_bits & mask)
+
+
+_reference_data = None
+_reference_data_lock = threading.Lock()
+
+def _load_reference_data(version):
+    """تحميل جميع الجداول المرجعية من قاعدة البيانات"""
+    departments = [
+        DepartmentRecord(d.id, d.name, d.description, d.created_at, d.is_active, d.parent_id, d.path, d.level or 0)
+        for d in Department.query.order_by(Department.id).all()
+    ]
+
+    permissions = [
+        PermissionRecord(p.id, p.name, p.display_name, p.description, p.group_id, p.is_critical, p.bit)
+        for p in Permission.query.order_by(Permission.id).all()
+    ]
+    permissions_by_id = {p.id: p for p in permissions}
+
+    role_permission_ids = {}
+    for role_id, permission_id in db.session.query(role_permissions.c.role_id, role_permissions.c.permission_id).all():
+        role_permission_ids.setdefault(role_id, []).append(permission_id)
+
+    roles = []
+    for r in Role.query.order_by(Role.id).all():
+        role_perms = [permissions_by_id[pid] for pid in role_permission_ids.get(r.id, []) if pid in permissions_by_id]
+        # حساب البتات من role_permissions مباشرة حتى لا تعتمد اللقطة على القيمة المخزنة
+        bits = 0
+        for p in role_perms:
+            if p.bit is not None:
+                bits |= 1 << p.bit
+        roles.append(RoleRecord(
+            r.id, r.name, r.description, r.is_system,
+            RecordList(role_perms), frozenset(p.name for p in role_perms), bits
+        ))
+
+    permission_groups = [
+        PermissionGroupRecord(
+            group.id, group.name, group.display_name, group.description, group.icon, group.order,
+            RecordList(p for p in permissions if p.group_id == group.id)
+        )
+        for group in PermissionGroup.query.order_by(PermissionGroup.order).all()
+    ]
+
+    return ReferenceDataSnapshot(version, departments, roles, permissions, permission_groups)
+
+def get_reference_data():
+    """الحصول على لقطة البيانات المرجعية (يتم التحقق من الإصدار مرة واحدة لكل طلب)"""
+    global _reference_data
+
+    snapshot = g.get('reference_data')
+    if snapshot is not None:
+        return snapshot
+
+    version = db.session.query(ReferenceDataVersion.version).filter_by(id=1).scalar() or 0
+
+    snapshot = _reference_data
+    if snapshot is None or snapshot.version != version:
+        with _reference_data_lock:
+            snapshot = _reference_data
+            if snapshot is None or snapshot.version != version:
+                snapshot = _reference_data = _load_reference_data(version)
+
+    g.reference_data = snapshot
+    return snapshot
+
+# أقصى عدد من الصلاحيات يمكن تمثيله في عدد صحيح موقّع بطول 64 بت
+MAX_PERMISSION_BITS = 63
+
+def sync_permission_bits():
+    """تعيين مواقع البتات للصلاحيات الجديدة وإعادة اشتقاق permission_bits لجميع الأدوار"""
+    db.session.flush()
+
+    # تعيين أصغر موقع متاح لكل صلاحية بدون موقع
+    used_bits = {bit for (bit,) in db.session.query(Permission.bit).filter(Permission.bit.isnot(None))}
+    free_bits = (bit for bit in range(MAX_PERMISSION_BITS) if bit not in used_bits)
+    for permission in Permission.query.filter(Permission.bit.is_(None)).order_by(Permission.id):
+        permission.bit = next(free_bits, None)
+        if permission.bit is None:
+            raise ValueError(f'تم تجاوز الحد الأقصى لعدد الصلاحيات ({MAX_PERMISSION_BITS})')
+    db.session.flush()
+
+    # إعادة حساب بتات جميع الأدوار باستعلام UPDATE واحد
+    role_bits = select(func.coalesce(func.sum(literal(1).op('<<')(Permission.bit)), 0)) \
+        .select_from(role_permissions.join(Permission, Permission.id == role_permissions.c.permission_id)) \
+        .where(role_permissions.c.role_id == Role.id, Permission.bit.isnot(None)) \
+        .scalar_subquery()
+    db.session.execute(
+        update(Role).values(permission_bits=role_bits).execution_options(synchronize_session=False)
+    )
+
+def users_with_permission(permission_name, active_only=True):
+    """الحصول على معرفات المستخدمين الذين يملكون صلاحية معينة باستعلام واحد"""
+    mask = get_reference_data().permission_mask(permission_name)
+
+    # المشرفون يملكون جميع الصلاحيات (بنفس منطق User.has_permission)
+    conditions = [User.role == 'admin', Role.name == 'admin']
+    if mask:
+        conditions.append(Role.permission_bits.op('&')(mask) != 0)
+    else:
+        # صلاحية بدون موقع بت بعد: الرجوع إلى جدول role_permissions
+        conditions.append(Role.id.in_(
+            select(role_permissions.c.role_id)
+            .join(Permission, Permission.id == role_permissions.c.permission_id)
+            .where(Permission.name == permission_name)
+        ))
+
+    query = db.session.query(User.id).outerjoin(Role, User.role_id == Role.id).filter(or_(*conditions))
+    if active_only:
+        query = query.filter(User.is_active == True)
+
+    return [user_id for (user_id,) in query.order_by(User.id)]
+
+def prefix_upper_bound(prefix):
+    """الحد الأعلى (غير الشامل) لنطاق القيم التي تبدأ بالبادئة، لاستخدام الفهرس بدل LIKE"""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def department_subtree_condition(path):
+    """شرط الأقسام الواقعة تحت المسار (نطاق واحد على فهرس المسار)"""
+    return (Department.path >= path) & (Department.path < prefix_upper_bound(path))
+
+def subtree_department_ids(department_ids):
+    """استعلام معرفات الأقسام المحددة وجميع أقسامها الفرعية"""
+    reference = get_reference_data()
+    conditions = []
+    for department_id in department_ids:
+        department = reference.get_department(department_id)
+        if department and department.path:
+            conditions.append(department_subtree_condition(department.path))
+        else:
+            conditions.append(Department.id == department_id)
+    return select(Department.id).where(or_(*conditions))
+
+def move_department(department, new_parent):
+    """نقل القسم مع شجرته الفرعية تحت قسم أب جديد (تحديث المسارات باستعلام واحد)"""
+    if new_parent and department.is_ancestor_of(new_parent):
+        raise ValueError('لا يمكن نقل القسم إلى داخل نفسه أو أحد أقسامه الفرعية')
+
+    old_path = department.path
+    old_level = department.level or 0
+    department.set_parent(new_parent)
+    db.session.flush()
+
+    Department.query.filter(department_subtree_condition(old_path), Department.id != department.id).update({
+        Department.path: literal(department.path) + func.substr(Department.path, len(old_path) + 1),
+        Department.level: Department.level + (department.level - old_level)
+    }, synchronize_session=False)
+
+def department_subtree_report(department_id, date_from=None, date_to=None):
+    """إحصائيات القسم وأقسامه الفرعية (المستخدمون وحجم الرسائل) باستعلامات مجمعة"""
+    users = department_audience([department_id], active_only=False)
+
+    def in_period(query, column):
+        if date_from:
+            query = query.filter(column >= date_from)
+        if date_to:
+            query = query.filter(column < date_to)
+        return query
+
+    users_count, active_users = db.session.query(
+        func.count(User.id), func.sum(db.case((User.is_active == True, 1), else_=0))
+    ).filter(User.id.in_(users)).one()
+
+    sent = in_period(db.session.query(func.count(Message.id)).filter(Message.sender_id.in_(users)), Message.date).scalar()
+
+    # الرسائل المستلمة: بمستلم واحد (الإصدار القديم) + صفوف المستلمين المتعددين
+    received_legacy = in_period(
+        db.session.query(func.count(Message.id))
+        .filter(Message.recipient_id.in_(users), Message.is_multi_recipient.isnot(True)),
+        Message.date
+    ).scalar()
+    received_multi = in_period(
+        db.session.query(func.count(MessageRecipient.id))
+        .join(Message, Message.id == MessageRecipient.message_id)
+        .filter(MessageRecipient.recipient_id.in_(users)),
+        Message.date
+    ).scalar()
+
+    return {
+        'department_id': department_id,
+        'users': users_count or 0,
+        'active_users': int(active_users or 0),
+        'messages_sent': sent or 0,
+        'messages_received': (received_legacy or 0) + (received_multi or 0)
+    }
+
+# أعمدة الفرز المسموح بها في إدارة المستخدمين
+USER_ADMIN_SORTS = {
+    'username': User.username,
+    'full_name': User.full_name,
+    'created_at': User.created_at,
+    'last_login': User.last_login_at,
+    'department': User.department_id,
+    'role': User.role_id,
+}
+USER_ADMIN_MAX_PER_PAGE = 100
+
+def _parse_date_arg(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d') if value else None
+    except ValueError:
+        return None
+
+def query_admin_users(args):
+    """بناء استعلام قائمة المستخدمين مع التصفية والفرز والتقسيم إلى صفحات من معاملات الطلب"""
+    query = User.query
+
+    # التصفية حسب القسم والدور والحالة
+    department_id = args.get('department_id', type=int)
+    if department_id:
+        # يشمل الأقسام الفرعية افتراضيًا
+        if args.get('include_subdepartments', '1') == '1':
+            query = query.filter(User.department_id.in_(subtree_department_ids([department_id])))
+        else:
+            query = query.filter(User.department_id == department_id)
+
+    role_id = args.get('role_id', type=int)
+    if role_id:
+        query = query.filter(User.role_id == role_id)
+
+    is_active = args.get('is_active')
+    if is_active in ('0', '1'):
+        query = query.filter(User.is_active == (is_active == '1'))
+
+    # التصفية حسب بادئة الاسم (نطاق على الفهرس)
+    prefix = (args.get('q') or '').strip()
+    if prefix:
+        upper = prefix_upper_bound(prefix)
+        query = query.filter(or_(
+            (User.username >= prefix) & (User.username < upper),
+            (User.full_name >= prefix) & (User.full_name < upper)
+        ))
+
+    # التصفية حسب آخر تسجيل دخول
+    if args.get('never_logged_in') == '1':
+        query = query.filter(User.last_login_at.is_(None))
+    last_login_from = _parse_date_arg(args.get('last_login_from'))
+    if last_login_from:
+        query = query.filter(User.last_login_at >= last_login_from)
+    last_login_to = _parse_date_arg(args.get('last_login_to'))
+    if last_login_to:
+        query = query.filter(User.last_login_at < last_login_to + timedelta(days=1))
+
+    # الفرز (البادئة - تعني تنازليًا)
+    sort = args.get('sort') or 'username'
+    descending = sort.startswith('-')
+    column = USER_ADMIN_SORTS.get(sort.lstrip('-'), User.username)
+    query = query.order_by(column.desc() if descending else column.asc(), User.id)
+
+    page = args.get('page', 1, type=int)
+    per_page = min(max(args.get('per_page', 25, type=int), 1), USER_ADMIN_MAX_PER_PAGE)
+    return query.paginate(page=page, per_page=per_page, error_out=False)
+
+def serialize_admin_user(user, reference=None):
+    """تحويل المستخدم إلى قاموس لواجهة إدارة المستخدمين"""
+    reference = reference or get_reference_data()
+    department = reference.get_department(user.department_id)
+    role = reference.get_role(user.role_id)
+    return {
+        'id': user.id,
+        'username': user.username,
+        'full_name': user.full_name or user.username,
+        'email': user.email,
+        'department_id': user.department_id,
+        'department': department.name if department else user.department_name,
+        'role_id': user.role_id,
+        'role': role.name if role else user.role,
+        'is_active': user.is_active,
+        'created_at': user.created_at.isoformat() if user.created_at else None,
+        'last_login_at': user.last_login_at.isoformat() if user.last_login_at else None,
+    }
+
+def bump_reference_data_version():
+    """زيادة إصدار البيانات المرجعية ضمن المعاملة الحالية (يجب استدعاؤها قبل commit)"""
+    # أي تغيير في الأدوار أو الصلاحيات يجب أن ينعكس على مجموعات البتات المخزنة
+    sync_permission_bits()
+
+    updated = ReferenceDataVersion.query.filter_by(id=1).update({
+        ReferenceDataVersion.version: ReferenceDataVersion.version + 1,
+        ReferenceDataVersion.updated_at: datetime.utcnow()
+    })
+    if not updated:
+        db.session.add(ReferenceDataVersion(id=1, version=1))
+
+    # عدم استخدام اللقطة القديمة في بقية الطلب الحالي
+    g.pop('reference_data', None)
+
+def refresh_reference_data():
+    """زيادة إصدار البيانات المرجعية وتعيين بتات الصلاحيات الجديدة في معاملة مستقلة
+
+    تستدعى من سكربتات التحديث بعد حفظ تعديلاتها على الأقسام أو الأدوار أو الصلاحيات؛
+    يعاد False إذا تعذر التحديث (مثل عدم وجود عمود bit قبل تشغيل update_db_for_permission_bits.py).
+    """
+    with app.app_context():
+        try:
+            ReferenceDataVersion.__table__.create(db.engine, checkfirst=True)
+            bump_reference_data_version()
+            db.session.commit()
+            return True
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f'تعذر تحديث إصدار البيانات المرجعية: {str(e)}')
+            return False
+
+class RecipientEntry(namedtuple('RecipientEntry', 'id username full_name department position')):
+    __slots__ = ()
+
+    def to_dict(self, is_favorite=False):
+        return {
+            'id': self.id,
+            'username': self.username,
+            'full_name': self.full_name or self.username,
+            'department': self.department,
+            'position': self.position,
+            'is_favorite': is_favorite
+        }
+
+
+class RecipientIndex:
+    """فهرس بادئات في ذاكرة العملية لدليل المستخدمين (مصفوفة مرتبة مع بحث ثنائي)"""
+
+    # أوزان الحقول في الترتيب
+    FIELD_WEIGHTS = (('username', 30), ('full_name', 20), ('position', 10), ('department', 5))
+    EXACT_MATCH_BONUS = 5
+    FAVORITE_BONUS = 100
+
+    def __init__(self, refresh_interval, full_refresh_interval, scan_limit):
+        self.refresh_interval = refresh_interval
+        self.full_refresh_interval = full_refresh_interval
+        self.scan_limit = scan_limit
+        self._lock = threading.Lock()
+        self._keys = []  # (token, weight, user_id) مرتبة
+        self._entries = None  # user_id -> RecipientEntry
+        self._tokens = {}  # user_id -> ((token, weight), ...)
+        self._reference_version = None
+        self._updated_since = None
+        self._built_at = 0
+        self._checked_at = 0
+        self._pending_ids = set()
+
+    @classmethod
+    def _entry_tokens(cls, entry):
+        tokens = {}
+        for field, weight in cls.FIELD_WEIGHTS:
+            value = normalize_arabic(getattr(entry, field))
+            if not value:
+                continue
+            words = value.split()
+            candidates = [value] + words
+            # السماح بالبحث بدون أداة التعريف
+            candidates += [word[2:] for word in words if word.startswith('ال') and len(word) > 3]
+            for token in candidates:
+                if tokens.get(token, 0) < weight:
+                    tokens[token] = weight
+        return tuple(tokens.items())
+
+    @staticmethod
+    def _query():
+        return db.session.query(
+            User.id, User.username, User.full_name, User.department_id,
+            User.department_name, User.position, User.is_active, User.updated_at
+        )
+
+    def _make_entry(self, row, reference):
+        department = reference.get_department(row.department_id)
+        return RecipientEntry(row.id, row.username, row.full_name,
+                              department.name if department else row.department_name, row.position)
+
+    def _rebuild(self, reference):
+        rows = self._query().filter(User.is_active == True).all()
+        entries = {}
+        tokens = {}
+        keys = []
+        for row in rows:
+            entry = entries[row.id] = self._make_entry(row, reference)
+            tokens[row.id] = self._entry_tokens(entry)
+            keys.extend((token, weight, row.id) for token, weight in tokens[row.id])
+        keys.sort()
+
+        now = time.monotonic()
+        with self._lock:
+            self._keys, self._entries, self._tokens = keys, entries, tokens
+            self._reference_version = reference.version
+            self._updated_since = max((row.updated_at for row in rows if row.updated_at), default=None)
+            self._built_at = self._checked_at = now
+            self._pending_ids.clear()
+
+    def _refresh_changed(self, reference):
+        with self._lock:
+            pending_ids = set(self._pending_ids)
+            self._pending_ids.clear()
+            since = self._updated_since
+
+        conditions = []
+        if since is not None:
+            conditions.append(User.updated_at >= since)
+        if pending_ids:
+            conditions.append(User.id.in_(pending_ids))
+        rows = self._query().filter(or_(*conditions)).all() if conditions else []
+
+        changed = {row.id: row for row in rows}
+        affected = set(changed) | pending_ids
+        with self._lock:
+            entries = dict(self._entries)
+            tokens = dict(self._tokens)
+            keys = self._keys
+            if affected:
+                # إزالة المستخدمين المتأثرين (بما فيهم المحذوفون والمعطلون) ثم إعادة إضافة النشطين
+                keys = [key for key in keys if key[2] not in affected]
+                for user_id in affected:
+                    entries.pop(user_id, None)
+                    tokens.pop(user_id, None)
+                for row in changed.values():
+                    if not row.is_active:
+                        continue
+                    entry = entries[row.id] = self._make_entry(row, reference)
+                    tokens[row.id] = self._entry_tokens(entry)
+                    keys.extend((token, weight, row.id) for token, weight in tokens[row.id])
+                keys.sort()
+            self._keys, self._entries, self._tokens = keys, entries, tokens
+            self._updated_since = max([since] + [row.updated_at for row in rows if row.updated_at],
+                                      key=lambda value: value or datetime.min)
+            self._checked_at = time.monotonic()
+
+    def refresh(self):
+        """تحديث الفهرس عند الحاجة (إعادة بناء كاملة عند تغير البيانات المرجعية وإلا تحديث تزايدي)"""
+        reference = get_reference_data()
+        now = time.monotonic()
+        if (self._entries is None or self._reference_version != reference.version
+                or now - self._built_at >= self.full_refresh_interval):
+            self._rebuild(reference)
+        elif self._pending_ids or now - self._checked_at >= self.refresh_interval:
+            self._refresh_changed(reference)
+
+    def mark_changed(self, user_ids):
+        """تسجيل مستخدمين تغيروا في هذه العملية لتحديثهم عند البحث التالي"""
+        with self._lock:
+            self._pending_ids.update(user_ids)
+
+    def _matches(self, user_id, prefix):
+        best = 0
+        for token, weight in self._tokens.get(user_id, ()):
+            if token.startswith(prefix):
+                best = max(best, weight + (self.EXACT_MATCH_BONUS if token == prefix else 0))
+        return best
+
+    def search(self, query, limit=10, favorites=frozenset(), exclude_id=None):
+        """البحث عن المستخدمين بالبادئة مع تعزيز المفضلين"""
+        self.refresh()
+        prefix = normalize_arabic(query)
+        keys, entries = self._keys, self._entries
+
+        scores = {}
+        if prefix:
+            index = bisect.bisect_left(keys, (prefix,))
+            end = min(len(keys), index + self.scan_limit)
+            while index < end:
+                token, weight, user_id = keys[index]
+                if not token.startswith(prefix):
+                    break
+                score = weight + (self.EXACT_MATCH_BONUS if token == prefix else 0)
+                if score > scores.get(user_id, 0):
+                    scores[user_id] = score
+                index += 1
+
+        # المفضلون يظهرون دائمًا أولًا حتى لو تجاوز البحث حد الفحص
+        for user_id in favorites:
+            if user_id not in entries:
+                continue
+            score = self._matches(user_id, prefix) if prefix else 1
+            if score:
+                scores[user_id] = max(score, scores.get(user_id, 0)) + self.FAVORITE_BONUS
+
+        scores.pop(exclude_id, None)
+        ranked = sorted(scores, key=lambda user_id: (-scores[user_id], entries[user_id].username))
+        return [entries[user_id].to_dict(user_id in favorites) for user_id in ranked[:limit]]
+
+
+recipient_index = RecipientIndex(
+    refresh_interval=app.config['RECIPIENT_INDEX_REFRESH_INTERVAL'],
+    full_refresh_interval=app.config['RECIPIENT_INDEX_FULL_REFRESH_INTERVAL'],
+    scan_limit=app.config['RECIPIENT_INDEX_SCAN_LIMIT']
+)
+
+@event.listens_for(db.session, 'after_flush')
+def collect_recipient_index_changes(session, flush_context):
+    """جمع المستخدمين المعدلين لتحديث فهرس المستلمين بعد تأكيد المعاملة"""
+    changed = session.info.setdefault('recipient_index_changes', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User) and obj.id is not None:
+            changed.add(obj.id)
+
+@event.listens_for(db.session, 'after_commit')
+def apply_recipient_index_changes(session):
+    changed = session.info.pop('recipient_index_changes', None)
+    if changed:
+        recipient_index.mark_changed(changed)
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_recipient_index_changes(session):
+    session.info.pop('recipient_index_changes', None)
+
+def _as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, (list, tuple)) else [value]
+
+def _as_bool(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, int) and value in (0, 1):
+        return bool(value)
+    if isinstance(value, str):
+        text = value.strip().lower()
+        if text in ('true', '1', 'yes', 'نعم'):
+            return True
+        if text in ('false', '0', 'no', 'لا'):
+            return False
+    raise ValueError('قيمة غير صحيحة للحقل is_active')
+
+def compile_group_rules(rules):
+    """تحويل قواعد المجموعة الديناميكية إلى شرط SQL على جدول المستخدمين
+
+    مثال على القواعد:
+        {"match": "all", "conditions": [
+            {"field": "department", "op": "subtree", "value": [3]},
+            {"field": "role", "op": "in", "value": [2, 5]},
+            {"field": "position", "op": "prefix", "value": "رئيس"}
+        ]}
+    يتم استبعاد المستخدمين غير النشطين ما لم يحدد شرط على is_active.
+    """
+    if isinstance(rules, str) or rules is None:
+        try:
+            rules = json.loads(rules or '{}')
+        except ValueError:
+            raise ValueError('صيغة القواعد غير صحيحة')
+    if not isinstance(rules, dict):
+        raise ValueError('صيغة القواعد غير صحيحة')
+    if not isinstance(rules.get('conditions', []), list):
+        raise ValueError('يجب أن تكون الشروط قائمة')
+
+    conditions = []
+    has_active_condition = False
+
+    for condition in rules.get('conditions', []):
+        if not isinstance(condition, dict):
+            raise ValueError('صيغة الشرط غير صحيحة')
+        field = condition.get('field')
+        op = condition.get('op', 'in')
+        value = condition.get('value')
+
+        if field in ('department', 'role'):
+            column = User.department_id if field == 'department' else User.role_id
+            try:
+                ids = [int(v) for v in _as_list(value)]
+            except (TypeError, ValueError):
+                raise ValueError(f'قيم غير صحيحة للحقل {field}')
+            if op == 'in':
+                expression = column.in_(ids)
+            elif op == 'not_in':
+                expression = or_(column.is_(None), column.notin_(ids))
+            elif op == 'subtree' and field == 'department':
+                expression = column.in_(subtree_department_ids(ids))
+            else:
+                raise ValueError(f'عملية غير مدعومة للحقل {field}: {op}')
+
+        elif field == 'position':
+            if value is not None and not isinstance(value, str):
+                raise ValueError('قيمة غير صحيحة للمسمى الوظيفي')
+            value = (value or '').strip()
+            if not value:
+                raise ValueError('يجب تحديد قيمة للمسمى الوظيفي')
+            if op == 'eq':
+                expression = User.position == value
+            elif op == 'prefix':
+                expression = (User.position >= value) & (User.position < prefix_upper_bound(value))
+            elif op == 'contains':
+                expression = User.position.contains(value, autoescape=True)
+            else:
+                raise ValueError(f'عملية غير مدعومة للمسمى الوظيفي: {op}')
+
+        elif field == 'is_active':
+            has_active_condition = True
+            expression = User.is_active == _as_bool(value)
+
+        else:
+            raise ValueError(f'حقل غير مدعوم في قواعد المجموعة: {field}')
+
+        conditions.append(expression)
+
+    if not conditions:
+        raise ValueError('يجب تحديد شرط واحد على الأقل')
+
+    predicate = or_(*conditions) if rules.get('match') == 'any' else and_(*conditions)
+    if not has_active_condition:
+        predicate = and_(predicate, User.is_active == True)
+    return predicate
+
+def message_notification_style(priority):
+    """عنوان الإشعار وأيقونته ولونه حسب أولوية الرسالة"""
+    if priority == 'urgent':
+        return 'رسالة عاجلة', 'fa-exclamation-circle', 'warning'
+    if priority == 'very_urgent':
+        return 'رسالة هامة جداً', 'fa-exclamation-triangle', 'danger'
+    return 'رسالة جديدة', 'fa-envelope', 'primary'
+
+def department_audience(department_ids, exclude_user_id=None, active_only=True):
+    """استعلام معرفات المستخدمين النشطين (أو جميع المستخدمين) في الأقسام المحددة وأقسامها الفرعية"""
+    audience = select(User.id).where(User.department_id.in_(subtree_department_ids(department_ids)))
+    if active_only:
+        audience = audience.where(User.is_active == True)
+    if exclude_user_id:
+        audience = audience.where(User.id != exclude_user_id)
+    return audience
+
+def can_send_to_departments(user, department_ids):
+    """الإرسال إلى أقسام (مع أقسامها الفرعية) يتطلب صلاحية send_broadcast، إلا إذا كانت
+    جميع الأقسام هي قسم المرسل أو من أقسامه الفرعية"""
+    if not department_ids or user.has_permission('send_broadcast'):
+        return True
+    if not user.department_id:
+        return False
+    reference_data = get_reference_data()
+    return all(user.department_id in reference_data.get_department_ancestor_ids(department_id)
+               for department_id in department_ids)
+
+def all_users_audience(exclude_user_id=None):
+    """استعلام معرفات جميع المستخدمين النشطين"""
+    audience = select(User.id).where(User.is_active == True)
+    if exclude_user_id:
+        audience = audience.where(User.id != exclude_user_id)
+    return audience
+
+def exclude_from_audience(audience, user_id):
+    """استبعاد مستخدم (عادة المرسل) من استعلام جمهور أيًا كان مصدره"""
+    audience = audience.subquery()
+    return select(audience.c[0]).where(audience.c[0] != user_id)
+
+def _int_list(values):
+    """تحويل قائمة قيم نصية إلى معرفات صحيحة فريدة مع تجاهل القيم غير الصالحة"""
+    return sorted({int(value) for value in values if str(value).strip().isdigit()})
+
+def _audience_parts(user_ids=(), group_ids=(), department_ids=()):
+    """استعلامات معرفات المستخدمين لكل مصدر (أفراد، مجموعات، أقسام)"""
+    parts = []
+    if user_ids:
+        parts.append(select(User.id).where(User.id.in_(user_ids)))
+    if group_ids:
+        for group in UserGroup.query.filter(UserGroup.id.in_(group_ids), UserGroup.is_active == True):
+            parts.append(group.member_ids_query())
+    if department_ids:
+        parts.append(select(User.id).where(User.department_id.in_(subtree_department_ids(department_ids))))
+    return parts
+
+def resolve_audience(user_ids=(), group_ids=(), department_ids=(),
+                     exclude_user_ids=(), exclude_group_ids=(), exclude_department_ids=()):
+    """حل الجمهور من أي مزيج من المستخدمين والمجموعات والأقسام مع الاستثناءات
+
+    يعاد استعلام واحد (UNION ثم EXCEPT) لمعرفات المستخدمين النشطين دون تكرار،
+    يمكن تمريره إلى count_audience أو fan_out_message مباشرة، أو None إذا لم
+    يحدد أي مصدر. قد يرفع ValueError إذا كانت قواعد مجموعة ديناميكية غير صالحة.
+    """
+    parts = _audience_parts(user_ids, group_ids, department_ids)
+    if not parts:
+        return None
+
+    included = union(*parts).subquery()
+    audience = (
+        select(User.id)
+        .join(included, User.id == included.c[0])
+        .where(User.is_active == True)
+    )
+
+    exclusions = _audience_parts(exclude_user_ids, exclude_group_ids, exclude_department_ids)
+    if exclusions:
+        audience = except_(audience, *exclusions)
+    return audience
+
+def audience_from_args(args, exclude_user_id=None):
+    """حل الجمهور من حقول النموذج أو معاملات الطلب (users[] و groups[] و departments[] واستثناءاتها)"""
+    return resolve_audience(
+        user_ids=_int_list(args.getlist('multiple_recipients[]') + args.getlist('user_ids[]')),
+        group_ids=_int_list(args.getlist('group_ids[]')),
+        department_ids=_int_list(args.getlist('department_ids[]')),
+        exclude_user_ids=_int_list(args.getlist('exclude_user_ids[]') + ([exclude_user_id] if exclude_user_id else [])),
+        exclude_group_ids=_int_list(args.getlist('exclude_group_ids[]')),
+        exclude_department_ids=_int_list(args.getlist('exclude_department_ids[]'))
+    )
+
+# أدوار العضوية في المجموعات
+GROUP_MEMBERSHIP_ROLES = ('member', 'admin')
+
+def member_source_query(user_ids=(), usernames=(), department_ids=()):
+    """استعلام معرفات المستخدمين النشطين المحددين بالمعرف أو اسم المستخدم أو القسم (مع أقسامه الفرعية)"""
+    parts = _audience_parts(user_ids=user_ids, department_ids=department_ids)
+    if usernames:
+        parts.append(select(User.id).where(User.username.in_(usernames)))
+    if not parts:
+        return None
+    source = union(*parts).subquery()
+    return select(User.id).join(source, User.id == source.c[0]).where(User.is_active == True)
+
+def bulk_add_group_members(group, source, role='member'):
+    """إضافة المستخدمين الناتجين عن الاستعلام إلى المجموعة بإدراج INSERT ... SELECT واحد
+
+    يتم تجاهل الأعضاء الحاليين، ويعاد عدد العضويات المضافة. لا يتم تأكيد المعاملة.
+    """
+    source = source.subquery()
+    existing = select(UserGroupMembership.user_id).where(UserGroupMembership.group_id == group.id)
+    result = db.session.execute(
+        insert(UserGroupMembership).from_select(
+            ['group_id', 'user_id', 'role', 'joined_at'],
+            select(literal(group.id), source.c[0], literal(role), literal(datetime.now(), db.DateTime))
+            .where(source.c[0].notin_(existing))
+        )
+    )
+    return result.rowcount
+
+def bulk_remove_group_members(group, source=None, keep=None):
+    """حذف عضويات المجموعة بحذف DELETE واحد (منشئ المجموعة لا يحذف أبدًا)
+
+    source: حذف المستخدمين الناتجين عن الاستعلام فقط.
+    keep: حذف جميع الأعضاء عدا الناتجين عن الاستعلام (لاستبدال القائمة).
+    """
+    memberships = UserGroupMembership.__table__
+    statement = memberships.delete().where(memberships.c.group_id == group.id)
+    if group.created_by_id:
+        statement = statement.where(memberships.c.user_id != group.created_by_id)
+    if source is not None:
+        statement = statement.where(memberships.c.user_id.in_(source))
+    if keep is not None:
+        statement = statement.where(memberships.c.user_id.notin_(keep))
+    return db.session.execute(statement).rowcount
+
+def apply_group_membership_change(group, action, source, role='member'):
+    """تطبيق إضافة أو إزالة أو استبدال أعضاء المجموعة في معاملة واحدة"""
+    if action == 'add':
+        return {'added': bulk_add_group_members(group, source, role), 'removed': 0}
+    if action == 'remove':
+        return {'added': 0, 'removed': bulk_remove_group_members(group, source=source)}
+    if action == 'replace':
+        removed = bulk_remove_group_members(group, keep=source)
+        return {'added': bulk_add_group_members(group, source, role), 'removed': removed}
+    raise ValueError('إجراء غير مدعوم')
+
+def import_group_members_csv(group, stream, replace=False):
+    """استيراد أعضاء المجموعة من ملف CSV بالقراءة المتدفقة وعلى دفعات
+
+    الأعمدة: username أو user_id، ودور اختياري role (member أو admin). يمكن أن
+    يحتوي الملف على سطر عناوين. يعاد ملخص يشمل عدد الأسطر والمضافين والمحذوفين
+    وعينة من أسماء المستخدمين غير الموجودين.
+    """
+    reader = csv.reader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+    summary = {'rows': 0, 'added': 0, 'removed': 0, 'unknown': 0, 'unknown_sample': []}
+    imported_ids = set()
+    chunk = []
+    chunk_size = app.config['MEMBERSHIP_IMPORT_CHUNK_SIZE']
+
+    def flush_chunk():
+        usernames = {value for value, _ in chunk}
+        user_ids = {int(value) for value, _ in chunk if value.isdigit()}
+        found = db.session.execute(
+            select(User.id, User.username).where(
+                User.is_active == True,
+                or_(User.username.in_(usernames), User.id.in_(user_ids))
+            )
+        ).all()
+        # اسم المستخدم له الأولوية؛ القيمة الرقمية تعامل كمعرف فقط إذا لم تطابق اسم مستخدم
+        ids_by_username = {username: user_id for user_id, username in found}
+        found_ids = {user_id for user_id, _ in found}
+
+        by_role = {}
+        for value, role in chunk:
+            user_id = ids_by_username.get(value)
+            if user_id is None and value.isdigit() and int(value) in found_ids:
+                user_id = int(value)
+            if user_id is None:
+                summary['unknown'] += 1
+                if len(summary['unknown_sample']) < 20:
+                    summary['unknown_sample'].append(value)
+                continue
+            by_role.setdefault(role, set()).add(user_id)
+            imported_ids.add(user_id)
+
+        for role, role_ids in by_role.items():
+            summary['added'] += bulk_add_group_members(group, select(User.id).where(User.id.in_(role_ids)), role)
+        chunk.clear()
+
+    for row in reader:
+        if not row or not row[0].strip():
+            continue
+        value = row[0].strip()
+        if summary['rows'] == 0 and value.lower() in ('username', 'user_id'):
+            continue
+        role = row[1].strip().lower() if len(row) > 1 and row[1].strip() else 'member'
+        if role not in GROUP_MEMBERSHIP_ROLES:
+            role = 'member'
+
+        summary['rows'] += 1
+        chunk.append((value, role))
+        if len(chunk) >= chunk_size:
+            flush_chunk()
+
+    if chunk:
+        flush_chunk()
+
+    if replace:
+        # حذف الأعضاء غير الموجودين في الملف على دفعات
+        current_ids = db.session.execute(
+            select(UserGroupMembership.user_id).where(UserGroupMembership.group_id == group.id)
+        ).scalars().all()
+        stale_ids = [user_id for user_id in current_ids if user_id not in imported_ids]
+        for start in range(0, len(stale_ids), chunk_size):
+            summary['removed'] += bulk_remove_group_members(
+                group, source=stale_ids[start:start + chunk_size])
+
+    return summary
+
+def count_audience(audience):
+    """حساب حجم الجمهور داخل قاعدة البيانات دون تحميل المستخدمين"""
+    return db.session.execute(select(func.count()).select_from(audience.subquery())).scalar()
+
+def fan_out_message(message, audience, recipient_type, notification_link=None):
+    """إنشاء صفوف المستلمين والإشعارات وتحديث العدادات باستعلامات INSERT ... SELECT
+
+    audience استعلام يعيد عمودًا واحدًا من معرفات المستخدمين. لا يتم تحميل أي
+    كائنات ORM، ويعاد عدد المستلمين الفعلي قبل تأكيد المعاملة.
+    """
+    db.session.flush()
+    audience = audience.subquery()
+    recipient_ids = select(audience.c[0])
+
+    # صفوف المستلمين
+    result = db.session.execute(
+        insert(MessageRecipient).from_select(
+            ['message_id', 'recipient_id', 'recipient_type', 'status', 'is_archived'],
+            select(literal(message.id), audience.c[0], literal(recipient_type, RecipientType), literal('new', MessageStatus),
+                   literal(False))
+        )
+    )
+    count = result.rowcount
+
+    if not count:
+        return 0
+
+    # الإشعارات للمستخدمين الذين فعّلوا الإشعارات
+    title, icon, color = message_notification_style(message.priority)
+    sender_name = message.sender.username if message.sender else ''
+    db.session.execute(
+        insert(Notification).from_select(
+            ['user_id', 'title', 'content', 'icon', 'color', 'created_at', 'is_read', 'link'],
+            select(
+                User.id, literal(title), literal(f'لديك رسالة جديدة من {sender_name}: {message.subject}'),
+                literal(icon), literal(color), literal(datetime.now(), db.DateTime), literal(False),
+                literal(notification_link)
+            ).where(User.id.in_(recipient_ids), User.notifications_enabled.isnot(False))
+        )
+    )
+
+    # تحديث عدادات غير المقروء (الإدراج المباشر لا يمر بمستمع after_flush)
+    if message.is_multi_recipient:
+        counters = MailboxCounter.__table__
+        db.session.execute(
+            counters.update()
+            .where(counters.c.folder == 'inbox_unread', counters.c.user_id.in_(recipient_ids))
+            .values(count=counters.c.count + 1)
+        )
+
+    return count
+
+# أرقام القيد الرسمية
+# كل عملية تحجز من جدول registry_sequence كتلة من الأرقام في معاملة قصيرة مستقلة،
+# ثم توزع أرقامها من الذاكرة دون الرجوع إلى قاعدة البيانات. الأرقام التي لا تحفظ
+# (إرسال فاشل أو بقية كتلة عند إيقاف العملية) تظهر في تقرير الفجوات
+class RegistryNumberAllocator:
+    """موزع أرقام القيد بكتل محجوزة مسبقًا لكل قسم وسنة"""
+
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._blocks = {}  # (department_id, year) -> [next, end, block_id]
+
+    def allocate(self, department_id, year):
+        """الرقم التالي للقسم والسنة
+
+        قد تحجز كتلة جديدة عبر اتصال مستقل؛ في SQLite يجب استدعاؤها قبل أي كتابة
+        في جلسة الطلب حتى لا تنتظر قفل الكتابة الذي تحمله الجلسة نفسها.
+        """
+        key = (department_id, year)
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is None or block[0] > block[1]:
+                block = self._blocks[key] = self._reserve(department_id, year)
+            number = block[0]
+            block[0] += 1
+            return number
+
+    def _reserve(self, department_id, year):
+        sequences = RegistrySequence.__table__
+        blocks = RegistryBlock.__table__
+        key = and_(sequences.c.department_id == department_id, sequences.c.year == year)
+
+        with db.engine.begin() as connection:
+            connection.execute(
+                sequences.insert().prefix_with('OR IGNORE')
+                .values(department_id=department_id, year=year, next_value=1)
+            )
+            connection.execute(
+                sequences.update().where(key).values(next_value=sequences.c.next_value + self.block_size)
+            )
+            end = connection.execute(select(sequences.c.next_value).where(key)).scalar() - 1
+            start = end - self.block_size + 1
+            block_id = connection.execute(blocks.insert().values(
+                department_id=department_id, year=year, start=start, end=end, reserved_at=datetime.now()
+            )).inserted_primary_key[0]
+        return [start, end, block_id]
+
+    def release(self):
+        """إعادة الكتل المفتوحة: تسجيل آخر رقم موزع منها (ما بعده يحسب فجوة)"""
+        with self._lock:
+            blocks, self._blocks = self._blocks, {}
+        if not blocks:
+            return
+        table = RegistryBlock.__table__
+        with db.engine.begin() as connection:
+            connection.execute(
+                table.update().where(table.c.id == db.bindparam('b'))
+                .values(last_used=db.bindparam('u'), released_at=datetime.now()),
+                [{'b': block_id, 'u': next_value - 1} for next_value, _, block_id in blocks.values()]
+            )
+
+registry_numbers = RegistryNumberAllocator(block_size=app.config['REGISTRY_BLOCK_SIZE'])
+
+@atexit.register
+def release_registry_blocks_on_exit():
+    with app.app_context():
+        try:
+            registry_numbers.release()
+        except Exception:
+            pass
+
+def format_registry_number(department_id, year, sequence):
+    """تنسيق رقم القيد حسب القالب REGISTRY_NUMBER_FORMAT"""
+    department = get_reference_data().get_department(department_id)
+    return app.config['REGISTRY_NUMBER_FORMAT'].format(
+        department_id=department_id,
+        department=department.name if department else '',
+        year=year,
+        number=sequence
+    )
+
+def assign_registry_number(message, department_id, when=None):
+    """منح الرسالة الصادرة رقم القيد التالي لقسم المرسل وسنة الإرسال (قبل أي كتابة في الجلسة)
+
+    الخطابات الواردة لا ترقم أيًا كان مسار تسجيلها (النموذج أو الإرسال المجدول أو الاستيراد الجماعي).
+    """
+    if message.registry_number or message.message_type == 'incoming':
+        return message.registry_number
+    department_id = department_id or 0
+    year = (when or datetime.now()).year
+    sequence = registry_numbers.allocate(department_id, year)
+    message.registry_department_id = department_id
+    message.registry_year = year
+    message.registry_sequence = sequence
+    message.registry_number = format_registry_number(department_id, year, sequence)
+    return message.registry_number
+
+def registry_gaps(department_id, year):
+    """فجوات أرقام القيد للقسم والسنة: [(الرقم، السبب)]
+
+    skipped: رقم وزع ولم تحفظ رسالته (إرسال فاشل)، unused: بقية كتلة أعيدت عند إيقاف العملية.
+    الأرقام بعد آخر رقم مستخدم في الكتل المفتوحة ليست فجوات بعد.
+    """
+    blocks = RegistryBlock.query.filter_by(department_id=department_id, year=year)\
+        .order_by(RegistryBlock.start).all()
+    if not blocks:
+        return []
+    used = set(db.session.execute(
+        select(Message.registry_sequence)
+        .where(Message.registry_department_id == department_id, Message.registry_year == year,
+               Message.registry_sequence.isnot(None))
+    ).scalars())
+    max_used = max(used, default=0)
+
+    gaps = []
+    for block in blocks:
+        if block.released_at is not None:
+            issued_end = block.last_used if block.last_used is not None else block.end
+            gaps += [(number, 'unused') for number in range(max(issued_end + 1, block.start), block.end + 1)]
+        else:
+            issued_end = min(block.end, max_used)
+        gaps += [(number, 'skipped') for number in range(block.start, issued_end + 1) if number not in used]
+    gaps.sort()
+    return gaps
+
+# كشف تكرار المراسلات الواردة
+def find_incoming_duplicates(fingerprint, reference_key, exclude_id=None, limit=10):
+    """الرسائل الواردة المسجلة بنفس البصمة (مطابقة) أو بنفس الجهة والرقم المرجعي (محتملة)
+    عبر بحث مباشر في فهرسي البصمتين"""
+    conditions = []
+    if fingerprint:
+        conditions.append(Message.incoming_fingerprint == fingerprint)
+    if reference_key:
+        conditions.append(Message.incoming_reference_key == reference_key)
+    if not conditions:
+        return []
+
+    query = db.session.query(
+        Message.id, Message.subject, Message.date, Message.reference_number, Message.sender_entity,
+        Message.registry_number, Message.incoming_fingerprint, User.username
+    ).outerjoin(User, User.id == Message.sender_id).filter(or_(*conditions))
+    if exclude_id:
+        query = query.filter(Message.id != exclude_id)
+
+    return [
+        {'id': row.id, 'subject': row.subject, 'reference_number': row.reference_number,
+         'sender_entity': row.sender_entity, 'registry_number': row.registry_number,
+         'registered_by': row.username,
+         'date': row.date.strftime('%Y-%m-%d %H:%M') if row.date else None,
+         'exact': bool(fingerprint) and row.incoming_fingerprint == fingerprint}
+        for row in query.order_by(Message.id).limit(limit)
+    ]
+
+def visible_incoming_duplicates(duplicates, user):
+    """تفاصيل التكرار للرسائل التي يحق للمستخدم الاطلاع عليها فقط؛ البقية بمعرفها ونوع التطابق"""
+    if not duplicates or user.is_admin():
+        return duplicates
+    messages = {message.id: message for message in Message.query.filter(Message.id.in_([d['id'] for d in duplicates]))}
+    return [
+        d if d['id'] in messages and messages[d['id']].can_be_viewed_by(user)
+        else {'id': d['id'], 'exact': d['exact'], 'restricted': True}
+        for d in duplicates
+    ]
+
+def incoming_duplicate_groups(exact=True, limit=None):
+    """تقرير التكرار: مجموعات الرسائل الواردة التي تشترك في البصمة الكاملة (أو في الجهة والرقم المرجعي)
+    [(المفتاح، [معرفات الرسائل])]"""
+    column = Message.incoming_fingerprint if exact else Message.incoming_reference_key
+    keys = select(column.label('key')).where(column.isnot(None)).group_by(column).having(func.count(Message.id) > 1)
+    if limit:
+        keys = keys.limit(limit)
+    keys = keys.subquery()
+
+    groups = {}
+    for key, message_id in db.session.execute(
+        select(column, Message.id).join(keys, keys.c.key == column).order_by(column, Message.id)
+    ):
+        groups.setdefault(key, []).append(message_id)
+    return list(groups.items())
+
+# الاستيراد الجماعي للمراسلات الواردة والبريد الشخصي من ملفات CSV أو XLSX
+# يقرأ الملف سطرًا بسطر (openpyxl في وضع القراءة فقط لملفات XLSX) فلا يحمل كاملًا في الذاكرة،
+# وتحفظ الأسطر الصالحة على دفعات في معاملات مستقلة، وتكتب الأسطر المرفوضة أثناء القراءة
+# إلى تقرير أخطاء CSV قابل للتنزيل.
+
+# أسماء الأعمدة المقبولة لكل حقل (اسم الحقل نفسه أو أحد الأسماء العربية؛ الأول يستخدم في رسائل الخطأ)
+INCOMING_IMPORT_COLUMNS = MappingProxyType({
+    'subject': ('الموضوع',),
+    'content': ('المحتوى', 'النص'),
+    'sender_entity': ('الجهة المرسلة', 'الجهة'),
+    'reference_number': ('الرقم المرجعي', 'رقم الخطاب'),
+    'document_date': ('تاريخ الخطاب',),
+    'due_date': ('تاريخ الاستحقاق',),
+    'priority': ('الأولوية',),
+    'confidentiality': ('السرية',),
+    'recipient': ('المستلم',),
+})
+PERSONAL_MAIL_IMPORT_COLUMNS = MappingProxyType({
+    'title': ('العنوان',),
+    'content': ('المحتوى', 'النص'),
+    'source': ('المصدر',),
+    'reference_number': ('الرقم المرجعي',),
+    'due_date': ('تاريخ الاستحقاق',),
+    'status': ('الحالة',),
+    'priority': ('الأولوية',),
+    'notes': ('ملاحظات', 'الملاحظات'),
+})
+
+IMPORT_DATE_FORMATS = ('%Y-%m-%d', '%Y/%m/%d', '%d/%m/%Y', '%d-%m-%Y', '%Y-%m-%d %H:%M:%S')
+
+def import_choices(display):
+    """جدول القيم المقبولة في الاستيراد: الاسم الداخلي أو النص العربي (بعد التطبيع) -> الاسم الداخلي"""
+    choices = {}
+    for name, label in display.items():
+        choices[normalize_arabic(name, strip_punctuation=True)] = name
+        choices[normalize_arabic(name.replace('_', ' '), strip_punctuation=True)] = name
+        choices[normalize_arabic(label, strip_punctuation=True)] = name
+    return MappingProxyType(choices)
+
+IMPORT_PRIORITY_CHOICES = import_choices(MESSAGE_PRIORITY_DISPLAY)
+IMPORT_CONFIDENTIALITY_CHOICES = import_choices(MESSAGE_CONFIDENTIALITY_DISPLAY)
+IMPORT_PERSONAL_MAIL_STATUS_CHOICES = import_choices(PERSONAL_MAIL_STATUS_DISPLAY)
+
+def import_value(record, field, label, required=False, limit=None):
+    """قيمة نصية منظفة من سطر الاستيراد (ValueError إذا كانت مطلوبة وفارغة أو أطول من الحد)"""
+    value = record.get(field)
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    text = str(value).strip() if value is not None else ''
+    if not text:
+        if required:
+            raise ValueError(f'الحقل {label} مطلوب')
+        return None
+    if limit and len(text) > limit:
+        raise ValueError(f'الحقل {label} أطول من {limit} حرف')
+    return text
+
+def import_date(record, field, label):
+    """تاريخ من خلية XLSX أو نص بإحدى الصيغ المقبولة (الأرقام العربية مقبولة)"""
+    value = record.get(field)
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    text = import_value(record, field, label)
+    if text is None:
+        return None
+    text = text.translate(ARABIC_LETTER_MAP)
+    for date_format in IMPORT_DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format).date()
+        except ValueError:
+            continue
+    raise ValueError(f'صيغة {label} غير صحيحة: {text}')
+
+def import_choice(record, field, label, choices, default):
+    """قيمة تعداد من سطر الاستيراد (الاسم الداخلي أو النص العربي)"""
+    text = import_value(record, field, label)
+    if text is None:
+        return default
+    name = choices.get(normalize_arabic(text, strip_punctuation=True))
+    if name is None:
+        raise ValueError(f'قيمة {label} غير صالحة: {text}')
+    return name
+
+def iter_import_rows(file):
+    """(رقم السطر، القيم) من ملف CSV أو XLSX بالقراءة المتدفقة"""
+    extension = os.path.splitext(file.filename or '')[1].lower()
+    if extension == '.xlsx':
+        # الحزمة openpyxl اختيارية ولا تلزم إلا لملفات XLSX
+        try:
+            from openpyxl import load_workbook
+        except ImportError:
+            raise ValueError('قراءة ملفات XLSX تتطلب تثبيت الحزمة openpyxl؛ يرجى حفظ الملف بصيغة CSV')
+        workbook = load_workbook(file.stream, read_only=True, data_only=True)
+        try:
+            for line, row in enumerate(workbook.active.iter_rows(values_only=True), 1):
+                yield line, list(row)
+        finally:
+            workbook.close()
+    elif extension in ('.csv', '.txt'):
+        reader = csv.reader(io.TextIOWrapper(file.stream, encoding='utf-8-sig', newline=''))
+        for row in reader:
+            yield reader.line_num, row
+    else:
+        raise ValueError('نوع الملف غير مدعوم؛ يرجى رفع ملف CSV أو XLSX')
+
+def import_reports_folder():
+    """مجلد تقارير أخطاء الاستيراد"""
+    return os.path.join(app.instance_path, 'import_reports')
+
+class ImportErrorReport:
+    """تقرير أخطاء الاستيراد: يكتب الأسطر المرفوضة إلى ملف CSV أثناء القراءة
+
+    لا ينشأ الملف إلا عند أول خطأ. اسم الملف يبدأ بمعرف المستخدم للتحقق من ملكيته عند التنزيل.
+    """
+
+    def __init__(self, user_id, header):
+        self.name = f'{user_id}-{uuid.uuid4().hex}.csv'
+        self.header = header
+        self.count = 0
+        self._file = None
+        self._writer = None
+
+    def add(self, line, values, error):
+        if self._writer is None:
+            folder = import_reports_folder()
+            os.makedirs(folder, exist_ok=True)
+            prune_import_reports(folder)
+            self._file = open(os.path.join(folder, self.name), 'w', encoding='utf-8-sig', newline='')
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(['السطر', 'الخطأ'] + self.header)
+        self._writer.writerow([line, error] + ['' if value is None else value for value in values])
+        self.count += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+def prune_import_reports(folder):
+    """حذف تقارير الأخطاء الأقدم من مدة الاحتفاظ"""
+    expires = time.time() - app.config['BULK_IMPORT_REPORT_MAX_AGE'] * 86400
+    for entry in os.scandir(folder):
+        if entry.is_file() and entry.stat().st_mtime < expires:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+def run_bulk_import(rows, columns, required, user_id, parse_row, save_chunk):
+    """تشغيل الاستيراد: سطر العناوين أولًا ثم الأسطر على دفعات
+
+    parse_row(record) يعيد الحقول المطبعة للسطر أو يرفع ValueError برسالة الخطأ.
+    save_chunk(chunk) يضيف الدفعة [(السطر، القيم، الحقول)] إلى الجلسة دون تأكيد المعاملة،
+    ويعيد الأسطر المرفوضة بعد التحقق الجماعي [(السطر، القيم، الخطأ)].
+    يعاد ملخص: عدد الأسطر والمستورد والمرفوض واسم تقرير الأخطاء (إن وجد).
+    """
+    aliases = {}
+    for field, names in columns.items():
+        for name in (field,) + names:
+            aliases[normalize_arabic(name, strip_punctuation=True)] = field
+
+    chunk_size = app.config['BULK_IMPORT_CHUNK_SIZE']
+    summary = {'rows': 0, 'imported': 0, 'errors': 0, 'report': None}
+    fields = None
+    report = None
+    chunk = []
+
+    def flush_chunk():
+        try:
+            rejected = save_chunk(chunk)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            rejected = [(line, values, f'تعذر حفظ الدفعة: {str(e)}') for line, values, _ in chunk]
+        for line, values, error in rejected:
+            report.add(line, values, error)
+        summary['imported'] += len(chunk) - len(rejected)
+        chunk.clear()
+
+    try:
+        for line, values in rows:
+            if not any(value is not None and str(value).strip() for value in values):
+                continue
+
+            if fields is None:
+                # سطر العناوين: ربط كل عمود بحقله (الأعمدة غير المعروفة تتجاهل)
+                fields = [aliases.get(normalize_arabic(str(value or ''), strip_punctuation=True)) for value in values]
+                missing = [columns[field][0] for field in required if field not in fields]
+                if missing:
+                    raise ValueError(f'أعمدة مطلوبة غير موجودة في الملف: {"، ".join(missing)}')
+                report = ImportErrorReport(user_id, ['' if value is None else str(value) for value in values])
+                continue
+
+            summary['rows'] += 1
+            record = {field: value for field, value in zip(fields, values) if field}
+            try:
+                chunk.append((line, values, parse_row(record)))
+            except ValueError as e:
+                report.add(line, values, str(e))
+
+            if len(chunk) >= chunk_size:
+                flush_chunk()
+
+        if fields is None:
+            raise ValueError('الملف فارغ')
+        if chunk:
+            flush_chunk()
+    finally:
+        if report is not None:
+            report.close()
+
+    summary['errors'] = report.count
+    summary['report'] = report.name if report.count else None
+    return summary
+
+def parse_incoming_import_row(record):
+    """تحقق وتطبيع سطر مراسلة واردة"""
+    return {
+        'subject': import_value(record, 'subject', 'الموضوع', required=True, limit=200),
+        'content': import_value(record, 'content', 'المحتوى') or '',
+        'sender_entity': import_value(record, 'sender_entity', 'الجهة المرسلة', required=True, limit=200),
+        'reference_number': import_value(record, 'reference_number', 'الرقم المرجعي', limit=50),
+        'document_date': import_date(record, 'document_date', 'تاريخ الخطاب'),
+        'due_date': import_date(record, 'due_date', 'تاريخ الاستحقاق'),
+        'priority': import_choice(record, 'priority', 'الأولوية', IMPORT_PRIORITY_CHOICES, 'normal'),
+        'confidentiality': import_choice(record, 'confidentiality', 'السرية', IMPORT_CONFIDENTIALITY_CHOICES, 'normal'),
+        'recipient': import_value(record, 'recipient', 'المستلم', required=True),
+    }
+
+def import_incoming_correspondence(file, sender, allow_duplicates=False):
+    """استيراد خطابات واردة من ملف CSV أو XLSX؛ كل سطر رسالة واردة لمستلم واحد
+
+    المستلمون (اسم المستخدم أو المعرف) يحلون باستعلام واحد لكل دفعة، والخطابات المسجلة مسبقًا
+    (نفس البصمة) ترفض ما لم يسمح بالتكرار. لا ترقم الرسائل الواردة في سجل القيد.
+    """
+    sender_name = sender.username
+    sender_id = sender.id
+
+    def save_chunk(chunk):
+        keys = {fields['recipient'] for _, _, fields in chunk}
+        # اسم المستخدم له الأولوية؛ القيمة الرقمية تعامل كمعرف فقط إذا لم تطابق اسم مستخدم
+        by_username = {}
+        by_id = {}
+        for user_id, username, notifications_enabled in db.session.execute(
+            select(User.id, User.username, User.notifications_enabled).where(
+                User.is_active == True,
+                or_(User.username.in_(keys), User.id.in_([int(key) for key in keys if key.isdigit()]))
+            )
+        ):
+            by_username[username] = by_id[user_id] = (user_id, notifications_enabled)
+
+        # البصمات المسجلة مسبقًا باستعلام واحد على فهرس البصمة
+        for _, _, fields in chunk:
+            fields['fingerprint'] = incoming_fingerprint(fields['sender_entity'], fields['reference_number'],
+                                                         fields['document_date'], fields['content'])
+        seen = set()
+        if not allow_duplicates:
+            seen.update(db.session.execute(
+                select(Message.incoming_fingerprint)
+                .where(Message.incoming_fingerprint.in_({fields['fingerprint'] for _, _, fields in chunk}))
+            ).scalars())
+
+        rejected = []
+        messages = []
+        for line, values, fields in chunk:
+            user = by_username.get(fields['recipient'])
+            if user is None and fields['recipient'].isdigit():
+                user = by_id.get(int(fields['recipient']))
+            if user is None:
+                rejected.append((line, values, f'المستلم غير موجود أو غير نشط: {fields["recipient"]}'))
+                continue
+            if fields['fingerprint'] in seen:
+                rejected.append((line, values, 'الخطاب الوارد مسجل مسبقًا'))
+                continue
+            if not allow_duplicates:
+                seen.add(fields['fingerprint'])
+
+            message = Message(
+                subject=fields['subject'],
+                content=fields['content'],
+                sender_id=sender_id,
+                recipient_id=user[0],
+                priority=fields['priority'],
+                message_type='incoming',
+                confidentiality=fields['confidentiality'],
+                reference_number=fields['reference_number'],
+                due_date=fields['due_date'],
+                sender_entity=fields['sender_entity'],
+                document_date=fields['document_date'],
+                incoming_fingerprint=fields['fingerprint'],
+                incoming_reference_key=incoming_reference_key(fields['sender_entity'], fields['reference_number']),
+                recipient_type='user',
+                is_multi_recipient=False
+            )
+            message.recipients_data.append(MessageRecipient(recipient_id=user[0], recipient_type='user', status='new'))
+            messages.append((message, user))
+
+        db.session.add_all([message for message, _ in messages])
+        db.session.flush()
+
+        # الإشعارات بإدراج واحد للدفعة
+        notifications = []
+        for message, (user_id, notifications_enabled) in messages:
+            if notifications_enabled is False:
+                continue
+            title, icon, color = message_notification_style(message.priority)
+            notifications.append({
+                'user_id': user_id, 'title': title,
+                'content': f'لديك رسالة جديدة من {sender_name}: {message.subject}',
+                'icon': icon, 'color': color, 'created_at': datetime.now(), 'is_read': False,
+                'link': url_for('view_message', id=message.id)
+            })
+        if notifications:
+            db.session.execute(insert(Notification), notifications)
+
+        return rejected
+
+    return run_bulk_import(iter_import_rows(file), INCOMING_IMPORT_COLUMNS, ('subject', 'sender_entity', 'recipient'),
+                           sender_id, parse_incoming_import_row, save_chunk)
+
+def parse_personal_mail_import_row(record):
+    """تحقق وتطبيع سطر بريد شخصي"""
+    return {
+        'title': import_value(record, 'title', 'العنوان', required=True, limit=200),
+        'content': import_value(record, 'content', 'المحتوى'),
+        'source': import_value(record, 'source', 'المصدر', limit=200),
+        'reference_number': import_value(record, 'reference_number', 'الرقم المرجعي', limit=100),
+        'due_date': import_date(record, 'due_date', 'تاريخ الاستحقاق'),
+        'status': import_choice(record, 'status', 'الحالة', IMPORT_PERSONAL_MAIL_STATUS_CHOICES, 'pending'),
+        'priority': import_choice(record, 'priority', 'الأولوية', IMPORT_PRIORITY_CHOICES, 'normal'),
+        'notes': import_value(record, 'notes', 'ملاحظات'),
+    }
+
+def import_personal_mail(file, user_id):
+    """استيراد بريد شخصي للمستخدم من ملف CSV أو XLSX"""
+    def save_chunk(chunk):
+        db.session.add_all([PersonalMail(user_id=user_id, **fields) for _, _, fields in chunk])
+        db.session.flush()
+        return []
+
+    return run_bulk_import(iter_import_rows(file), PERSONAL_MAIL_IMPORT_COLUMNS, ('title',),
+                           user_id, parse_personal_mail_import_row, save_chunk)
+
+# حقول النموذج التي تحدد جمهور المستلمين المتعددين (تحفظ مع الإرسال المجدول)
+AUDIENCE_ARG_KEYS = ('multiple_recipients[]', 'user_ids[]', 'group_ids[]', 'department_ids[]',
+                     'exclude_user_ids[]', 'exclude_group_ids[]', 'exclude_department_ids[]')
+
+def resolve_delivery(sender_id, recipient_type, delivery):
+    """حل مواصفات الإرسال إلى (قائمة مستلمين، استعلام جمهور)؛ أحدهما فقط يستخدم حسب النوع"""
+    if recipient_type == 'user':
+        recipient = db.session.get(User, delivery.get('recipient_id'))
+        return ([recipient] if recipient else []), None
+    if recipient_type == 'group':
+        # أعضاء المجموعة (قائمة ثابتة أو قواعد ديناميكية) كاستعلام يتم توسيعه عند الإرسال
+        group = db.session.get(UserGroup, delivery.get('group_id'))
+        if not group:
+            return [], None
+        return [], exclude_from_audience(group.member_ids_query(), sender_id)
+    if recipient_type == 'all':
+        return [], all_users_audience(exclude_user_id=sender_id)
+    if recipient_type == 'department':
+        return [], department_audience(delivery.get('department_ids', []), exclude_user_id=sender_id)
+    # يتم حل الجمهور دون تكرار في استعلام واحد (UNION/EXCEPT)
+    return [], audience_from_args(MultiDict(delivery.get('args', {})), exclude_user_id=sender_id)
+
+def deliver_message(message, recipient_type, delivery, recipients, audience):
+    """ربط الرسالة بمستلميها وإنشاء الإشعارات؛ يعاد عدد المستلمين. لا يتم تأكيد المعاملة."""
+    db.session.flush()
+
+    if audience is not None:
+        if message.is_broadcast:
+            # حفظ تعريف الجمهور فقط؛ حالة كل مستلم تنشأ عند قراءته أو أرشفته أو تغيير حالتها
+            if recipient_type == 'all':
+                message.audiences.append(MessageAudience(audience_type='all'))
+            else:
+                for department_id in delivery.get('department_ids', []):
+                    message.audiences.append(MessageAudience(audience_type='department', target_id=department_id))
+            return count_audience(audience)
+
+        # إنشاء المستلمين والإشعارات في قاعدة البيانات في نفس المعاملة
+        return fan_out_message(message, audience, recipient_type,
+                               notification_link=url_for('view_message', id=message.id))
+
+    # تعيين المستلم للتوافق مع الإصدارات السابقة
+    if recipient_type == 'user' and recipients:
+        message.recipient_id = recipients[0].id
+
+    # إضافة المستلمين إلى الرسالة
+    sender_name = message.sender.username if message.sender else ''
+    for recipient in recipients:
+        message_recipient = MessageRecipient(
+            message_id=message.id,
+            recipient_id=recipient.id,
+            recipient_type=recipient_type,
+            status='new'
+        )
+        db.session.add(message_recipient)
+
+        # إنشاء إشعار للمستلم
+        if recipient.notifications_enabled:
+            # تخصيص الإشعار حسب أولوية الرسالة
+            title, icon, color = message_notification_style(message.priority)
+
+            create_notification(
+                recipient.id,
+                title,
+                f'لديك رسالة جديدة من {sender_name}: {message.subject}',
+                icon,
+                color,
+                url_for('view_message', id=message.id)
+            )
+
+    return len(recipients)
+
+def next_scheduled_send_at():
+    """أقرب موعد إرسال مجدول (من فهرس قائمة الإرسال)، أو None"""
+    return db.session.query(func.min(ScheduledSend.send_at))\
+        .filter(ScheduledSend.attempts < app.config['SCHEDULED_SEND_MAX_ATTEMPTS'])\
+        .scalar()
+
+def release_scheduled_sends(now=None):
+    """إرسال الرسائل المجدولة التي حان موعدها على دفعات؛ يعاد عدد الرسائل المرسلة
+
+    كل رسالة ترسل في معاملة مستقلة عبر مسار التوسيع الجماعي (INSERT ... SELECT)،
+    فلا تؤخر رسالة كبيرة أو فاشلة بقية الدفعة. قبل الإرسال تحجز الرسالة بتأجيل موعدها
+    مشروطًا بموعدها المقروء، فلا ترسلها عمليتا جدولة مرتين، وإذا توقفت العملية أثناء
+    الإرسال يعاد المحاولة بعد انتهاء الحجز. بعد SCHEDULED_SEND_MAX_ATTEMPTS محاولة
+    فاشلة تبقى الرسالة مجدولة دون إرسال ويتم إشعار المرسل.
+    """
+    now = now or datetime.now()
+    batch_size = app.config['SCHEDULED_SEND_BATCH_SIZE']
+    max_attempts = app.config['SCHEDULED_SEND_MAX_ATTEMPTS']
+    lease_until = now + timedelta(seconds=app.config['SCHEDULED_SEND_RETRY_DELAY'])
+    released = 0
+
+    while True:
+        due = db.session.query(ScheduledSend.message_id, ScheduledSend.send_at)\
+            .filter(ScheduledSend.send_at <= now, ScheduledSend.attempts < max_attempts)\
+            .order_by(ScheduledSend.send_at, ScheduledSend.message_id)\
+            .limit(batch_size)\
+            .all()
+        if not due:
+            break
+
+        for message_id, send_at in due:
+            # حجز الرسالة؛ إذا تغير موعدها فقد حجزتها عملية أخرى
+            claimed = db.session.execute(
+                update(ScheduledSend)
+                .where(ScheduledSend.message_id == message_id, ScheduledSend.send_at == send_at)
+                .values(send_at=lease_until, attempts=ScheduledSend.attempts + 1)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            db.session.commit()
+            if claimed != 1:
+                continue
+
+            message = db.session.get(Message, message_id)
+            try:
+                sender_department_id = db.session.query(User.department_id)\
+                    .filter(User.id == message.sender_id).scalar()
+                assign_registry_number(message, sender_department_id)
+                delivery = json.loads(message.scheduled_send.delivery)
+                recipients, audience = resolve_delivery(message.sender_id, message.recipient_type, delivery)
+                message.date = datetime.utcnow()
+                count = deliver_message(message, message.recipient_type, delivery, recipients, audience)
+                message.scheduled_send = None
+                db.session.commit()
+                released += 1
+                app.logger.info(f'تم إرسال الرسالة المجدولة {message_id} إلى {count} مستلم')
+            except Exception as e:
+                # الرسالة الفاشلة تبقى محجوزة حتى موعد المحاولة التالية فلا تعيق بقية القائمة
+                db.session.rollback()
+                app.logger.error(f'تعذر إرسال الرسالة المجدولة {message_id}: {str(e)}')
+                attempts = db.session.query(ScheduledSend.attempts)\
+                    .filter(ScheduledSend.message_id == message_id).scalar()
+                if attempts is not None and attempts >= max_attempts:
+                    create_notification(
+                        message.sender_id,
+                        'تعذر إرسال رسالة مجدولة',
+                        f'تعذر إرسال الرسالة المجدولة "{message.subject}" بعد {attempts} محاولات',
+                        'fa-exclamation-triangle',
+                        'danger',
+                        url_for('view_message', id=message_id)
+                    )
+                    db.session.commit()
+
+        if len(due) < batch_size:
+            break
+
+    return released
+
+# محرك التصعيد حسب تاريخ الاستحقاق
+# يعمل من عملية الجدولة (scheduler.py). لكل مستوى نافذة من تواريخ الاستحقاق تقرأ عبر الفهرس
+# (due_date, status)، وتستبعد العناصر التي سبق تصعيدها بنفس المستوى، فتتناسب كلفة كل تشغيل
+# مع عدد العناصر التي تغيرت حالتها لا مع حجم الجداول
+ESCALATION_TITLES = MappingProxyType({
+    'due_soon': ('تذكير بموعد الاستحقاق', 'fa-clock', 'info'),
+    'overdue': ('رسالة متأخرة', 'fa-exclamation-circle', 'warning'),
+    'manager': ('تصعيد رسالة متأخرة', 'fa-exclamation-triangle', 'danger'),
+})
+
+def escalation_windows(today):
+    """نوافذ تواريخ الاستحقاق لكل مستوى تصعيد: (المستوى، من، إلى)"""
+    lookback = today - timedelta(days=app.config['ESCALATION_LOOKBACK_DAYS'])
+    return (
+        ('due_soon', today, today + timedelta(days=app.config['ESCALATION_DUE_SOON_DAYS'])),
+        ('overdue', lookback, today - timedelta(days=1)),
+        ('manager', lookback, today - timedelta(days=app.config['ESCALATION_MANAGER_DAYS'])),
+    )
+
+def _escalation_exclusions(model):
+    """شروط إضافية: الرسائل المجدولة التي لم ترسل بعد لا تصعد"""
+    if model is Message:
+        return (~select(ScheduledSend.message_id).where(ScheduledSend.message_id == Message.id).exists(),)
+    return ()
+
+def _escalation_candidates(model, item_type, level, start, end, done_statuses, limit):
+    """العناصر المفتوحة في نافذة الاستحقاق التي لم تصعد بعد بهذا المستوى"""
+    escalated = select(DueDateEscalation.id)\
+        .where(DueDateEscalation.item_type == item_type,
+               DueDateEscalation.item_id == model.id,
+               DueDateEscalation.level == level)\
+        .exists()
+    return db.session.execute(
+        select(model.id, model.due_date)
+        .where(model.due_date >= start, model.due_date <= end,
+               model.status.notin_(done_statuses), model.is_archived.isnot(True), ~escalated,
+               *_escalation_exclusions(model))
+        .order_by(model.due_date, model.id)
+        .limit(limit)
+    ).all()
+
+def _raise_priority(model, ids, level):
+    """رفع أولوية العناصر درجة واحدة (أو إلى هام جداً عند التصعيد للمدير)"""
+    table = model.__table__
+    if level == 'manager':
+        db.session.execute(table.update().where(table.c.id.in_(ids)).values(priority='very_urgent'))
+        return
+    db.session.execute(table.update().where(table.c.id.in_(ids), table.c.priority == 'urgent')
+                       .values(priority='very_urgent'))
+    db.session.execute(table.update().where(table.c.id.in_(ids), or_(table.c.priority.is_(None), table.c.priority == 'normal'))
+                       .values(priority='urgent'))
+
+def _open_message_recipients(message_ids):
+    """أزواج (الرسالة، المستلم) التي لم ينجزها أو يؤرشفها المستلم بعد
+    (مستلمو التعاميم الذين لم يتفاعلوا معها لا يخطرون؛ يخطر المرسل فقط)"""
+    legacy = select(Message.id, Message.recipient_id)\
+        .where(Message.id.in_(message_ids), Message.is_multi_recipient.isnot(True), Message.recipient_id.isnot(None),
+               Message.status.notin_(MESSAGE_DONE_STATUSES), Message.is_archived.isnot(True))
+    multi = select(MessageRecipient.message_id, MessageRecipient.recipient_id)\
+        .join(Message, Message.id == MessageRecipient.message_id)\
+        .where(MessageRecipient.message_id.in_(message_ids), Message.is_multi_recipient == True,
+               MessageRecipient.status.notin_(MESSAGE_DONE_STATUSES), MessageRecipient.is_archived.isnot(True))
+    return db.session.execute(union_all(legacy, multi)).all()
+
+def _department_managers(user_ids):
+    """مدراء أقسام المستخدمين: {user_id: [manager_id, ...]}"""
+    manager = db.aliased(User)
+    rows = db.session.query(User.id, manager.id)\
+        .join(manager, and_(manager.department_id == User.department_id, manager.id != User.id))\
+        .join(Role, Role.id == manager.role_id)\
+        .filter(User.id.in_(user_ids), User.department_id.isnot(None),
+                Role.name == app.config['ESCALATION_MANAGER_ROLE'], manager.is_active == True)\
+        .all()
+    managers = {}
+    for user_id, manager_id in rows:
+        managers.setdefault(user_id, []).append(manager_id)
+    return managers
+
+def _insert_escalation_notifications(targets, level):
+    """إدراج إشعارات التصعيد دفعة واحدة. targets: [(user_id, content, link)]"""
+    if not targets:
+        return 0
+    enabled = {user_id for (user_id,) in db.session.execute(
+        select(User.id).where(User.id.in_({user_id for user_id, _, _ in targets}),
+                              User.notifications_enabled.isnot(False), User.is_active == True)
+    )}
+    title, icon, color = ESCALATION_TITLES[level]
+    now = datetime.now()
+    rows = [
+        {'user_id': user_id, 'title': title, 'content': content, 'icon': icon, 'color': color,
+         'created_at': now, 'is_read': False, 'link': link}
+        for user_id, content, link in dict.fromkeys(targets) if user_id in enabled
+    ]
+    if rows:
+        db.session.execute(insert(Notification), rows)
+    return len(rows)
+
+def escalate_messages(level, items):
+    """تنفيذ تصعيد دفعة من الرسائل: رفع الأولوية وإخطار المستلمين أو المرسل أو المدراء"""
+    message_ids = [item_id for item_id, _ in items]
+    if level != 'due_soon':
+        _raise_priority(Message, message_ids, level)
+
+    messages = db.session.execute(
+        select(Message.id, Message.sender_id, Message.subject).where(Message.id.in_(message_ids))
+    ).all()
+    subjects = {message_id: subject for message_id, _, subject in messages}
+    recipients = _open_message_recipients(message_ids)
+    notified = dict.fromkeys(message_ids, 0)
+
+    targets = []
+    if level == 'manager':
+        managers = _department_managers({recipient_id for _, recipient_id in recipients})
+        for message_id, recipient_id in recipients:
+            targets += [(manager_id, message_id) for manager_id in managers.get(recipient_id, ())]
+    else:
+        targets += [(recipient_id, message_id) for message_id, recipient_id in recipients]
+    if level != 'due_soon':
+        targets += [(sender_id, message_id) for message_id, sender_id, _ in messages if sender_id]
+
+    rows = []
+    for user_id, message_id in dict.fromkeys(targets):
+        rows.append((user_id, f'{ESCALATION_TITLES[level][0]}: {subjects[message_id]}',
+                     url_for('view_message', id=message_id)))
+        notified[message_id] += 1
+    _insert_escalation_notifications(rows, level)
+
+    for message_id in message_ids:
+        fragment_cache.invalidate('message_row', message_id)
+    return notified
+
+def escalate_personal_mail(level, items):
+    """تنفيذ تصعيد دفعة من البريد الشخصي: رفع الأولوية وإخطار المالك"""
+    mail_ids = [item_id for item_id, _ in items]
+    if level != 'due_soon':
+        _raise_priority(PersonalMail, mail_ids, level)
+
+    rows = db.session.execute(
+        select(PersonalMail.id, PersonalMail.user_id, PersonalMail.title).where(PersonalMail.id.in_(mail_ids))
+    ).all()
+    _insert_escalation_notifications(
+        [(user_id, f'{ESCALATION_TITLES[level][0]}: {title}', url_for('view_personal_mail', id=mail_id))
+         for mail_id, user_id, title in rows],
+        level
+    )
+    return {mail_id: 1 for mail_id, _, _ in rows}
+
+def run_escalations(today=None):
+    """تشغيل واحد لمحرك التصعيد؛ يعاد عدد العناصر المصعدة لكل نوع ومستوى"""
+    today = today or datetime.now().date()
+    batch_size = app.config['ESCALATION_BATCH_SIZE']
+    sources = (
+        ('message', Message, MESSAGE_DONE_STATUSES, escalate_messages),
+        ('personal_mail', PersonalMail, PERSONAL_MAIL_DONE_STATUSES, escalate_personal_mail),
+    )
+
+    result = {}
+    for level, start, end in escalation_windows(today):
+        if start > end:
+            continue
+        for item_type, model, done_statuses, escalate in sources:
+            if item_type == 'personal_mail' and level == 'manager':
+                continue
+            while True:
+                items = _escalation_candidates(model, item_type, level, start, end, done_statuses, batch_size)
+                if not items:
+                    break
+                try:
+                    # تسجيل التصعيد في نفس معاملة الإشعارات: القيد الفريد يمنع تكراره إذا عملت عمليتا جدولة معًا
+                    notified = escalate(level, items)
+                    db.session.execute(insert(DueDateEscalation), [
+                        {'item_type': item_type, 'item_id': item_id, 'level': level, 'due_date': due_date,
+                         'escalated_at': datetime.now(), 'notified': notified.get(item_id, 0)}
+                        for item_id, due_date in items
+                    ])
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    raise
+                key = f'{item_type}_{level}'
+                result[key] = result.get(key, 0) + len(items)
+                if len(items) < batch_size:
+                    break
+    return result
+
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
@@ -905,6 +4388,7 @@ def login():
                     status='success'
                 )
                 db.session.add(login_log)
+                user.last_login_at = login_log.login_date = datetime.now()
                 db.session.commit()
 
                 login_user(user, remember=remember)
@@ -977,110 +4461,41 @@ def dashboard():
         .filter_by(recipient_id=current_user.id, is_archived=True)\
         .count()
 
+    # التعاميم التي لم يتفاعل معها المستخدم بعد (تظهر في الوارد دون صف حالة)
+    pending_broadcasts = pending_broadcasts_query(current_user.id)
+    broadcast_pending_count = pending_broadcasts.count()
+
     # الرسائل المرسلة
     sent_messages_count = Message.query.filter_by(sender_id=current_user.id).count()
 
     # إجمالي الإحصائيات
     stats = {
-        'total_messages': legacy_messages_count + multi_messages_count,
-        'inbox_messages': legacy_inbox_count + multi_inbox_count,
+        'total_messages': legacy_messages_count + multi_messages_count + broadcast_pending_count,
+        'inbox_messages': legacy_inbox_count + multi_inbox_count + broadcast_pending_count,
         'sent_messages': sent_messages_count,
         'archived_messages': legacy_archived_count + multi_archived_count
     }
 
-    # الحصول على الرسائل الحديثة
-
-    # الرسائل الحديثة (الإصدار القديم)
-    legacy_recent_messages = Message.query.filter_by(
-        recipient_id=current_user.id,
-        is_archived=False
-    ).order_by(Message.date.desc()).limit(5).all()
-
-    # الرسائل الحديثة (الإصدار الجديد - متعدد المستلمين)
-    multi_recipient_messages_ids = db.session.query(MessageRecipient.message_id)\
-        .filter_by(recipient_id=current_user.id, is_archived=False)\
-        .join(Message, Message.id == MessageRecipient.message_id)\
-        .order_by(Message.date.desc())\
-        .limit(5)\
-        .all()
-
-    multi_recipient_messages_ids = [r[0] for r in multi_recipient_messages_ids]
-    multi_recent_messages = Message.query.filter(Message.id.in_(multi_recipient_messages_ids))\
-        .order_by(Message.date.desc())\
-        .all()
+    # الرسائل الحديثة (أحدث 5 رسائل من جميع المصادر مع حالتها للمستخدم)
+    recent_messages = mailbox_rows(current_user.id, limit=5)
 
-    # دمج الرسائل وترتيبها حسب التاريخ
-    all_recent_messages = legacy_recent_messages + multi_recent_messages
-    all_recent_messages.sort(key=lambda x: x.date, reverse=True)
-    recent_messages = all_recent_messages[:5]  # أخذ أحدث 5 رسائل فقط
+    # إصدار جزء الرسائل الحديثة في الذاكرة المؤقتة (يتغير بتغير الرسائل أو حالاتها)
+    recent_version = ','.join(f'{m.id}:{m.status_text}' for m in recent_messages)
 
-    # إضافة معلومات الحالة للرسائل
-    for message in recent_messages:
-        if message.is_multi_recipient:
-            # الحصول على حالة الرسالة للمستخدم الحالي
-            recipient_data = MessageRecipient.query.filter_by(
-                message_id=message.id,
-                recipient_id=current_user.id
-            ).first()
-
-            if recipient_data:
-                message.status_color = recipient_data.get_status_color()
-                message.status_text = recipient_data.get_status_display()
-            else:
-                message.status_color = 'secondary'
-                message.status_text = 'غير معروف'
-        else:
-            message.status_color = message.get_status_color()
-            message.status_text = message.get_status_display()
-
-    return render_template('dashboard.html', stats=stats, recent_messages=recent_messages)
+    return render_template('dashboard.html', stats=stats, recent_messages=recent_messages, recent_version=recent_version)
 
 @app.route('/inbox')
 @login_required
 def inbox():
-    # الرسائل من الإصدار القديم
-    legacy_messages = Message.query.filter_by(
-        recipient_id=current_user.id,
-        is_archived=False
-    ).order_by(Message.date.desc()).all()
+    # الرسائل القديمة وصفوف المستلمين والتعاميم المعلقة مع حالتها للمستخدم (صفوف عرض خفيفة)
+    all_messages = mailbox_rows(current_user.id)
 
-    # الرسائل من الإصدار الجديد (متعدد المستلمين)
-    multi_recipient_messages_ids = db.session.query(MessageRecipient.message_id)\
-        .filter_by(recipient_id=current_user.id, is_archived=False)\
-        .all()
-
-    multi_recipient_messages_ids = [r[0] for r in multi_recipient_messages_ids]
-    multi_recipient_messages = Message.query.filter(Message.id.in_(multi_recipient_messages_ids))\
-        .order_by(Message.date.desc())\
-        .all()
+    # طي المحادثات: عرض أحدث رسالة في كل محادثة مع عدد رسائلها في الصندوق
+    collapse_threads = request.args.get('collapse') == 'thread'
+    if collapse_threads:
+        all_messages = collapse_by_thread(all_messages)
 
-    # دمج الرسائل وترتيبها حسب التاريخ
-    all_messages = legacy_messages + multi_recipient_messages
-    all_messages.sort(key=lambda x: x.date, reverse=True)
-
-    # إضافة معلومات الحالة للرسائل
-    for message in all_messages:
-        if message.is_multi_recipient:
-            # الحصول على حالة الرسالة للمستخدم الحالي
-            recipient_data = MessageRecipient.query.filter_by(
-                message_id=message.id,
-                recipient_id=current_user.id
-            ).first()
-
-            if recipient_data:
-                message.status_color = recipient_data.get_status_color()
-                message.status_text = recipient_data.get_status_display()
-                message.recipient_status = recipient_data.status
-            else:
-                message.status_color = 'secondary'
-                message.status_text = 'غير معروف'
-                message.recipient_status = 'unknown'
-        else:
-            message.status_color = message.get_status_color()
-            message.status_text = message.get_status_display()
-            message.recipient_status = message.status
-
-    return render_template('inbox.html', messages=all_messages)
+    return render_template('inbox.html', messages=all_messages, collapse_threads=collapse_threads)
 
 @app.route('/outbox')
 @login_required
@@ -1093,10 +4508,13 @@ def outbox():
     # إضافة معلومات المستلمين للرسائل متعددة المستلمين
     for message in messages:
         if message.is_multi_recipient:
-            # الحصول على عدد المستلمين
-            recipients_count = MessageRecipient.query.filter_by(
-                message_id=message.id
-            ).count()
+            # الحصول على عدد المستلمين (حجم الجمهور للتعاميم)
+            if message.is_broadcast:
+                recipients_count = count_audience(message.get_audience_users())
+            else:
+                recipients_count = MessageRecipient.query.filter_by(
+                    message_id=message.id
+                ).count()
 
             # الحصول على عدد المستلمين الذين قرأوا الرسالة
             read_count = MessageRecipient.query.filter(
@@ -1108,7 +4526,7 @@ def outbox():
             message.recipients_count = recipients_count
             message.read_count = read_count
 
-            # الحصول على قائمة المستلمين
+            # الحصول على قائمة المستلمين (في التعاميم: من تفاعل فقط)
             recipients_data = MessageRecipient.query.filter_by(
                 message_id=message.id
             ).all()
@@ -1126,52 +4544,13 @@ def outbox():
 
             message.recipients_list = recipients_list
 
-    return render_template('outbox.html', messages=messages)
-
-@app.route('/archive')
-@login_required
-def archive():
-    # الرسائل من الإصدار القديم
-    legacy_messages = Message.query.filter_by(
-        recipient_id=current_user.id,
-        is_archived=True
-    ).order_by(Message.date.desc()).all()
-
-    # الرسائل من الإصدار الجديد (متعدد المستلمين)
-    multi_recipient_messages_ids = db.session.query(MessageRecipient.message_id)\
-        .filter_by(recipient_id=current_user.id, is_archived=True)\
-        .all()
-
-    multi_recipient_messages_ids = [r[0] for r in multi_recipient_messages_ids]
-    multi_recipient_messages = Message.query.filter(Message.id.in_(multi_recipient_messages_ids))\
-        .order_by(Message.date.desc())\
-        .all()
-
-    # دمج الرسائل وترتيبها حسب التاريخ
-    all_messages = legacy_messages + multi_recipient_messages
-    all_messages.sort(key=lambda x: x.date, reverse=True)
-
-    # إضافة معلومات الحالة للرسائل
-    for message in all_messages:
-        if message.is_multi_recipient:
-            # الحصول على حالة الرسالة للمستخدم الحالي
-            recipient_data = MessageRecipient.query.filter_by(
-                message_id=message.id,
-                recipient_id=current_user.id
-            ).first()
-
-            if recipient_data:
-                message.status_color = recipient_data.get_status_color()
-                message.status_text = recipient_data.get_status_display()
-                message.recipient_status = recipient_data.status
-            else:
-                message.status_color = 'secondary'
-                message.status_text = 'غير معروف'
-                message.recipient_status = 'unknown'
-        else:
-            message.status_color = message.get_status_color()
-            message.status_text = message.get_status_display()
-            message.recipient_status = message.status
+    return render_template('outbox.html', messages=messages)
+
+@app.route('/archive')
+@login_required
+def archive():
+    # الرسائل المؤرشفة (القديمة وصفوف المستلمين) كصفوف عرض خفيفة
+    all_messages = mailbox_rows(current_user.id, archived=True)
 
     return render_template('archive.html', messages=all_messages)
 
@@ -1182,11 +4561,29 @@ def users():
         flash('غير مصرح بالوصول', 'danger')
         return redirect(url_for('dashboard'))
 
-    users = User.query.all()
-    departments = Department.query.all()
-    roles = Role.query.all()
+    pagination = query_admin_users(request.args)
+    reference = get_reference_data()
+
+    return render_template('users.html', users=pagination.items, pagination=pagination, filters=request.args,
+                          departments=reference.departments, roles=reference.roles)
+
+@app.route('/api/users')
+@login_required
+def api_admin_users():
+    """واجهة برمجة التطبيقات لقائمة المستخدمين مع التصفية والفرز والتقسيم إلى صفحات"""
+    if not (current_user.has_permission('manage_users') or current_user.has_permission('manage_permissions')):
+        return jsonify({'error': 'غير مصرح بالوصول'}), 403
+
+    pagination = query_admin_users(request.args)
+    reference = get_reference_data()
 
-    return render_template('users.html', users=users, departments=departments, roles=roles)
+    return jsonify({
+        'users': [serialize_admin_user(user, reference) for user in pagination.items],
+        'page': pagination.page,
+        'per_page': pagination.per_page,
+        'pages': pagination.pages,
+        'total': pagination.total
+    })
 
 @app.route('/users/<int:id>/edit', methods=['POST'])
 @login_required
@@ -1219,7 +4616,7 @@ def edit_user(id):
 
         # تحديث القسم
         if department_id:
-            department = Department.query.get(department_id)
+            department = get_reference_data().get_department(department_id)
             if department:
                 user.department_id = department_id
                 user.department_name = department.name  # للتوافق مع الإصدارات السابقة
@@ -1258,7 +4655,7 @@ def add_user():
         # الحصول على اسم القسم إذا تم تحديد قسم
         department_name = None
         if department_id:
-            department = Department.query.get(department_id)
+            department = get_reference_data().get_department(department_id)
             if department:
                 department_name = department.name
 
@@ -1363,8 +4760,8 @@ def departments():
         flash('غير مصرح بالوصول', 'danger')
         return redirect(url_for('dashboard'))
 
-    # الحصول على قائمة الأقسام
-    departments = Department.query.all()
+    # الحصول على قائمة الأقسام مرتبة حسب الهيكل التنظيمي
+    departments = get_reference_data().departments_tree
 
     return render_template('departments.html', departments=departments)
 
@@ -1385,15 +4782,26 @@ def add_department():
             flash('يوجد قسم بهذا الاسم بالفعل', 'danger')
             return redirect(url_for('departments'))
 
-        # إنشاء قسم جديد
+        # القسم الأب (اختياري)
+        parent = None
+        parent_id = request.form.get('parent_id', type=int)
+        if parent_id:
+            parent = Department.query.get(parent_id)
+            if not parent:
+                flash('القسم الأب غير موجود', 'danger')
+                return redirect(url_for('departments'))
+
+        # إنشاء قسم جديد (يحسب مساره بعد الإدراج)
         new_department = Department(
             name=name,
             description=description,
-            is_active=True
+            is_active=True,
+            parent_id=parent.id if parent else None
         )
 
         try:
             db.session.add(new_department)
+            bump_reference_data_version()
             db.session.commit()
             flash('تم إضافة القسم بنجاح', 'success')
         except Exception as e:
@@ -1421,11 +4829,26 @@ def edit_department(id):
             flash('يوجد قسم آخر بهذا الاسم بالفعل', 'danger')
             return redirect(url_for('edit_department', id=id))
 
+        # القسم الأب الجديد (القيمة الفارغة تعني المستوى الأعلى)
+        move = 'parent_id' in request.form
+        parent = None
+        if move and request.form.get('parent_id'):
+            parent_id = request.form.get('parent_id', type=int)
+            parent = Department.query.get(parent_id) if parent_id else None
+            if not parent:
+                flash('القسم الأب غير موجود', 'danger')
+                return redirect(url_for('edit_department', id=id))
+
         # تحديث بيانات القسم
         department.name = name
         department.description = description
 
         try:
+            # نقل القسم في الهيكل التنظيمي إذا تغير القسم الأب
+            if move and (parent.id if parent else None) != department.parent_id:
+                move_department(department, parent)
+
+            bump_reference_data_version()
             db.session.commit()
             flash('تم تحديث القسم بنجاح', 'success')
             return redirect(url_for('departments'))
@@ -1433,7 +4856,8 @@ def edit_department(id):
             db.session.rollback()
             flash(f'حدث خطأ أثناء تحديث القسم: {str(e)}', 'danger')
 
-    return render_template('edit_department.html', department=department)
+    return render_template('edit_department.html', department=department,
+                          departments=get_reference_data().departments_tree)
 
 @app.route('/departments/<int:id>/toggle-status', methods=['POST'])
 @login_required
@@ -1449,6 +4873,7 @@ def toggle_department_status(id):
     status_text = 'تفعيل' if department.is_active else 'تعطيل'
 
     try:
+        bump_reference_data_version()
         db.session.commit()
         flash(f'تم {status_text} القسم بنجاح', 'success')
     except Exception as e:
@@ -1471,8 +4896,14 @@ def delete_department(id):
         flash('لا يمكن حذف القسم لأنه يحتوي على مستخدمين', 'danger')
         return redirect(url_for('departments'))
 
+    # التحقق من عدم وجود أقسام فرعية
+    if department.children.count() > 0:
+        flash('لا يمكن حذف القسم لأنه يحتوي على أقسام فرعية', 'danger')
+        return redirect(url_for('departments'))
+
     try:
         db.session.delete(department)
+        bump_reference_data_version()
         db.session.commit()
         flash('تم حذف القسم بنجاح', 'success')
     except Exception as e:
@@ -1481,6 +4912,23 @@ def delete_department(id):
 
     return redirect(url_for('departments'))
 
+@app.route('/api/departments/<int:id>/report')
+@login_required
+def api_department_report(id):
+    """واجهة برمجة التطبيقات لإحصائيات القسم وجميع أقسامه الفرعية"""
+    if not (current_user.has_permission('manage_departments') or current_user.has_permission('view_reports')):
+        return jsonify({'error': 'غير مصرح بالوصول'}), 403
+
+    department = get_reference_data().get_department(id)
+    if not department:
+        return jsonify({'error': 'القسم غير موجود'}), 404
+
+    date_from = _parse_date_arg(request.args.get('from'))
+    date_to = _parse_date_arg(request.args.get('to'))
+    report = department_subtree_report(id, date_from, date_to + timedelta(days=1) if date_to else None)
+    report['name'] = department.name
+    return jsonify(report)
+
 @app.route('/permissions')
 @login_required
 def permissions():
@@ -1489,7 +4937,7 @@ def permissions():
         return redirect(url_for('dashboard'))
 
     # الحصول على مجموعات الصلاحيات مرتبة حسب الترتيب
-    permission_groups = PermissionGroup.query.order_by(PermissionGroup.order).all()
+    permission_groups = get_reference_data().permission_groups
 
     return render_template('permissions.html', permission_groups=permission_groups)
 
@@ -1500,10 +4948,9 @@ def roles():
         flash('غير مصرح بالوصول', 'danger')
         return redirect(url_for('dashboard'))
 
-    roles = Role.query.all()
-    permissions = Permission.query.all()
+    reference = get_reference_data()
 
-    return render_template('roles.html', roles=roles, permissions=permissions)
+    return render_template('roles.html', roles=reference.roles, permissions=reference.permissions)
 
 @app.route('/roles/add', methods=['POST'])
 @login_required
@@ -1537,6 +4984,7 @@ def add_role():
 
         try:
             db.session.add(new_role)
+            bump_reference_data_version()
             db.session.commit()
             flash('تم إضافة الدور بنجاح', 'success')
         except Exception as e:
@@ -1579,6 +5027,7 @@ def edit_role(id):
         role.permissions = permissions
 
         try:
+            bump_reference_data_version()
             db.session.commit()
             flash('تم تحديث الدور بنجاح', 'success')
             return redirect(url_for('roles'))
@@ -1618,6 +5067,7 @@ def delete_role(id):
 
     try:
         db.session.delete(role)
+        bump_reference_data_version()
         db.session.commit()
         flash('تم حذف الدور بنجاح', 'success')
     except Exception as e:
@@ -1634,17 +5084,40 @@ def user_permissions():
         flash('غير مصرح بالوصول لإدارة الصلاحيات', 'danger')
         return redirect(url_for('dashboard'))
 
-    # الحصول على قائمة المستخدمين
-    users = User.query.all()
-    roles = Role.query.all()
+    # الحصول على صفحة من قائمة المستخدمين
+    pagination = query_admin_users(request.args)
+    reference = get_reference_data()
+    roles = reference.roles
 
     # الحصول على مجموعات الصلاحيات مرتبة حسب الترتيب
-    permission_groups = PermissionGroup.query.order_by(PermissionGroup.order).all()
+    permission_groups = reference.permission_groups
 
     # الحصول على سجل تغييرات الصلاحيات (آخر 10 تغييرات)
     recent_changes = PermissionChange.query.order_by(PermissionChange.change_date.desc()).limit(10).all()
 
-    return render_template('user_permissions.html', users=users, roles=roles, permission_groups=permission_groups, recent_changes=recent_changes)
+    return render_template('user_permissions.html', users=pagination.items, pagination=pagination, filters=request.args,
+                          roles=roles, permission_groups=permission_groups, recent_changes=recent_changes)
+
+@app.route('/api/permissions/<permission_name>/users')
+@login_required
+def api_permission_users(permission_name):
+    """واجهة برمجة التطبيقات للحصول على المستخدمين الذين يملكون صلاحية معينة"""
+    if not current_user.has_permission('manage_permissions'):
+        return jsonify({'error': 'غير مصرح بالوصول'}), 403
+
+    permission = get_reference_data().permissions_by_name.get(permission_name)
+    if not permission:
+        return jsonify({'error': 'الصلاحية غير موجودة'}), 404
+
+    include_inactive = request.args.get('include_inactive', '0') == '1'
+    user_ids = users_with_permission(permission_name, active_only=not include_inactive)
+
+    return jsonify({
+        'permission': permission.name,
+        'display_name': permission.get_display_name(),
+        'user_ids': user_ids,
+        'count': len(user_ids)
+    })
 
 @app.route('/permission-changes')
 @login_required
@@ -1726,7 +5199,7 @@ def update_user_permissions(id):
     if 'role_id' in data:
         role_id = data.get('role_id')
         if role_id:
-            role = Role.query.get(role_id)
+            role = get_reference_data().get_role(role_id)
             if role:
                 old_role_id = user.role_id
                 user.role_id = role_id
@@ -1754,7 +5227,7 @@ def update_user_permissions(id):
     if 'permission_id' in data:
         permission_id = data.get('permission_id')
         if permission_id:
-            permission = Permission.query.get(permission_id)
+            permission = get_reference_data().get_permission(permission_id)
             if permission:
                 # إنشاء سجل إضافة الصلاحية
                 permission_change = PermissionChange(
@@ -1818,7 +5291,8 @@ def update_user_permissions(id):
 @app.route('/message/<int:id>')
 @login_required
 def view_message(id):
-    message = Message.query.get_or_404(id)
+    # نص الرسالة يحمل مع الترويسة في نفس الاستعلام (الصفحة الوحيدة التي تعرضه كاملًا)
+    message = Message.query.options(db.joinedload(Message.body)).get_or_404(id)
 
     # التحقق من صلاحية الوصول
     has_access = False
@@ -1831,40 +5305,39 @@ def view_message(id):
     elif message.recipient_id == current_user.id:
         has_access = True
 
-        # تحديث حالة الرسالة إذا كانت جديدة
+        # تسجيل القراءة في المخزن المؤقت (تحفظ على دفعات دون معاملة كتابة في هذا الطلب)
         if message.status == 'new':
-            message.change_status('read', current_user.id, 'تم قراءة الرسالة')
-            db.session.commit()
+            read_receipts.record(message.id, current_user.id)
 
     # التحقق من المستلمين المتعددين
     elif message.is_multi_recipient:
-        # البحث عن المستخدم في قائمة المستلمين
-        recipient_data = MessageRecipient.query.filter_by(
-            message_id=message.id,
-            recipient_id=current_user.id
-        ).first()
+        # البحث عن المستخدم في قائمة المستلمين (أو في جمهور التعميم؛ صف الحالة ينشأ عند حفظ القراءة)
+        recipient_data = message.get_recipient_state(current_user)
 
         if recipient_data:
             has_access = True
 
-            # تحديث حالة الرسالة إذا كانت جديدة
             if recipient_data.status == 'new':
-                message.change_status('read', current_user.id, 'تم قراءة الرسالة', current_user.id)
-
-                # تحديث تاريخ القراءة
-                recipient_data.read_at = datetime.now()
-                db.session.commit()
+                read_receipts.record(message.id, current_user.id)
 
     if not has_access:
         flash('غير مصرح بالوصول إلى هذه الرسالة', 'danger')
         return redirect(url_for('inbox'))
 
+    # حفظ HTML المعاد تحويله إذا كان من إصدار أقدم للمحول
+    if message.body and message.body.ensure_html():
+        db.session.commit()
+
     # إضافة متغير التاريخ الحالي لحساب الأيام المتبقية للاستحقاق
     now = datetime.now()
 
     # الحصول على معلومات المستلمين إذا كانت الرسالة متعددة المستلمين
     recipients_info = None
+    audience_size = None
     if message.is_multi_recipient:
+        # في التعاميم تعرض صفوف من تفاعل فقط مع حجم الجمهور الكلي
+        if message.is_broadcast and message.sender_id == current_user.id:
+            audience_size = count_audience(message.get_audience_users())
         recipients_data = MessageRecipient.query.filter_by(message_id=message.id).all()
         recipients_info = []
 
@@ -1882,7 +5355,155 @@ def view_message(id):
                     'read_at': r_data.read_at
                 })
 
-    return render_template('view_message.html', message=message, now=now, recipients_info=recipients_info)
+    return render_template('view_message.html', message=message, now=now, recipients_info=recipients_info,
+                          audience_size=audience_size, content_html=message.content_html)
+
+def get_forwardable_attachments(message_id, attachment_ids=()):
+    """مرفقات رسالة يحق للمستخدم الحالي تحويلها (جميعها أو المحددة فقط)
+
+    يعاد None إذا لم يكن للمستخدم حق الوصول إلى الرسالة.
+    """
+    if not message_id:
+        return []
+    source = db.session.get(Message, message_id)
+    if not source or not source.can_be_viewed_by(current_user):
+        return None
+    attachments = source.attachments
+    attachment_ids = _int_list(attachment_ids)
+    if attachment_ids:
+        attachments = attachments.filter(Attachment.id.in_(attachment_ids))
+    return attachments.all()
+
+@app.route('/message/<int:id>/forward')
+@login_required
+def forward_message(id):
+    """تحويل رسالة: صفحة إنشاء رسالة معبأة بمحتوى الرسالة الأصلية ومرفقاتها"""
+    original_message = Message.query.get_or_404(id)
+
+    if not original_message.can_be_viewed_by(current_user):
+        flash('غير مصرح بالوصول إلى هذه الرسالة', 'danger')
+        return redirect(url_for('inbox'))
+
+    sender_name = (original_message.sender.full_name or original_message.sender.username) if original_message.sender else ''
+    forward_content = (
+        "\n\n---------- رسالة محولة ----------\n"
+        f"من: {sender_name}\n"
+        f"التاريخ: {original_message.date.strftime('%Y-%m-%d %H:%M') if original_message.date else ''}\n"
+        f"الموضوع: {original_message.subject}\n\n"
+        f"{original_message.content}"
+    )
+
+    groups = UserGroup.query.filter(
+        (UserGroup.is_public == True) |
+        (UserGroup.created_by_id == current_user.id) |
+        (UserGroup.id.in_([m.group_id for m in current_user.group_memberships]))
+    ).all()
+    favorites = FavoriteUser.query.filter_by(user_id=current_user.id).all()
+
+    return render_template('create_message.html', groups=groups, favorites=favorites,
+                          departments=get_reference_data().departments_tree,
+                          recipient_search_url=url_for('api_search_recipients'),
+                          forward_message=original_message,
+                          forward_attachments=original_message.attachments.all(),
+                          forward_subject=f"تحويل: {original_message.subject}",
+                          forward_content=forward_content)
+
+def collapse_by_thread(rows):
+    """إبقاء أحدث صف من كل محادثة مع عدد رسائلها (الصفوف مرتبة تنازليًا حسب التاريخ)"""
+    latest = OrderedDict()
+    counts = {}
+    for row in rows:
+        thread_key = row.thread_id or row.id
+        counts[thread_key] = counts.get(thread_key, 0) + 1
+        latest.setdefault(thread_key, row)
+    return [row._replace(thread_count=counts[thread_key]) for thread_key, row in latest.items()]
+
+def load_thread(thread_id, user):
+    """تحميل رسائل المحادثة التي يحق للمستخدم رؤيتها مع مرسليها وحالتها له في استعلام واحد مرتب
+
+    يعاد قائمة بالرسائل مع الخصائص: sender_user و recipient_status و status_text و status_color و is_own.
+    """
+    sender = db.aliased(User)
+    state = db.aliased(MessageRecipient)
+    rows = db.session.query(Message, sender, state)\
+        .outerjoin(sender, sender.id == Message.sender_id)\
+        .outerjoin(state, and_(state.message_id == Message.id, state.recipient_id == user.id))\
+        .filter(Message.thread_id == thread_id)\
+        .filter(or_(
+            Message.sender_id == user.id,
+            Message.recipient_id == user.id,
+            state.id.isnot(None),
+            Message.delivery_mode == 'broadcast'
+        ))\
+        .order_by(Message.date, Message.id)\
+        .all()
+
+    messages = []
+    for message, message_sender, recipient_data in rows:
+        message.is_own = message.sender_id == user.id
+        if message.is_own:
+            message.recipient_status = None
+            message.status_text = 'مرسلة'
+            message.status_color = 'secondary'
+        elif recipient_data:
+            message.recipient_status = recipient_data.status
+            message.status_text = recipient_data.get_status_display()
+            message.status_color = recipient_data.get_status_color()
+        elif message.recipient_id == user.id:
+            message.recipient_status = message.status
+            message.status_text = message.get_status_display()
+            message.status_color = message.get_status_color()
+        elif message.is_in_audience(user):
+            # تعميم لم يتفاعل معه المستخدم بعد
+            message.recipient_status = 'new'
+            message.status_text = 'جديد'
+            message.status_color = 'primary'
+        else:
+            continue
+        message.sender_user = message_sender
+        messages.append(message)
+    return messages
+
+@app.route('/message/<int:id>/thread')
+@login_required
+def view_thread(id):
+    """عرض المحادثة كاملة التي تنتمي إليها الرسالة"""
+    message = Message.query.get_or_404(id)
+    messages = load_thread(message.thread_id or message.id, current_user)
+
+    # يجب أن تكون الرسالة المطلوبة نفسها ضمن ما يحق للمستخدم رؤيته
+    if not any(m.id == message.id for m in messages):
+        flash('غير مصرح بالوصول إلى هذه الرسالة', 'danger')
+        return redirect(url_for('inbox'))
+
+    return render_template('message_thread.html', message=message, messages=messages, now=datetime.now())
+
+@app.route('/api/message/<int:id>/thread')
+@login_required
+def api_message_thread(id):
+    """واجهة برمجة التطبيقات لرسائل المحادثة"""
+    message = Message.query.get_or_404(id)
+    messages = load_thread(message.thread_id or message.id, current_user)
+
+    if not any(m.id == message.id for m in messages):
+        return jsonify({'error': 'غير مصرح بالوصول'}), 403
+
+    return jsonify({
+        'thread_id': message.thread_id or message.id,
+        'messages': [{
+            'id': m.id,
+            'parent_id': m.parent_id,
+            'subject': m.subject,
+            'date': m.date.strftime('%Y-%m-%d %H:%M') if m.date else None,
+            'sender': (m.sender_user.full_name or m.sender_user.username) if m.sender_user else None,
+            'is_own': m.is_own,
+            'status': m.recipient_status,
+            'status_display': m.status_text,
+            'status_color': m.status_color,
+            'has_attachments': m.has_attachments,
+            'url': url_for('view_message', id=m.id)
+        } for m in messages]
+    })
 
 @app.route('/message/create', methods=['GET', 'POST'])
 @login_required
@@ -1891,12 +5512,12 @@ def create_message():
         subject = request.form.get('subject')
         content = request.form.get('content')
         include_signature = 'include_signature' in request.form
-        recipient_type = request.form.get('recipient_type', 'user')
+        recipient_type = RecipientType.coerce(request.form.get('recipient_type'), 'user')
 
         # الحقول الجديدة
-        priority = request.form.get('priority', 'normal')
-        message_type = request.form.get('message_type')
-        confidentiality = request.form.get('confidentiality', 'normal')
+        priority = MessagePriority.coerce(request.form.get('priority'), 'normal')
+        message_type = MessageType.coerce(request.form.get('message_type'))
+        confidentiality = MessageConfidentiality.coerce(request.form.get('confidentiality'), 'normal')
         reference_number = request.form.get('reference_number')
         due_date_str = request.form.get('due_date')
 
@@ -1909,6 +5530,18 @@ def create_message():
                 flash('صيغة تاريخ الاستحقاق غير صحيحة', 'danger')
                 return redirect(url_for('create_message'))
 
+        # بيانات الخطاب الوارد (الجهة المرسلة وتاريخ الخطاب)
+        sender_entity = None
+        document_date = None
+        if message_type == 'incoming':
+            sender_entity = request.form.get('sender_entity') or None
+            if request.form.get('document_date'):
+                try:
+                    document_date = datetime.strptime(request.form.get('document_date'), '%Y-%m-%d').date()
+                except ValueError:
+                    flash('صيغة تاريخ الخطاب غير صحيحة', 'danger')
+                    return redirect(url_for('create_message'))
+
         # إضافة التوقيع النصي إلى المحتوى إذا كان مطلوبًا
         if include_signature and current_user.signature:
             content = content + "\n\n--\n" + current_user.signature
@@ -1927,12 +5560,30 @@ def create_message():
             confidentiality=confidentiality,
             reference_number=reference_number,
             due_date=due_date,
+            sender_entity=sender_entity,
+            document_date=document_date,
             recipient_type=recipient_type,
             is_multi_recipient=(recipient_type != 'user')
         )
 
+        # كشف تكرار الخطاب الوارد قبل تسجيله (ما لم يؤكد المستخدم التسجيل رغم التحذير)
+        message.update_incoming_fingerprint(request.form.get('content'))
+        # يعاد عرض النموذج بالقيم المدخلة مع قائمة التكرار وخيار التأكيد (confirm_duplicate)
+        if message.incoming_fingerprint and 'confirm_duplicate' not in request.form:
+            duplicates = find_incoming_duplicates(message.incoming_fingerprint, message.incoming_reference_key)
+            if duplicates:
+                duplicates = visible_incoming_duplicates(duplicates, current_user)
+                kind = 'مسجل مسبقًا' if any(d['exact'] for d in duplicates) else 'قد يكون مسجلًا مسبقًا'
+                flash(f'الخطاب الوارد {kind}: ' + '، '.join(
+                    f"#{d['id']}" + (f" ({d['date']})" if d.get('date') else '') for d in duplicates
+                ) + '. يرجى تأكيد التسجيل رغم التكرار', 'warning')
+                if any(file and file.filename for file in request.files.getlist('attachments')):
+                    flash('يرجى إعادة اختيار الملفات المرفقة', 'warning')
+                return render_create_message(form_data=request.form, duplicates=duplicates)
+
         # معالجة المستلمين حسب النوع
-        recipients = []
+        # (delivery: مواصفات المستلمين القابلة للحفظ، تحل إلى مستلمين الآن أو عند موعد الإرسال المجدول)
+        delivery = {}
 
         if recipient_type == 'user':
             # مستلم فردي
@@ -1943,9 +5594,7 @@ def create_message():
                 flash('المستلم غير موجود', 'danger')
                 return redirect(url_for('create_message'))
 
-            # تعيين المستلم للتوافق مع الإصدارات السابقة
-            message.recipient_id = recipient.id
-            recipients.append(recipient)
+            delivery['recipient_id'] = recipient.id
 
         elif recipient_type == 'group':
             # مجموعة
@@ -1961,38 +5610,66 @@ def create_message():
                 flash('المجموعة غير موجودة', 'danger')
                 return redirect(url_for('create_message'))
 
-            # الحصول على أعضاء المجموعة
-            group_members = group.get_members()
+            delivery['group_id'] = group.id
 
-            if not group_members:
-                flash('المجموعة لا تحتوي على أعضاء', 'warning')
-                return redirect(url_for('create_message'))
+        elif recipient_type in ('department', 'all'):
+            # تعميم على قسم أو أكثر أو على جميع المستخدمين النشطين (يتم التوسيع داخل قاعدة البيانات)
+            # التعاميم تخزن مرة واحدة مع تعريف الجمهور بدل صف لكل مستلم
+            if request.form.get('delivery_mode') == 'broadcast' or message_type == 'circular':
+                message.delivery_mode = 'broadcast'
 
-            # إضافة أعضاء المجموعة كمستلمين
-            for member in group_members:
-                # تجاهل المرسل نفسه
-                if member.id != current_user.id:
-                    recipients.append(member)
+            if recipient_type == 'all':
+                if not current_user.has_permission('send_broadcast'):
+                    flash('ليس لديك صلاحية إرسال تعميم لجميع المستخدمين', 'danger')
+                    return redirect(url_for('create_message'))
+            else:
+                department_ids = [int(d) for d in request.form.getlist('department_ids[]') if d.isdigit()]
+                if not department_ids:
+                    flash('يرجى اختيار قسم واحد على الأقل', 'danger')
+                    return redirect(url_for('create_message'))
+                if not can_send_to_departments(current_user, department_ids):
+                    flash('ليس لديك صلاحية الإرسال إلى أقسام خارج قسمك', 'danger')
+                    return redirect(url_for('create_message'))
+                delivery['department_ids'] = department_ids
 
         elif recipient_type == 'multiple':
-            # مستلمين متعددين
-            multiple_recipients = request.form.getlist('multiple_recipients[]')
-
-            if not multiple_recipients:
-                flash('يرجى اختيار مستلم واحد على الأقل', 'danger')
+            # مستلمين متعددين: أي مزيج من المستخدمين والمجموعات والأقسام مع الاستثناءات
+            delivery['args'] = {key: request.form.getlist(key) for key in AUDIENCE_ARG_KEYS if key in request.form}
+            if not can_send_to_departments(current_user, _int_list(request.form.getlist('department_ids[]'))):
+                flash('ليس لديك صلاحية الإرسال إلى أقسام خارج قسمك', 'danger')
                 return redirect(url_for('create_message'))
 
-            # إضافة المستلمين المحددين
-            for user_id in multiple_recipients:
-                user = User.query.get(user_id)
-                if user and user.id != current_user.id:
-                    recipients.append(user)
+        # حل المستلمين الآن للتحقق من وجودهم
+        try:
+            recipients, audience = resolve_delivery(current_user.id, recipient_type, delivery)
+        except ValueError as e:
+            flash(f'قواعد المجموعة غير صالحة: {str(e)}', 'danger')
+            return redirect(url_for('create_message'))
 
         # التحقق من وجود مستلمين
-        if not recipients:
+        if recipient_type == 'multiple' and audience is None:
+            flash('يرجى اختيار مستلم واحد على الأقل', 'danger')
+            return redirect(url_for('create_message'))
+        if audience is not None:
+            if not count_audience(audience):
+                flash('لا يوجد مستخدمون نشطون في الجهة المحددة', 'danger')
+                return redirect(url_for('create_message'))
+        elif not recipients:
             flash('لم يتم تحديد أي مستلمين صالحين', 'danger')
             return redirect(url_for('create_message'))
 
+        # الإرسال المجدول
+        send_at = None
+        send_at_str = request.form.get('send_at')
+        if send_at_str:
+            try:
+                send_at = datetime.strptime(send_at_str, '%Y-%m-%dT%H:%M')
+            except ValueError:
+                flash('صيغة موعد الإرسال غير صحيحة', 'danger')
+                return redirect(url_for('create_message'))
+            if send_at <= datetime.now():
+                send_at = None
+
         # معالجة الملفات المرفقة
         files = request.files.getlist('attachments')
         has_attachments = False
@@ -2009,51 +5686,42 @@ def create_message():
                     message.attachments.append(attachment)
 
         message.has_attachments = has_attachments
-        db.session.add(message)
-        db.session.commit()
 
-        # إضافة المستلمين إلى الرسالة
-        for recipient in recipients:
-            message_recipient = MessageRecipient(
-                message_id=message.id,
-                recipient_id=recipient.id,
-                recipient_type=recipient_type,
-                status='new'
-            )
-            db.session.add(message_recipient)
-
-            # إنشاء إشعار للمستلم
-            if recipient.notifications_enabled:
-                # تخصيص الإشعار حسب أولوية الرسالة
-                icon = 'fa-envelope'
-                color = 'primary'
-
-                if priority == 'urgent':
-                    icon = 'fa-exclamation-circle'
-                    color = 'warning'
-                    title = 'رسالة عاجلة'
-                elif priority == 'very_urgent':
-                    icon = 'fa-exclamation-triangle'
-                    color = 'danger'
-                    title = 'رسالة هامة جداً'
-                else:
-                    title = 'رسالة جديدة'
+        # تحويل رسالة: مرفقاتها ترتبط بالرسالة الجديدة بالإشارة دون إعادة رفع
+        forward_attachments = get_forwardable_attachments(
+            request.form.get('forward_message_id', type=int),
+            request.form.getlist('forward_attachment_ids[]')
+        )
+        if forward_attachments is None:
+            flash('غير مصرح بالوصول إلى الرسالة المحولة', 'danger')
+            return redirect(url_for('inbox'))
+        message.link_attachments(forward_attachments)
 
-                create_notification(
-                    recipient.id,
-                    title,
-                    f'لديك رسالة جديدة من {current_user.username}: {subject}',
-                    icon,
-                    color,
-                    url_for('view_message', id=message.id)
-                )
+        # رقم القيد للإرسال الفوري (الرسائل المجدولة تمنح رقمها عند الإرسال)
+        if not send_at:
+            assign_registry_number(message, current_user.department_id)
+
+        db.session.add(message)
 
+        if send_at:
+            # حفظ الرسالة في قائمة الإرسال المجدول دون مستلمين؛ ترسل من عملية الجدولة
+            message.send_at = send_at
+            message.scheduled_send = ScheduledSend(send_at=send_at, delivery=json.dumps(delivery))
+            db.session.commit()
+            flash(f'تمت جدولة الرسالة للإرسال في {send_at.strftime("%Y-%m-%d %H:%M")}', 'success')
+            return redirect(url_for('outbox'))
+
+        recipients_count = deliver_message(message, recipient_type, delivery, recipients, audience)
         db.session.commit()
-        flash(f'تم إرسال الرسالة بنجاح إلى {len(recipients)} مستلم', 'success')
+        flash(f'تم إرسال الرسالة بنجاح إلى {recipients_count} مستلم', 'success')
         return redirect(url_for('outbox'))
 
+    return render_create_message()
+
+def render_create_message(form_data=None, duplicates=None):
+    """عرض صفحة إنشاء الرسالة (مع القيم المدخلة وقائمة التكرار عند إعادة العرض)"""
     # الحصول على البيانات اللازمة لصفحة إنشاء الرسالة
-    users = User.query.filter(User.id != current_user.id).all()
+    # (لا يتم إرسال دليل المستخدمين؛ يتم البحث عن المستلمين عبر /api/recipients/search)
     groups = UserGroup.query.filter(
         (UserGroup.is_public == True) |
         (UserGroup.created_by_id == current_user.id) |
@@ -2061,7 +5729,83 @@ def create_message():
     ).all()
     favorites = FavoriteUser.query.filter_by(user_id=current_user.id).all()
 
-    return render_template('create_message.html', users=users, groups=groups, favorites=favorites)
+    return render_template('create_message.html', groups=groups, favorites=favorites,
+                          departments=get_reference_data().departments_tree,
+                          recipient_search_url=url_for('api_search_recipients'),
+                          form_data=form_data or {}, duplicates=duplicates or [])
+
+def flash_import_summary(summary):
+    """رسائل نتيجة الاستيراد الجماعي مع رابط تقرير الأخطاء"""
+    flash(f'تم استيراد {summary["imported"]} من {summary["rows"]} سطر', 'success')
+    if summary['report']:
+        flash(f'تم رفض {summary["errors"]} سطر؛ تقرير الأخطاء: '
+              f'{url_for("download_import_report", name=summary["report"])}', 'warning')
+
+@app.route('/messages/import', methods=['POST'])
+@login_required
+def import_incoming_messages():
+    """استيراد خطابات واردة من ملف CSV أو XLSX"""
+    file = request.files.get('import_file')
+    if not file or not file.filename:
+        flash('يرجى اختيار ملف CSV أو XLSX', 'danger')
+        return redirect(url_for('create_message'))
+
+    try:
+        summary = import_incoming_correspondence(file, current_user, allow_duplicates='allow_duplicates' in request.form)
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        db.session.rollback()
+        flash(f'تعذر قراءة الملف: {str(e)}', 'danger')
+        return redirect(url_for('create_message'))
+    except Exception as e:
+        db.session.rollback()
+        flash(f'حدث خطأ أثناء الاستيراد: {str(e)}', 'danger')
+        return redirect(url_for('create_message'))
+
+    flash_import_summary(summary)
+    return redirect(url_for('outbox'))
+
+@app.route('/import/reports/<name>')
+@login_required
+def download_import_report(name):
+    """تنزيل تقرير أخطاء الاستيراد (لصاحب الاستيراد فقط)"""
+    if not name.startswith(f'{current_user.id}-'):
+        abort(404)
+    return send_from_directory(import_reports_folder(), name, as_attachment=True, download_name='import_errors.csv')
+
+@app.route('/api/audience/preview')
+@login_required
+def api_audience_preview():
+    """واجهة برمجة التطبيقات لمعرفة حجم جمهور التعميم قبل الإرسال"""
+    recipient_type = request.args.get('recipient_type')
+
+    if recipient_type == 'all':
+        if not current_user.has_permission('send_broadcast'):
+            return jsonify({'error': 'غير مصرح بالوصول'}), 403
+        audience = all_users_audience(exclude_user_id=current_user.id)
+    elif recipient_type == 'department':
+        department_ids = [int(d) for d in request.args.getlist('department_ids[]') if d.isdigit()]
+        if not can_send_to_departments(current_user, department_ids):
+            return jsonify({'error': 'غير مصرح بالوصول'}), 403
+        audience = department_audience(department_ids, exclude_user_id=current_user.id)
+    elif recipient_type == 'multiple':
+        if not can_send_to_departments(current_user, _int_list(request.args.getlist('department_ids[]'))):
+            return jsonify({'error': 'غير مصرح بالوصول'}), 403
+        try:
+            audience = audience_from_args(request.args, exclude_user_id=current_user.id)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        if audience is None:
+            return jsonify({'recipient_type': recipient_type, 'count': 0, 'user_ids': []})
+
+        # المعرفات النهائية بعد إزالة التكرار والاستثناءات (عينة محدودة للعرض)
+        limit = min(max(request.args.get('limit', 100, type=int), 1), 1000)
+        sample = audience.subquery()
+        user_ids = db.session.execute(select(sample.c[0]).order_by(sample.c[0]).limit(limit)).scalars().all()
+        return jsonify({'recipient_type': recipient_type, 'count': count_audience(audience), 'user_ids': user_ids})
+    else:
+        return jsonify({'error': 'نوع المستلم غير مدعوم'}), 400
+
+    return jsonify({'recipient_type': recipient_type, 'count': count_audience(audience)})
 
 @app.route('/message/<int:id>/archive', methods=['POST'])
 @login_required
@@ -2081,11 +5825,8 @@ def archive_message(id):
 
     # التحقق من المستلمين المتعددين
     elif message.is_multi_recipient:
-        # البحث عن المستخدم في قائمة المستلمين
-        recipient_data = MessageRecipient.query.filter_by(
-            message_id=message.id,
-            recipient_id=current_user.id
-        ).first()
+        # البحث عن المستخدم في قائمة المستلمين (أو في جمهور التعميم مع إنشاء صف الحالة)
+        recipient_data = message.get_recipient_state(current_user, create=True)
 
         if recipient_data:
             has_access = True
@@ -2177,11 +5918,8 @@ def change_message_status(id):
 
     # التحقق من المستلمين المتعددين
     elif message.is_multi_recipient:
-        # البحث عن المستخدم في قائمة المستلمين
-        recipient_data = MessageRecipient.query.filter_by(
-            message_id=message.id,
-            recipient_id=current_user.id
-        ).first()
+        # البحث عن المستخدم في قائمة المستلمين أو في جمهور التعميم
+        recipient_data = message.get_recipient_state(current_user)
 
         if recipient_data:
             has_access = True
@@ -2211,8 +5949,7 @@ def change_message_status(id):
         recipient_id = data.get('recipient_id')
 
     # التحقق من صحة الحالة الجديدة
-    valid_statuses = ['new', 'read', 'replied', 'processing', 'completed', 'closed', 'postponed']
-    if new_status not in valid_statuses:
+    if not MessageStatus.coerce(new_status):
         return jsonify({'error': 'حالة غير صالحة'}), 400
 
     # تغيير حالة الرسالة
@@ -2237,33 +5974,175 @@ def change_message_status(id):
     else:
         return jsonify({'message': 'لم يتم تغيير الحالة (الحالة الحالية هي نفسها)'})
 
+def message_status_history(message_id, recipient_id=None):
+    """سجل الحالة للرسالة: أحداث الحالة وأحداث القراءة (مع أسماء المستخدمين في نفس الاستعلام)،
+    الأحدث أولًا. عند تحديد المستلم يقتصر السجل على أحداثه"""
+    events = db.session.query(
+        MessageStatusEvent.changed_at, MessageStatusEvent.old_code, MessageStatusEvent.new_code,
+        MessageStatusEvent.notes, User.username
+    ).outerjoin(User, User.id == MessageStatusEvent.changed_by_id)\
+        .filter(MessageStatusEvent.message_id == message_id)
+    reads = db.session.query(MessageReadEvent.read_at, User.username)\
+        .join(User, User.id == MessageReadEvent.user_id)\
+        .filter(MessageReadEvent.message_id == message_id)
+
+    if recipient_id is not None:
+        events = events.filter(or_(MessageStatusEvent.recipient_id.is_(None),
+                                   MessageStatusEvent.recipient_id == recipient_id))
+        reads = reads.filter(MessageReadEvent.user_id == recipient_id)
+
+    history = [(changed_at, MESSAGE_STATUS_NAMES[old_code], MESSAGE_STATUS_NAMES[new_code], username, notes)
+               for changed_at, old_code, new_code, notes, username in events]
+    history += [(read_at, 'new', 'read', username, None) for read_at, username in reads]
+    history.sort(key=lambda entry: entry[0], reverse=True)
+    return history
+
+def message_status_times(message_id, recipient_id=None):
+    """ملخص زمن البقاء في كل حالة لكل مستلم: {recipient_id: {status: seconds}}"""
+    query = MessageStatusTime.query.filter(MessageStatusTime.message_id == message_id)
+    if recipient_id is not None:
+        query = query.filter(MessageStatusTime.recipient_id == recipient_id)
+
+    now = datetime.now()
+    times = {}
+    for row in query:
+        times.setdefault(row.recipient_id, {})[row.status] = row.total_seconds(now)
+    return times
+
 @app.route('/message/<int:id>/status-history', methods=['GET'])
 @login_required
 def get_message_status_history(id):
     message = Message.query.get_or_404(id)
 
     # التحقق من صلاحية الوصول
-    if message.recipient_id != current_user.id and message.sender_id != current_user.id:
+    if not message.can_be_viewed_by(current_user):
         return jsonify({'error': 'غير مصرح بالوصول'}), 403
 
-    # الحصول على سجل تغييرات الحالة
-    status_changes = MessageStatusChange.query.filter_by(message_id=id).order_by(MessageStatusChange.change_date.desc()).all()
+    # المستلم يرى أحداثه فقط، والمرسل يرى أحداث جميع المستلمين
+    read_receipts.flush_for(current_user.id)
+    recipient_id = None if message.sender_id == current_user.id else current_user.id
 
     # تحويل البيانات إلى تنسيق JSON
     history = []
-    for change in status_changes:
+    for changed_at, old_status, new_status, username, notes in message_status_history(id, recipient_id):
         history.append({
-            'date': change.change_date.strftime('%Y-%m-%d %H:%M'),
-            'old_status': change.old_status,
-            'old_status_display': message.get_status_display() if change.old_status == message.status else change.old_status,
-            'new_status': change.new_status,
-            'new_status_display': message.get_status_display() if change.new_status == message.status else change.new_status,
-            'changed_by': change.changed_by.username,
-            'notes': change.notes or ''
+            'date': changed_at.strftime('%Y-%m-%d %H:%M'),
+            'old_status': old_status,
+            'old_status_display': MESSAGE_STATUS_DISPLAY.get(old_status, old_status),
+            'new_status': new_status,
+            'new_status_display': MESSAGE_STATUS_DISPLAY.get(new_status, new_status),
+            'changed_by': username or '',
+            'notes': notes or ''
         })
 
     return jsonify({'history': history})
 
+@app.route('/api/message/<int:id>/status-times')
+@login_required
+def api_message_status_times(id):
+    """واجهة برمجة التطبيقات لزمن البقاء في كل حالة لكل مستلم (بالثواني)"""
+    message = Message.query.get_or_404(id)
+
+    # التحقق من صلاحية الوصول
+    if not message.can_be_viewed_by(current_user) and not current_user.is_admin():
+        return jsonify({'error': 'غير مصرح بالوصول'}), 403
+
+    read_receipts.flush_for(current_user.id)
+    recipient_id = None if message.sender_id == current_user.id or current_user.is_admin() else current_user.id
+    times = message_status_times(id, recipient_id)
+
+    # متوسط الزمن في كل حالة على جميع المستلمين
+    totals = {}
+    for statuses in times.values():
+        for status, seconds in statuses.items():
+            totals.setdefault(status, []).append(seconds)
+
+    return jsonify({
+        'recipients': [{'recipient_id': rid, 'seconds': statuses} for rid, statuses in times.items()],
+        'average_seconds': {status: sum(values) // len(values) for status, values in totals.items()},
+        'status_display': dict(MESSAGE_STATUS_DISPLAY)
+    })
+
+@app.route('/api/incoming/duplicates')
+@login_required
+def api_incoming_duplicates():
+    """واجهة برمجة التطبيقات للتحقق من تكرار خطاب وارد قبل تسجيله"""
+    document_date = None
+    if request.args.get('document_date'):
+        try:
+            document_date = datetime.strptime(request.args.get('document_date'), '%Y-%m-%d').date()
+        except ValueError:
+            return jsonify({'error': 'صيغة تاريخ الخطاب غير صحيحة'}), 400
+
+    sender_entity = request.args.get('sender_entity')
+    reference_number = request.args.get('reference_number')
+    duplicates = visible_incoming_duplicates(find_incoming_duplicates(
+        incoming_fingerprint(sender_entity, reference_number, document_date, request.args.get('content')),
+        incoming_reference_key(sender_entity, reference_number),
+        exclude_id=request.args.get('exclude_id', type=int)
+    ), current_user)
+
+    return jsonify({
+        'duplicates': duplicates,
+        'has_exact': any(d['exact'] for d in duplicates)
+    })
+
+@app.route('/api/reports/incoming-duplicates')
+@login_required
+def api_incoming_duplicates_report():
+    """واجهة برمجة التطبيقات لتقرير تكرار المراسلات الواردة المسجلة"""
+    if not current_user.is_admin():
+        return jsonify({'error': 'غير مصرح بالوصول'}), 403
+
+    exact = request.args.get('mode', 'exact') != 'reference'
+    limit = min(max(request.args.get('limit', 100, type=int), 1), 1000)
+    groups = incoming_duplicate_groups(exact=exact, limit=limit)
+
+    return jsonify({
+        'mode': 'exact' if exact else 'reference',
+        'count': len(groups),
+        'groups': [{'key': key, 'message_ids': message_ids} for key, message_ids in groups]
+    })
+
+@app.route('/api/registry/lookup')
+@login_required
+def api_registry_lookup():
+    """واجهة برمجة التطبيقات للبحث عن رسالة برقم القيد (عبر الفهرس الفريد)"""
+    number = (request.args.get('number') or '').strip()
+    if not number:
+        return jsonify({'error': 'رقم القيد مطلوب'}), 400
+
+    message = Message.query.filter_by(registry_number=number).first()
+    if not message or (not message.can_be_viewed_by(current_user) and not current_user.is_admin()):
+        return jsonify({'error': 'رقم القيد غير موجود'}), 404
+
+    return jsonify({
+        'id': message.id,
+        'registry_number': message.registry_number,
+        'subject': message.subject,
+        'date': message.date.strftime('%Y-%m-%d %H:%M') if message.date else None,
+        'url': url_for('view_message', id=message.id)
+    })
+
+@app.route('/api/registry/gaps')
+@login_required
+def api_registry_gaps():
+    """واجهة برمجة التطبيقات لتقرير فجوات أرقام القيد لقسم وسنة"""
+    if not current_user.is_admin():
+        return jsonify({'error': 'غير مصرح بالوصول'}), 403
+
+    department_id = request.args.get('department_id', 0, type=int)
+    year = request.args.get('year', datetime.now().year, type=int)
+    gaps = registry_gaps(department_id, year)
+
+    return jsonify({
+        'department_id': department_id,
+        'year': year,
+        'count': len(gaps),
+        'gaps': [{'number': number, 'registry_number': format_registry_number(department_id, year, number),
+                  'reason': reason} for number, reason in gaps]
+    })
+
 @app.route('/api/message/<int:id>/recipients')
 @login_required
 def api_message_recipients(id):
@@ -2279,6 +6158,9 @@ def api_message_recipients(id):
         # للتوافق مع الإصدارات السابقة
         recipient = User.query.get(message.recipient_id) if message.recipient_id else None
         if recipient:
+            # تاريخ القراءة من أحداث القراءة (الرسالة بمستلم واحد لا تخزن تاريخ القراءة)
+            read_at = db.session.query(MessageReadEvent.read_at)\
+                .filter_by(message_id=message.id, user_id=recipient.id).scalar()
             recipients_data = [{
                 'id': recipient.id,
                 'username': recipient.username,
@@ -2287,7 +6169,7 @@ def api_message_recipients(id):
                 'status': message.status,
                 'status_display': message.get_status_display(),
                 'status_color': message.get_status_color(),
-                'read_at': message.read_at.strftime('%Y-%m-%d %H:%M') if message.read_at else None
+                'read_at': read_at.strftime('%Y-%m-%d %H:%M') if read_at else None
             }]
         else:
             recipients_data = []
@@ -2310,7 +6192,11 @@ def api_message_recipients(id):
                     'read_at': recipient_data.read_at.strftime('%Y-%m-%d %H:%M') if recipient_data.read_at else None
                 })
 
-    return jsonify({'recipients': recipients_data})
+    response = {'recipients': recipients_data}
+    if message.is_broadcast:
+        # صفوف التعاميم تنشأ عند التفاعل؛ بقية الجمهور لم يقرأ الرسالة بعد
+        response['audience_size'] = count_audience(message.get_audience_users())
+    return jsonify(response)
 
 @app.route('/api/group/<int:id>/members')
 @login_required
@@ -2322,6 +6208,13 @@ def api_group_members(id):
     if not group.is_public and group.created_by_id != current_user.id and not group.is_member(current_user.id) and not current_user.is_admin():
         return jsonify({'error': 'غير مصرح بالوصول'}), 403
 
+    # المجموعات الديناميكية: المعاينة تحسب مباشرة من شرط القواعد
+    if group.is_dynamic:
+        try:
+            return jsonify(preview_dynamic_group(group.rules, request.args.get('limit', 100, type=int)))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
     # الحصول على قائمة الأعضاء
     memberships = UserGroupMembership.query.filter_by(group_id=id).all()
 
@@ -2339,6 +6232,60 @@ def api_group_members(id):
 
     return jsonify({'members': members_data})
 
+def preview_dynamic_group(rules, limit=100):
+    """عدد أعضاء مجموعة ديناميكية وعينة منهم"""
+    predicate = compile_group_rules(rules)
+    limit = min(max(limit, 1), 500)
+    members = User.query.filter(predicate).order_by(User.username).limit(limit).all()
+    return {
+        'count': db.session.query(func.count(User.id)).filter(predicate).scalar(),
+        'members': [{
+            'id': member.id,
+            'username': member.username,
+            'full_name': member.full_name or member.username,
+            'department': member.department_name,
+            'role': 'member'
+        } for member in members]
+    }
+
+@app.route('/api/group/rules/preview', methods=['POST'])
+@login_required
+def api_group_rules_preview():
+    """معاينة أعضاء مجموعة ديناميكية قبل حفظ قواعدها"""
+    data = request.get_json(silent=True) or {}
+
+    # المعاينة تكشف أسماء المستخدمين وأقسامهم، لذا تقتصر على من يدير المجموعات
+    # أو على مشرف المجموعة التي يعدّل قواعدها
+    if not (current_user.has_permission('manage_groups') or current_user.has_permission('manage_permissions')):
+        group = UserGroup.query.get(data.get('group_id')) if isinstance(data.get('group_id'), int) else None
+        if not group or (group.created_by_id != current_user.id and not group.is_admin(current_user.id)):
+            return jsonify({'error': 'غير مصرح بالوصول'}), 403
+
+    try:
+        limit = int(data.get('limit', 100))
+    except (TypeError, ValueError):
+        limit = 100
+
+    try:
+        return jsonify(preview_dynamic_group(data.get('rules'), limit))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/recipients/search')
+@login_required
+def api_search_recipients():
+    """واجهة برمجة التطبيقات للإكمال التلقائي لأسماء المستلمين"""
+    query = request.args.get('q', '')
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 50)
+
+    favorites = frozenset(
+        user_id for (user_id,) in
+        db.session.query(FavoriteUser.favorite_user_id).filter_by(user_id=current_user.id)
+    )
+    results = recipient_index.search(query, limit=limit, favorites=favorites, exclude_id=current_user.id)
+
+    return jsonify({'results': results})
+
 @app.route('/api/user/favorite/add/<int:user_id>', methods=['POST'])
 @login_required
 def api_add_favorite_user(user_id):
@@ -2410,9 +6357,14 @@ def reply_message(id):
         include_signature = 'include_signature' in request.form
 
         # الحقول الجديدة
-        priority = request.form.get('priority', original_message.priority or 'normal')
-        message_type = request.form.get('message_type', original_message.message_type)
-        confidentiality = request.form.get('confidentiality', original_message.confidentiality or 'normal')
+        priority = MessagePriority.coerce(request.form.get('priority'), original_message.priority or 'normal')
+        # الرد صادر من المستخدم فلا يرث نوع الخطاب الوارد (الخطابات الواردة لا ترقم في سجل القيد)
+        default_type = None if original_message.message_type == 'incoming' else original_message.message_type
+        message_type = MessageType.coerce(request.form.get('message_type'), default_type)
+        if message_type == 'incoming':
+            message_type = default_type
+        confidentiality = MessageConfidentiality.coerce(request.form.get('confidentiality'),
+                                                        original_message.confidentiality or 'normal')
         reference_number = request.form.get('reference_number')
         due_date_str = request.form.get('due_date')
 
@@ -2445,6 +6397,15 @@ def reply_message(id):
             due_date=due_date
         )
 
+        # الرد ينضم إلى محادثة الرسالة الأصلية
+        reply.join_thread(original_message)
+
+        # إعادة إرفاق مرفقات الرسالة الأصلية بالإشارة إليها (جميعها أو المحددة)
+        include_attachments = 'include_attachments' in request.form
+        selected_attachment_ids = request.form.getlist('forward_attachment_ids[]')
+        if include_attachments or selected_attachment_ids:
+            reply.link_attachments(get_forwardable_attachments(original_message.id, selected_attachment_ids))
+
         # معالجة الملفات المرفقة
         files = request.files.getlist('attachments')
         has_attachments = False
@@ -2460,7 +6421,10 @@ def reply_message(id):
                     has_attachments = True
                     reply.attachments.append(attachment)
 
-        reply.has_attachments = has_attachments
+        reply.has_attachments = has_attachments or reply.has_attachments
+
+        # رقم القيد (قبل أي كتابة في الجلسة)
+        assign_registry_number(reply, current_user.department_id)
 
         # تحديث حالة الرسالة الأصلية
         original_message.change_status('replied', current_user.id, 'تم الرد على الرسالة')
@@ -2597,7 +6561,7 @@ def edit_profile():
         # تحديث القسم
         department_id = request.form.get('department_id')
         if department_id:
-            department = Department.query.get(department_id)
+            department = get_reference_data().get_department(department_id)
             if department:
                 current_user.department_id = department_id
                 current_user.department_name = department.name  # للتوافق مع الإصدارات السابقة
@@ -2683,7 +6647,7 @@ def edit_profile():
         return redirect(url_for('profile'))
 
     # الحصول على قائمة الأقسام
-    departments = Department.query.all()
+    departments = get_reference_data().departments
 
     return render_template('edit_profile.html', departments=departments)
 
@@ -2759,6 +6723,44 @@ def get_notifications_count():
     count = Notification.query.filter_by(user_id=current_user.id, is_read=False).count()
     return jsonify({'count': count})
 
+@app.route('/api/mailbox/counters')
+@login_required
+def get_mailbox_counters_api():
+    """عدادات شارات التنقل (بدون تحميل قوائم الرسائل)"""
+    response = jsonify(get_mailbox_badges(current_user.id))
+    response.add_etag()
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+@app.route('/api/mailbox/counters/stream')
+@login_required
+def stream_mailbox_counters():
+    """دفع العدادات للعميل (Server-Sent Events) عند تغيرها فقط"""
+    user_id = current_user.id
+    interval = app.config['MAILBOX_COUNTERS_PUSH_INTERVAL']
+    timeout = app.config['MAILBOX_COUNTERS_STREAM_TIMEOUT']
+
+    def generate():
+        last_payload = None
+        started = time.monotonic()
+        # إرسال مهلة إعادة الاتصال للمتصفح
+        yield f'retry: {interval * 1000}\n\n'
+        while time.monotonic() - started < timeout:
+            payload = json.dumps(get_mailbox_badges(user_id), ensure_ascii=False)
+            # إنهاء معاملة القراءة حتى لا يبقى الاتصال ممسكًا بقاعدة البيانات
+            db.session.rollback()
+            if payload != last_payload:
+                last_payload = payload
+                yield f'event: counters\ndata: {payload}\n\n'
+            else:
+                yield ': keep-alive\n\n'
+            time.sleep(interval)
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
 @app.route('/api/notifications')
 @login_required
 def get_notifications():
@@ -2903,6 +6905,16 @@ def add_group():
         name = request.form.get('name')
         description = request.form.get('description')
         is_public = 'is_public' in request.form
+        is_dynamic = 'is_dynamic' in request.form
+        rules = request.form.get('rules') if is_dynamic else None
+
+        # التحقق من صحة قواعد المجموعة الديناميكية
+        if is_dynamic:
+            try:
+                compile_group_rules(rules)
+            except ValueError as e:
+                flash(f'قواعد المجموعة غير صالحة: {str(e)}', 'danger')
+                return redirect(url_for('groups'))
 
         # التحقق من عدم وجود مجموعة بنفس الاسم
         existing_group = UserGroup.query.filter_by(name=name).first()
@@ -2916,7 +6928,9 @@ def add_group():
             description=description,
             created_by_id=current_user.id,
             is_public=is_public,
-            is_active=True
+            is_active=True,
+            is_dynamic=is_dynamic,
+            rules=rules
         )
 
         try:
@@ -2961,6 +6975,15 @@ def edit_group(id):
             flash('يوجد مجموعة أخرى بهذا الاسم بالفعل', 'danger')
             return redirect(url_for('groups'))
 
+        # تحديث قواعد المجموعة الديناميكية
+        if group.is_dynamic and 'rules' in request.form:
+            try:
+                compile_group_rules(request.form.get('rules'))
+            except ValueError as e:
+                flash(f'قواعد المجموعة غير صالحة: {str(e)}', 'danger')
+                return redirect(url_for('groups'))
+            group.rules = request.form.get('rules')
+
         # تحديث بيانات المجموعة
         group.name = name
         group.description = description
@@ -3008,6 +7031,11 @@ def add_group_member(group_id):
         flash('غير مصرح بإضافة أعضاء لهذه المجموعة', 'danger')
         return redirect(url_for('groups'))
 
+    # عضوية المجموعات الديناميكية تحسب من القواعد
+    if group.is_dynamic:
+        flash('لا يمكن إضافة أعضاء يدويًا إلى مجموعة ديناميكية؛ يرجى تعديل قواعدها', 'warning')
+        return redirect(url_for('groups'))
+
     if request.method == 'POST':
         user_id = request.form.get('user_id')
         role = request.form.get('role', 'member')
@@ -3076,6 +7104,98 @@ def remove_group_member(group_id, user_id):
         db.session.rollback()
         return jsonify({'error': f'حدث خطأ أثناء إزالة العضو: {str(e)}'}), 500
 
+@app.route('/api/group/<int:group_id>/members/bulk', methods=['POST'])
+@login_required
+def api_bulk_group_members(group_id):
+    """إضافة أو إزالة أو استبدال أعضاء مجموعة دفعة واحدة
+
+    المدخلات (JSON): action (add أو remove أو replace)، وأي من user_ids و usernames
+    و department_ids، ودور اختياري role للأعضاء المضافين.
+    """
+    group = UserGroup.query.get_or_404(group_id)
+
+    # التحقق من صلاحية الوصول (المنشئ أو المشرف)
+    if group.created_by_id != current_user.id and not group.is_admin(current_user.id) and not current_user.has_permission('manage_groups'):
+        return jsonify({'error': 'غير مصرح بتعديل أعضاء هذه المجموعة'}), 403
+
+    if group.is_dynamic:
+        return jsonify({'error': 'لا يمكن تعديل أعضاء مجموعة ديناميكية يدويًا'}), 400
+
+    data = request.get_json(silent=True) or {}
+    action = data.get('action', 'add')
+    role = data.get('role', 'member')
+    if role not in GROUP_MEMBERSHIP_ROLES:
+        return jsonify({'error': 'دور العضوية غير صحيح'}), 400
+
+    usernames = sorted({str(name).strip() for name in _as_list(data.get('usernames')) if str(name).strip()})
+    source = member_source_query(
+        user_ids=_int_list(_as_list(data.get('user_ids'))),
+        usernames=usernames,
+        department_ids=_int_list(_as_list(data.get('department_ids')))
+    )
+    if source is None and action != 'replace':
+        return jsonify({'error': 'يرجى تحديد مستخدم واحد على الأقل'}), 400
+    if source is None:
+        # الاستبدال بقائمة فارغة يفرغ المجموعة (عدا المنشئ)
+        source = select(User.id).where(literal(False))
+
+    try:
+        result = apply_group_membership_change(group, action, source, role)
+        db.session.commit()
+    except ValueError as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': f'حدث خطأ أثناء تعديل الأعضاء: {str(e)}'}), 500
+
+    # أسماء المستخدمين غير الموجودة أو غير النشطة
+    if usernames:
+        found = set(db.session.execute(
+            select(User.username).where(User.username.in_(usernames), User.is_active == True)
+        ).scalars())
+        result['unknown_usernames'] = [name for name in usernames if name not in found]
+
+    result['members_count'] = group.get_members_count()
+    return jsonify(dict(result, success=True))
+
+@app.route('/groups/<int:group_id>/members/import', methods=['POST'])
+@login_required
+def import_group_members(group_id):
+    """استيراد أعضاء مجموعة من ملف CSV"""
+    group = UserGroup.query.get_or_404(group_id)
+
+    # التحقق من صلاحية الوصول (المنشئ أو المشرف)
+    if group.created_by_id != current_user.id and not group.is_admin(current_user.id) and not current_user.has_permission('manage_groups'):
+        flash('غير مصرح بإضافة أعضاء لهذه المجموعة', 'danger')
+        return redirect(url_for('groups'))
+
+    if group.is_dynamic:
+        flash('لا يمكن إضافة أعضاء يدويًا إلى مجموعة ديناميكية؛ يرجى تعديل قواعدها', 'warning')
+        return redirect(url_for('groups'))
+
+    file = request.files.get('csv_file')
+    if not file or not file.filename:
+        flash('يرجى اختيار ملف CSV', 'danger')
+        return redirect(url_for('groups'))
+
+    try:
+        summary = import_group_members_csv(group, file.stream, replace='replace' in request.form)
+        db.session.commit()
+    except (UnicodeDecodeError, csv.Error) as e:
+        db.session.rollback()
+        flash(f'تعذر قراءة ملف CSV: {str(e)}', 'danger')
+        return redirect(url_for('groups'))
+    except Exception as e:
+        db.session.rollback()
+        flash(f'حدث خطأ أثناء استيراد الأعضاء: {str(e)}', 'danger')
+        return redirect(url_for('groups'))
+
+    flash(f'تم استيراد {summary["rows"]} سطر: إضافة {summary["added"]} وإزالة {summary["removed"]} عضو', 'success')
+    if summary['unknown']:
+        flash(f'{summary["unknown"]} مستخدم غير موجود أو غير نشط: {"، ".join(summary["unknown_sample"])}', 'warning')
+    return redirect(url_for('groups'))
+
 
 
 
@@ -3101,8 +7221,8 @@ def download_attachment(id):
     attachment = Attachment.query.get_or_404(id)
     message = Message.query.get(attachment.message_id)
 
-    # التحقق من صلاحية الوصول
-    if message.sender_id != current_user.id and message.recipient_id != current_user.id:
+    # التحقق من صلاحية الوصول (المرسل أو أحد المستلمين)
+    if not message.can_be_viewed_by(current_user):
         abort(403)  # غير مصرح بالوصول
 
     # استخراج اسم الملف من المسار الكامل
@@ -3124,8 +7244,8 @@ def view_attachment(id):
     attachment = Attachment.query.get_or_404(id)
     message = Message.query.get(attachment.message_id)
 
-    # التحقق من صلاحية الوصول
-    if message.sender_id != current_user.id and message.recipient_id != current_user.id:
+    # التحقق من صلاحية الوصول (المرسل أو أحد المستلمين)
+    if not message.can_be_viewed_by(current_user):
         abort(403)  # غير مصرح بالوصول
 
     # التحقق من إمكانية عرض الملف في المتصفح
@@ -3167,8 +7287,8 @@ def create_personal_mail():
         content = request.form.get('content')
         source = request.form.get('source')
         reference_number = request.form.get('reference_number')
-        status = request.form.get('status', 'pending')
-        priority = request.form.get('priority', 'normal')
+        status = PersonalMailStatus.coerce(request.form.get('status'), 'pending')
+        priority = MessagePriority.coerce(request.form.get('priority'), 'normal')
         notes = request.form.get('notes')
 
         # معالجة التاريخ
@@ -3243,6 +7363,29 @@ def create_personal_mail():
 
     return render_template('create_personal_mail.html')
 
+@app.route('/personal-mail/import', methods=['POST'])
+@login_required
+def import_personal_mail_file():
+    """استيراد بريد شخصي من ملف CSV أو XLSX"""
+    file = request.files.get('import_file')
+    if not file or not file.filename:
+        flash('يرجى اختيار ملف CSV أو XLSX', 'danger')
+        return redirect(url_for('create_personal_mail'))
+
+    try:
+        summary = import_personal_mail(file, current_user.id)
+    except (ValueError, UnicodeDecodeError, csv.Error) as e:
+        db.session.rollback()
+        flash(f'تعذر قراءة الملف: {str(e)}', 'danger')
+        return redirect(url_for('create_personal_mail'))
+    except Exception as e:
+        db.session.rollback()
+        flash(f'حدث خطأ أثناء الاستيراد: {str(e)}', 'danger')
+        return redirect(url_for('create_personal_mail'))
+
+    flash_import_summary(summary)
+    return redirect(url_for('personal_mail'))
+
 @app.route('/personal-mail/<int:id>')
 @login_required
 def view_personal_mail(id):
@@ -3254,7 +7397,11 @@ def view_personal_mail(id):
     if mail.user_id != current_user.id:
         abort(403)  # غير مصرح بالوصول
 
-    return render_template('view_personal_mail.html', mail=mail, now=datetime.now())
+    # حفظ HTML المعاد تحويله إذا كان من إصدار أقدم للمحول
+    if mail.ensure_content_html():
+        db.session.commit()
+
+    return render_template('view_personal_mail.html', mail=mail, content_html=mail.get_content_html(), now=datetime.now())
 
 @app.route('/personal-mail/<int:id>/edit', methods=['GET', 'POST'])
 @login_required
@@ -3273,8 +7420,8 @@ def edit_personal_mail(id):
         mail.content = request.form.get('content')
         mail.source = request.form.get('source')
         mail.reference_number = request.form.get('reference_number')
-        mail.status = request.form.get('status')
-        mail.priority = request.form.get('priority')
+        mail.status = PersonalMailStatus.coerce(request.form.get('status'), mail.status)
+        mail.priority = MessagePriority.coerce(request.form.get('priority'), mail.priority)
         mail.notes = request.form.get('notes')
 
         # معالجة التاريخ
@@ -3392,6 +7539,9 @@ def change_personal_mail_status(id):
     if not new_status:
         return jsonify({'error': 'الحالة الجديدة مطلوبة'}), 400
 
+    if not PersonalMailStatus.coerce(new_status):
+        return jsonify({'error': 'حالة غير صالحة'}), 400
+
     try:
         # تغيير حالة البريد الشخصي
         mail.status = new_status
@@ -24,6 +24,52 @@ class Config:
         'png', 'jpg', 'jpeg', 'gif', 'zip', 'rar'
     }
 
+    # إعدادات عدادات صناديق البريد (الشارات)
+    MAILBOX_COUNTERS_PUSH_INTERVAL = int(os.environ.get('MAILBOX_COUNTERS_PUSH_INTERVAL') or 5)  # الفاصل بين التحديثات المدفوعة (ثوانٍ)
+    MAILBOX_COUNTERS_STREAM_TIMEOUT = int(os.environ.get('MAILBOX_COUNTERS_STREAM_TIMEOUT') or 300)  # مدة بقاء اتصال الدفع قبل إعادة الاتصال (ثوانٍ)
+
+    # إعدادات الذاكرة المؤقتة لأجزاء HTML
+    FRAGMENT_CACHE_MAX_ENTRIES = int(os.environ.get('FRAGMENT_CACHE_MAX_ENTRIES') or 4096)  # الحد الأقصى لعدد الأجزاء في ذاكرة العملية
+    FRAGMENT_CACHE_MAX_BYTES = int(os.environ.get('FRAGMENT_CACHE_MAX_BYTES') or 16 * 1024 * 1024)  # الحد الأقصى لحجم الأجزاء في ذاكرة العملية
+    FRAGMENT_CACHE_PATH = os.environ.get('FRAGMENT_CACHE_PATH')  # ملف SQLite مشترك بين العمليات (الافتراضي instance/fragment_cache.db، والقيمة memory لعملية واحدة فقط)
+
+    # إعدادات فهرس الإكمال التلقائي للمستلمين
+    RECIPIENT_INDEX_REFRESH_INTERVAL = int(os.environ.get('RECIPIENT_INDEX_REFRESH_INTERVAL') or 2)  # الفاصل بين عمليات التحديث التزايدي (ثوانٍ)
+    RECIPIENT_INDEX_FULL_REFRESH_INTERVAL = int(os.environ.get('RECIPIENT_INDEX_FULL_REFRESH_INTERVAL') or 900)  # الفاصل بين عمليات إعادة البناء الكاملة (ثوانٍ)
+    RECIPIENT_INDEX_SCAN_LIMIT = int(os.environ.get('RECIPIENT_INDEX_SCAN_LIMIT') or 1000)  # أقصى عدد من المفاتيح يتم فحصها لكل بحث
+
+    # إعدادات إيصالات القراءة المجمعة
+    READ_RECEIPT_FLUSH_INTERVAL = float(os.environ.get('READ_RECEIPT_FLUSH_INTERVAL') or 2)  # المهلة قبل حفظ القراءات المتراكمة (ثوانٍ)
+    READ_RECEIPT_MAX_PENDING = int(os.environ.get('READ_RECEIPT_MAX_PENDING') or 500)  # حفظ فوري عند بلوغ هذا العدد من القراءات
+    READ_RECEIPT_JOURNAL_PATH = os.environ.get('READ_RECEIPT_JOURNAL_PATH')  # ملف SQLite مشترك بين العمليات للقراءات المعلقة (الافتراضي instance/read_receipts.db، والقيمة memory لعملية واحدة فقط)
+
+    # إعدادات محرك التصعيد حسب تاريخ الاستحقاق
+    ESCALATION_INTERVAL = int(os.environ.get('ESCALATION_INTERVAL') or 300)  # الفاصل بين تشغيلات عملية الجدولة (ثوانٍ)
+    ESCALATION_DUE_SOON_DAYS = int(os.environ.get('ESCALATION_DUE_SOON_DAYS') or 1)  # التذكير قبل موعد الاستحقاق (أيام)
+    ESCALATION_MANAGER_DAYS = int(os.environ.get('ESCALATION_MANAGER_DAYS') or 3)  # التصعيد لمدير القسم بعد التأخر (أيام)
+    ESCALATION_LOOKBACK_DAYS = int(os.environ.get('ESCALATION_LOOKBACK_DAYS') or 30)  # أقدم تاريخ استحقاق يتم فحصه (أيام)
+    ESCALATION_BATCH_SIZE = int(os.environ.get('ESCALATION_BATCH_SIZE') or 500)  # عدد العناصر في كل معاملة
+    ESCALATION_MANAGER_ROLE = os.environ.get('ESCALATION_MANAGER_ROLE') or 'manager'  # اسم دور مدير القسم
+
+    # إعدادات الإرسال المجدول
+    SCHEDULED_SEND_BATCH_SIZE = int(os.environ.get('SCHEDULED_SEND_BATCH_SIZE') or 50)  # عدد الرسائل المقروءة من القائمة في كل دفعة
+    SCHEDULED_SEND_POLL_INTERVAL = int(os.environ.get('SCHEDULED_SEND_POLL_INTERVAL') or 30)  # أقصى مدة انتظار قبل إعادة فحص القائمة (ثوانٍ)
+    SCHEDULED_SEND_RETRY_DELAY = int(os.environ.get('SCHEDULED_SEND_RETRY_DELAY') or 300)  # مدة حجز الرسالة أثناء الإرسال وتأجيلها عند الفشل (ثوانٍ)
+    SCHEDULED_SEND_MAX_ATTEMPTS = int(os.environ.get('SCHEDULED_SEND_MAX_ATTEMPTS') or 5)  # عدد المحاولات قبل التوقف عن إرسال الرسالة وإشعار المرسل
+
+    # إعدادات أرقام القيد
+    REGISTRY_BLOCK_SIZE = int(os.environ.get('REGISTRY_BLOCK_SIZE') or 20)  # عدد الأرقام المحجوزة لكل عملية في كل مرة
+    REGISTRY_NUMBER_FORMAT = os.environ.get('REGISTRY_NUMBER_FORMAT') or '{year}/{department_id}/{number:06d}'  # قالب رقم القيد (department_id, department, year, number)
+
+    # إعدادات الاستيراد الجماعي (المراسلات الواردة والبريد الشخصي)
+    BULK_IMPORT_CHUNK_SIZE = int(os.environ.get('BULK_IMPORT_CHUNK_SIZE') or 1000)  # عدد الأسطر المحفوظة في كل معاملة
+    BULK_IMPORT_REPORT_MAX_AGE = int(os.environ.get('BULK_IMPORT_REPORT_MAX_AGE') or 7)  # مدة الاحتفاظ بتقارير أخطاء الاستيراد (أيام)
+    MEMBERSHIP_IMPORT_CHUNK_SIZE = int(os.environ.get('MEMBERSHIP_IMPORT_CHUNK_SIZE') or 500)  # عدد أعضاء المجموعة المستوردين من ملف CSV في كل دفعة
+
+    # إعدادات تخزين نصوص الرسائل
+    MESSAGE_BODY_COMPRESS_THRESHOLD = int(os.environ.get('MESSAGE_BODY_COMPRESS_THRESHOLD') or 1024)  # حجم النص (بايت) الذي يبدأ عنده الضغط
+    MESSAGE_BODY_COMPRESS_LEVEL = int(os.environ.get('MESSAGE_BODY_COMPRESS_LEVEL') or 6)  # مستوى ضغط zlib (1-9)
+
     @staticmethod
     def init_app(app):
         """تهيئة التطبيق بالإعدادات"""
@@ -1,5 +1,5 @@
 import os
-from app import app, db, User, Role, PermissionGroup, Permission
+from app import app, db, User, Role, PermissionGroup, Permission, bump_reference_data_version
 from werkzeug.security import generate_password_hash
 from dotenv import load_dotenv
 
@@ -56,6 +56,7 @@ def init_db():
                 Permission(name="view_all_messages", display_name="عرض جميع الرسائل", description="عرض جميع الرسائل في النظام", group_id=message_group.id),
                 Permission(name="send_message", display_name="إرسال رسالة", description="إرسال رسائل جديدة", group_id=message_group.id),
                 Permission(name="delete_message", display_name="حذف رسالة", description="حذف الرسائل", group_id=message_group.id),
+                Permission(name="send_broadcast", display_name="إرسال تعميم عام", description="إرسال رسالة إلى جميع المستخدمين النشطين", group_id=message_group.id),
 
                 # صلاحيات إدارة الحالات
                 Permission(name="change_status", display_name="تغيير الحالة", description="تغيير حالة الرسائل", group_id=status_group.id),
@@ -68,6 +69,10 @@ def init_db():
             db.session.add_all(permissions)
             db.session.commit()
 
+        # إعلام العمليات بتغير البيانات المرجعية
+        bump_reference_data_version()
+        db.session.commit()
+
         # التحقق من وجود مستخدم مدير النظام
         admin = User.query.filter_by(username='admin').first()
         if not admin:
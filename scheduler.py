@@ -0,0 +1,59 @@
+from app import app, db, run_escalations, release_scheduled_sends, next_scheduled_send_at
+from datetime import datetime
+import argparse
+import time
+
+def run_escalation_tasks():
+    """تشغيل واحد لمحرك التصعيد"""
+    escalations = run_escalations()
+    if escalations:
+        print(f"التصعيد: {escalations}")
+
+def run_send_tasks():
+    """إرسال الرسائل المجدولة التي حان موعدها"""
+    released = release_scheduled_sends()
+    if released:
+        print(f"الإرسال المجدول: تم إرسال {released} رسالة")
+
+def seconds_until_next_send():
+    """المدة حتى أقرب موعد إرسال مجدول (بحد أقصى فاصل الفحص حتى تلتقط الرسائل المجدولة حديثًا)"""
+    poll_interval = app.config['SCHEDULED_SEND_POLL_INTERVAL']
+    next_send = next_scheduled_send_at()
+    # إنهاء الجلسة حتى لا تبقى معاملة قراءة مفتوحة أثناء الانتظار
+    db.session.remove()
+    if next_send is None:
+        return poll_interval
+    return min(max((next_send - datetime.now()).total_seconds(), 0), poll_interval)
+
+def main():
+    parser = argparse.ArgumentParser(description="عملية الجدولة (الإرسال المجدول والتصعيد حسب تاريخ الاستحقاق)")
+    parser.add_argument('--once', action='store_true', help="تشغيل واحد ثم الخروج")
+    args = parser.parse_args()
+
+    # سياق طلب لبناء روابط الإشعارات عبر url_for
+    if args.once:
+        with app.test_request_context():
+            run_send_tasks()
+            run_escalation_tasks()
+        return
+
+    print("بدء عملية الجدولة...")
+    next_escalation = time.monotonic()
+    while True:
+        # سياق جديد في كل دورة حتى لا تبقى البيانات المرجعية المخزنة في g قديمة
+        with app.test_request_context():
+            try:
+                run_send_tasks()
+                if time.monotonic() >= next_escalation:
+                    run_escalation_tasks()
+                    next_escalation = time.monotonic() + app.config['ESCALATION_INTERVAL']
+                # الانتظار حتى أقرب موعد: رسالة مجدولة أو تشغيل التصعيد التالي
+                delay = min(seconds_until_next_send(), max(next_escalation - time.monotonic(), 0))
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f'خطأ في عملية الجدولة: {str(e)}')
+                delay = app.config['SCHEDULED_SEND_POLL_INTERVAL']
+        time.sleep(max(delay, 0.5))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+from app import app, db
+import sqlite3
+import os
+
+def update_database_schema():
+    """تحديث قاعدة البيانات لدعم التعاميم ذات الحالة المؤجلة لكل مستلم"""
+
+    # الحصول على مسار قاعدة البيانات
+    db_path = os.path.join(app.instance_path, 'correspondence.db')
+
+    # التحقق من وجود قاعدة البيانات
+    if not os.path.exists(db_path):
+        print(f"خطأ: قاعدة البيانات غير موجودة في المسار {db_path}")
+        return False
+
+    print(f"جاري تحديث قاعدة البيانات في {db_path}")
+
+    # الاتصال بقاعدة البيانات
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    try:
+        # إضافة عمود طريقة التسليم إلى جدول الرسائل
+        cursor.execute("PRAGMA table_info(message)")
+        columns = [column[1] for column in cursor.fetchall()]
+
+        if 'delivery_mode' not in columns:
+            print("إضافة العمود delivery_mode إلى جدول message...")
+            cursor.execute("ALTER TABLE message ADD COLUMN delivery_mode VARCHAR(20) DEFAULT 'direct'")
+        else:
+            print("العمود delivery_mode موجود بالفعل في جدول message")
+
+        # الرسائل الحالية جميعها بتسليم مباشر
+        cursor.execute("UPDATE message SET delivery_mode = 'direct' WHERE delivery_mode IS NULL")
+
+        conn.commit()
+        print("تم تحديث جدول الرسائل بنجاح!")
+
+    except Exception as e:
+        # التراجع عن التغييرات في حالة حدوث خطأ
+        conn.rollback()
+        print(f"حدث خطأ أثناء تحديث مخطط قاعدة البيانات: {str(e)}")
+        return False
+
+    finally:
+        # إغلاق الاتصال بقاعدة البيانات
+        conn.close()
+
+    with app.app_context():
+        # إنشاء جدول message_audience وفهارسه إذا لم يكن موجودًا
+        db.create_all()
+        print("تم إنشاء جدول جمهور التعاميم بنجاح!")
+
+    return True
+
+if __name__ == "__main__":
+    # إنشاء مجلد instance إذا لم يكن موجودًا
+    if not os.path.exists(app.instance_path):
+        os.makedirs(app.instance_path)
+
+    # تحديث مخطط قاعدة البيانات
+    success = update_database_schema()
+
+    if success:
+        print("تم تنفيذ العملية بنجاح!")
+    else:
+        print("فشلت العملية!")
@@ -0,0 +1,130 @@
+from app import app, Message, MessageRecipient, PersonalMail
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.schema import CreateTable, CreateIndex
+import sqlite3
+import os
+
+# عدد الصفوف المنسوخة في كل دفعة
+BATCH_SIZE = 5000
+
+# أعمدة التعدادات في كل جدول مع القيمة البديلة للقيم غير المعروفة
+ENUM_COLUMNS = {
+    Message: {'status': 'new', 'priority': 'normal', 'message_type': 'other',
+              'confidentiality': 'normal', 'recipient_type': 'user'},
+    MessageRecipient: {'status': 'new', 'recipient_type': 'user'},
+    PersonalMail: {'status': 'pending', 'priority': 'normal'},
+}
+
+def code_expression(column_name, enum, fallback):
+    """تعبير CASE يحول القيمة النصية القديمة إلى رمزها الصغير"""
+    whens = ' '.join(f"WHEN '{name}' THEN {code}" for code, name in enumerate(enum.names))
+    return (f"CASE WHEN {column_name} IS NULL OR {column_name} = '' THEN NULL "
+            f"ELSE CASE {column_name} {whens} ELSE {enum.names.index(fallback)} END END")
+
+def rebuild_table(cursor, model, columns):
+    """إعادة بناء الجدول بأعمدة الرموز الصغيرة وقيود CHECK ونسخ البيانات على دفعات"""
+    table = model.__table__
+    name = table.name
+
+    cursor.execute(f"PRAGMA table_info({name})")
+    existing = {column[1]: column[2].upper() for column in cursor.fetchall()}
+    if not existing:
+        print(f"الجدول {name} غير موجود")
+        return
+    if all(existing.get(column) == 'SMALLINT' for column in columns):
+        print(f"الجدول {name} محول بالفعل")
+        return
+
+    # إعادة البناء تنسخ أعمدة النموذج فقط، لذا يتم الإيقاف إذا كان في الجدول أعمدة لا يعرفها
+    # النموذج (مثل message.content قبل تشغيل update_db_for_message_bodies.py) حتى لا تفقد بياناتها
+    unknown = sorted(set(existing) - set(table.columns.keys()))
+    if unknown:
+        raise RuntimeError(
+            f"الجدول {name} يحتوي على أعمدة غير موجودة في النموذج: {', '.join(unknown)}. "
+            f"يرجى تشغيل سكربتات التحديث السابقة (مثل update_db_for_message_bodies.py) أولًا"
+        )
+
+    print(f"إعادة بناء الجدول {name}...")
+
+    # حذف الفهارس القديمة (تعاد بنفس الأسماء على الجدول الجديد)
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL", (name,))
+    for (index_name,) in cursor.fetchall():
+        cursor.execute(f"DROP INDEX {index_name}")
+
+    cursor.execute(f"ALTER TABLE {name} RENAME TO {name}__old")
+    cursor.execute(str(CreateTable(table).compile(dialect=sqlite.dialect())))
+
+    # نسخ البيانات على دفعات حسب المعرف
+    copied = [column.name for column in table.columns if column.name in existing]
+    expressions = [
+        code_expression(column, table.c[column].type, columns[column]) if column in columns else column
+        for column in copied
+    ]
+    key = table.primary_key.columns.values()[0].name
+    cursor.execute(f"SELECT COALESCE(MAX({key}), 0) FROM {name}__old")
+    max_id = cursor.fetchone()[0]
+    for start in range(0, max_id, BATCH_SIZE):
+        cursor.execute(
+            f"INSERT INTO {name} ({', '.join(copied)}) "
+            f"SELECT {', '.join(expressions)} FROM {name}__old WHERE {key} > ? AND {key} <= ?",
+            (start, start + BATCH_SIZE)
+        )
+        print(f"  {name}: تم نسخ الصفوف حتى {min(start + BATCH_SIZE, max_id)} من {max_id}")
+
+    cursor.execute(f"DROP TABLE {name}__old")
+    for index in table.indexes:
+        cursor.execute(str(CreateIndex(index).compile(dialect=sqlite.dialect())))
+
+def update_database_schema():
+    """تحديث قاعدة البيانات لتخزين التعدادات (الحالة والأولوية والسرية والنوع) كرموز صغيرة"""
+
+    # الحصول على مسار قاعدة البيانات
+    db_path = os.path.join(app.instance_path, 'correspondence.db')
+
+    # التحقق من وجود قاعدة البيانات
+    if not os.path.exists(db_path):
+        print(f"خطأ: قاعدة البيانات غير موجودة في المسار {db_path}")
+        return False
+
+    print(f"جاري تحديث قاعدة البيانات في {db_path}")
+
+    # الاتصال بقاعدة البيانات
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    try:
+        # إيقاف التحقق من المفاتيح الأجنبية أثناء إعادة بناء الجداول،
+        # ومنع إعادة كتابة مراجع الجداول الأخرى عند إعادة التسمية
+        cursor.execute("PRAGMA foreign_keys = OFF")
+        cursor.execute("PRAGMA legacy_alter_table = ON")
+        cursor.execute("BEGIN")
+
+        for model, columns in ENUM_COLUMNS.items():
+            rebuild_table(cursor, model, columns)
+
+        conn.commit()
+        print("تم تحديث مخطط قاعدة البيانات بنجاح!")
+        return True
+
+    except Exception as e:
+        # التراجع عن التغييرات في حالة حدوث خطأ
+        conn.rollback()
+        print(f"حدث خطأ أثناء تحديث مخطط قاعدة البيانات: {str(e)}")
+        return False
+
+    finally:
+        # إغلاق الاتصال بقاعدة البيانات
+        conn.close()
+
+if __name__ == "__main__":
+    # إنشاء مجلد instance إذا لم يكن موجودًا
+    if not os.path.exists(app.instance_path):
+        os.makedirs(app.instance_path)
+
+    # تحديث مخطط قاعدة البيانات
+    success = update_database_schema()
+
+    if success:
+        print("تم تنفيذ العملية بنجاح!")
+    else:
+        print("فشلت العملية!")
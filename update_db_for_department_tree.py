@@ -0,0 +1,87 @@
+from app import app, db, bump_reference_data_version
+import sqlite3
+import os
+
+def update_database_schema():
+    """تحديث قاعدة البيانات لدعم الهيكل التنظيمي الهرمي للأقسام"""
+
+    # الحصول على مسار قاعدة البيانات
+    db_path = os.path.join(app.instance_path, 'correspondence.db')
+
+    # التحقق من وجود قاعدة البيانات
+    if not os.path.exists(db_path):
+        print(f"خطأ: قاعدة البيانات غير موجودة في المسار {db_path}")
+        return False
+
+    print(f"جاري تحديث قاعدة البيانات في {db_path}")
+
+    # الاتصال بقاعدة البيانات
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    try:
+        # إضافة أعمدة الهيكل التنظيمي إلى جدول الأقسام
+        cursor.execute("PRAGMA table_info(department)")
+        columns = [column[1] for column in cursor.fetchall()]
+
+        new_columns = [
+            ("parent_id", "INTEGER REFERENCES department(id)"),
+            ("path", "VARCHAR(255)"),
+            ("level", "INTEGER DEFAULT 0"),
+        ]
+
+        for column_name, column_type in new_columns:
+            if column_name not in columns:
+                print(f"إضافة العمود {column_name} إلى جدول department...")
+                cursor.execute(f"ALTER TABLE department ADD COLUMN {column_name} {column_type}")
+            else:
+                print(f"العمود {column_name} موجود بالفعل في جدول department")
+
+        # الأقسام الحالية تصبح جذورًا في الشجرة
+        print("حساب المسارات للأقسام الحالية...")
+        cursor.execute("""
+            UPDATE department SET path = '/' || id || '/', level = 0
+            WHERE path IS NULL AND parent_id IS NULL
+        """)
+
+        indexes = [
+            ("ix_department_parent_id", "department", "parent_id"),
+            ("ix_department_path", "department", "path"),
+        ]
+
+        for index_name, table_name, columns in indexes:
+            print(f"إنشاء الفهرس {index_name}...")
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({columns})")
+
+        conn.commit()
+        print("تم تحديث جدول الأقسام بنجاح!")
+
+    except Exception as e:
+        # التراجع عن التغييرات في حالة حدوث خطأ
+        conn.rollback()
+        print(f"حدث خطأ أثناء تحديث مخطط قاعدة البيانات: {str(e)}")
+        return False
+
+    finally:
+        # إغلاق الاتصال بقاعدة البيانات
+        conn.close()
+
+    with app.app_context():
+        # إعلام العمليات بتغير البيانات المرجعية
+        bump_reference_data_version()
+        db.session.commit()
+
+    return True
+
+if __name__ == "__main__":
+    # إنشاء مجلد instance إذا لم يكن موجودًا
+    if not os.path.exists(app.instance_path):
+        os.makedirs(app.instance_path)
+
+    # تحديث مخطط قاعدة البيانات
+    success = update_database_schema()
+
+    if success:
+        print("تم تنفيذ العملية بنجاح!")
+    else:
+        print("فشلت العملية!")
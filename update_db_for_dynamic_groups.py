@@ -0,0 +1,71 @@
+from app import app
+import sqlite3
+import os
+
+def update_database_schema():
+    """تحديث قاعدة البيانات لدعم المجموعات الديناميكية المعرفة بقواعد"""
+
+    # الحصول على مسار قاعدة البيانات
+    db_path = os.path.join(app.instance_path, 'correspondence.db')
+
+    # التحقق من وجود قاعدة البيانات
+    if not os.path.exists(db_path):
+        print(f"خطأ: قاعدة البيانات غير موجودة في المسار {db_path}")
+        return False
+
+    print(f"جاري تحديث قاعدة البيانات في {db_path}")
+
+    # الاتصال بقاعدة البيانات
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    try:
+        # إضافة أعمدة المجموعات الديناميكية إلى جدول المجموعات
+        cursor.execute("PRAGMA table_info(user_group)")
+        columns = [column[1] for column in cursor.fetchall()]
+
+        new_columns = [
+            ("is_dynamic", "BOOLEAN DEFAULT 0"),
+            ("rules", "TEXT"),
+        ]
+
+        for column_name, column_type in new_columns:
+            if column_name not in columns:
+                print(f"إضافة العمود {column_name} إلى جدول user_group...")
+                cursor.execute(f"ALTER TABLE user_group ADD COLUMN {column_name} {column_type}")
+            else:
+                print(f"العمود {column_name} موجود بالفعل في جدول user_group")
+
+        # المجموعات الحالية جميعها ثابتة
+        cursor.execute("UPDATE user_group SET is_dynamic = 0 WHERE is_dynamic IS NULL")
+
+        # فهرس المسمى الوظيفي لقواعد المجموعات
+        print("إنشاء الفهرس ix_user_position...")
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_user_position ON user (position)")
+
+        conn.commit()
+        print("تم تحديث مخطط قاعدة البيانات بنجاح!")
+        return True
+
+    except Exception as e:
+        # التراجع عن التغييرات في حالة حدوث خطأ
+        conn.rollback()
+        print(f"حدث خطأ أثناء تحديث مخطط قاعدة البيانات: {str(e)}")
+        return False
+
+    finally:
+        # إغلاق الاتصال بقاعدة البيانات
+        conn.close()
+
+if __name__ == "__main__":
+    # إنشاء مجلد instance إذا لم يكن موجودًا
+    if not os.path.exists(app.instance_path):
+        os.makedirs(app.instance_path)
+
+    # تحديث مخطط قاعدة البيانات
+    success = update_database_schema()
+
+    if success:
+        print("تم تنفيذ العملية بنجاح!")
+    else:
+        print("فشلت العملية!")
@@ -0,0 +1,66 @@
+from app import app, db
+import sqlite3
+import os
+
+def update_database_schema():
+    """تحديث قاعدة البيانات لدعم التصعيد حسب تاريخ الاستحقاق"""
+
+    # الحصول على مسار قاعدة البيانات
+    db_path = os.path.join(app.instance_path, 'correspondence.db')
+
+    # التحقق من وجود قاعدة البيانات
+    if not os.path.exists(db_path):
+        print(f"خطأ: قاعدة البيانات غير موجودة في المسار {db_path}")
+        return False
+
+    print(f"جاري تحديث قاعدة البيانات في {db_path}")
+
+    with app.app_context():
+        # إنشاء جدول due_date_escalation إذا لم يكن موجودًا
+        db.create_all()
+
+    # الاتصال بقاعدة البيانات
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    try:
+        # فهارس (تاريخ الاستحقاق، الحالة) تحل محل فهارس تاريخ الاستحقاق المنفردة
+        indexes = [
+            ("ix_message_due_status", "message", "due_date, status"),
+            ("ix_personal_mail_due_status", "personal_mail", "due_date, status"),
+        ]
+
+        for index_name, table_name, columns in indexes:
+            print(f"إنشاء الفهرس {index_name}...")
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({columns})")
+
+        for index_name in ("ix_message_due_date", "ix_personal_mail_due_date"):
+            print(f"حذف الفهرس {index_name}...")
+            cursor.execute(f"DROP INDEX IF EXISTS {index_name}")
+
+        conn.commit()
+        print("تم تحديث مخطط قاعدة البيانات بنجاح!")
+        return True
+
+    except Exception as e:
+        # التراجع عن التغييرات في حالة حدوث خطأ
+        conn.rollback()
+        print(f"حدث خطأ أثناء تحديث مخطط قاعدة البيانات: {str(e)}")
+        return False
+
+    finally:
+        # إغلاق الاتصال بقاعدة البيانات
+        conn.close()
+
+if __name__ == "__main__":
+    # إنشاء مجلد instance إذا لم يكن موجودًا
+    if not os.path.exists(app.instance_path):
+        os.makedirs(app.instance_path)
+
+    # تحديث مخطط قاعدة البيانات
+    success = update_database_schema()
+
+    if success:
+        print("تم تنفيذ العملية بنجاح!")
+    else:
+        print("فشلت العملية!")
@@ -0,0 +1,105 @@
+from app import app, db, Message, incoming_duplicate_groups
+import sqlite3
+import os
+
+# عدد الرسائل الواردة التي تحسب بصمتها في كل دفعة
+BATCH_SIZE = 500
+
+def update_database_schema():
+    """تحديث قاعدة البيانات لإضافة بصمات كشف تكرار المراسلات الواردة"""
+
+    # الحصول على مسار قاعدة البيانات
+    db_path = os.path.join(app.instance_path, 'correspondence.db')
+
+    # التحقق من وجود قاعدة البيانات
+    if not os.path.exists(db_path):
+        print(f"خطأ: قاعدة البيانات غير موجودة في المسار {db_path}")
+        return False
+
+    print(f"جاري تحديث قاعدة البيانات في {db_path}")
+
+    # الاتصال بقاعدة البيانات
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    try:
+        # إضافة أعمدة تاريخ الخطاب والبصمتين إلى جدول الرسائل
+        cursor.execute("PRAGMA table_info(message)")
+        columns = [column[1] for column in cursor.fetchall()]
+
+        for column_name, column_type in [('document_date', 'DATE'),
+                                         ('incoming_fingerprint', 'VARCHAR(40)'),
+                                         ('incoming_reference_key', 'VARCHAR(40)')]:
+            if column_name not in columns:
+                print(f"إضافة العمود {column_name} إلى جدول message...")
+                cursor.execute(f"ALTER TABLE message ADD COLUMN {column_name} {column_type}")
+            else:
+                print(f"العمود {column_name} موجود بالفعل في جدول message")
+
+        # فهارس البحث عن التكرار
+        indexes = [
+            ("ix_message_incoming_fingerprint", "message", "incoming_fingerprint"),
+            ("ix_message_incoming_reference_key", "message", "incoming_reference_key"),
+        ]
+
+        for index_name, table_name, columns in indexes:
+            print(f"إنشاء الفهرس {index_name}...")
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({columns})")
+
+        conn.commit()
+        print("تم تحديث مخطط قاعدة البيانات بنجاح!")
+
+    except Exception as e:
+        # التراجع عن التغييرات في حالة حدوث خطأ
+        conn.rollback()
+        print(f"حدث خطأ أثناء تحديث مخطط قاعدة البيانات: {str(e)}")
+        return False
+
+    finally:
+        # إغلاق الاتصال بقاعدة البيانات
+        conn.close()
+
+    with app.app_context():
+        # حساب بصمات الرسائل الواردة الحالية على دفعات حسب المعرف
+        print("حساب بصمات الرسائل الواردة...")
+        last_id, updated = 0, 0
+        while True:
+            messages = Message.query.filter(
+                Message.message_type == 'incoming',
+                Message.incoming_fingerprint.is_(None),
+                Message.id > last_id
+            ).order_by(Message.id).limit(BATCH_SIZE).all()
+            if not messages:
+                break
+
+            for message in messages:
+                message.update_incoming_fingerprint()
+            last_id = messages[-1].id
+            db.session.commit()
+            db.session.expunge_all()
+
+            updated += len(messages)
+            print(f"  تم حساب {updated} بصمة")
+
+        # ملخص التكرار الموجود مسبقًا
+        exact = incoming_duplicate_groups(exact=True)
+        likely = incoming_duplicate_groups(exact=False)
+        print(f"مجموعات مكررة تمامًا: {len(exact)} ({sum(len(ids) for _, ids in exact)} رسالة)")
+        print(f"مجموعات بنفس الجهة والرقم المرجعي: {len(likely)} ({sum(len(ids) for _, ids in likely)} رسالة)")
+        for _, message_ids in exact[:20]:
+            print(f"  {', '.join(f'#{message_id}' for message_id in message_ids)}")
+
+    return True
+
+if __name__ == "__main__":
+    # إنشاء مجلد instance إذا لم يكن موجودًا
+    if not os.path.exists(app.instance_path):
+        os.makedirs(app.instance_path)
+
+    # تحديث مخطط قاعدة البيانات
+    success = update_database_schema()
+
+    if success:
+        print("تم تنفيذ العملية بنجاح!")
+    else:
+        print("فشلت العملية!")
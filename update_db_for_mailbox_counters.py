@@ -0,0 +1,72 @@
+from app import app, db, User, rebuild_mailbox_counters
+import sqlite3
+import os
+
+def update_database_schema():
+    """تحديث قاعدة البيانات لإضافة جدول عدادات صناديق البريد والفهارس اللازمة"""
+
+    # الحصول على مسار قاعدة البيانات
+    db_path = os.path.join(app.instance_path, 'correspondence.db')
+
+    # التحقق من وجود قاعدة البيانات
+    if not os.path.exists(db_path):
+        print(f"خطأ: قاعدة البيانات غير موجودة في المسار {db_path}")
+        return False
+
+    print(f"جاري تحديث قاعدة البيانات في {db_path}")
+
+    # الاتصال بقاعدة البيانات
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    try:
+        # فهارس العدادات وتواريخ الاستحقاق
+        indexes = [
+            ("ix_message_recipient_inbox", "message_recipient", "recipient_id, is_archived, status"),
+            ("ix_message_recipient_id", "message", "recipient_id"),
+            ("ix_message_due_date", "message", "due_date"),
+            ("ix_personal_mail_due_date", "personal_mail", "due_date"),
+        ]
+
+        for index_name, table_name, columns in indexes:
+            print(f"إنشاء الفهرس {index_name}...")
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({columns})")
+
+        conn.commit()
+        print("تم إنشاء الفهارس بنجاح!")
+
+    except Exception as e:
+        # التراجع عن التغييرات في حالة حدوث خطأ
+        conn.rollback()
+        print(f"حدث خطأ أثناء تحديث مخطط قاعدة البيانات: {str(e)}")
+        return False
+
+    finally:
+        # إغلاق الاتصال بقاعدة البيانات
+        conn.close()
+
+    with app.app_context():
+        # إنشاء جدول mailbox_counter إذا لم يكن موجودًا
+        db.create_all()
+
+        # بناء العدادات لجميع المستخدمين
+        user_ids = [user_id for (user_id,) in db.session.query(User.id).all()]
+        for user_id in user_ids:
+            rebuild_mailbox_counters(user_id)
+
+        print(f"تم بناء عدادات صناديق البريد لـ {len(user_ids)} مستخدم")
+
+    return True
+
+if __name__ == "__main__":
+    # إنشاء مجلد instance إذا لم يكن موجودًا
+    if not os.path.exists(app.instance_path):
+        os.makedirs(app.instance_path)
+
+    # تحديث مخطط قاعدة البيانات
+    success = update_database_schema()
+
+    if success:
+        print("تم تنفيذ العملية بنجاح!")
+    else:
+        print("فشلت العملية!")
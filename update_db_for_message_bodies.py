@@ -0,0 +1,103 @@
+from app import app, MessageBody
+import sqlite3
+import os
+
+def update_database_schema():
+    """تحديث قاعدة البيانات لفصل نصوص الرسائل عن ترويساتها مع ضغط النصوص الكبيرة"""
+
+    # الحصول على مسار قاعدة البيانات
+    db_path = os.path.join(app.instance_path, 'correspondence.db')
+
+    # التحقق من وجود قاعدة البيانات
+    if not os.path.exists(db_path):
+        print(f"خطأ: قاعدة البيانات غير موجودة في المسار {db_path}")
+        return False
+
+    print(f"جاري تحديث قاعدة البيانات في {db_path}")
+
+    # الاتصال بقاعدة البيانات
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    try:
+        # إنشاء جدول نصوص الرسائل
+        print("إنشاء جدول message_body...")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS message_body (
+                message_id INTEGER NOT NULL PRIMARY KEY REFERENCES message(id),
+                encoding VARCHAR(10) NOT NULL DEFAULT 'utf8',
+                size INTEGER NOT NULL DEFAULT 0,
+                data BLOB NOT NULL
+            )
+        """)
+
+        cursor.execute("PRAGMA table_info(message)")
+        columns = [column[1] for column in cursor.fetchall()]
+
+        if 'content' in columns:
+            # نقل النصوص على دفعات مع ضغط النصوص الكبيرة
+            print("نقل نصوص الرسائل إلى جدول message_body...")
+            moved = 0
+            compressed = 0
+            last_id = 0
+            while True:
+                cursor.execute(
+                    "SELECT id, content FROM message WHERE id > ? ORDER BY id LIMIT 500",
+                    (last_id,)
+                )
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+
+                bodies = []
+                for message_id, content in rows:
+                    encoding, size, data = MessageBody.encode(content)
+                    bodies.append((message_id, encoding, size, data))
+                    compressed += encoding == 'zlib'
+
+                cursor.executemany(
+                    "INSERT OR IGNORE INTO message_body (message_id, encoding, size, data) VALUES (?, ?, ?, ?)",
+                    bodies
+                )
+                moved += len(rows)
+                last_id = rows[-1][0]
+
+            print(f"تم نقل {moved} نص (منها {compressed} مضغوط)")
+
+            # حذف العمود القديم من جدول الرسائل (يتطلب SQLite 3.35 أو أحدث)
+            print("حذف العمود content من جدول message...")
+            cursor.execute("ALTER TABLE message DROP COLUMN content")
+        else:
+            print("العمود content غير موجود في جدول message (تم النقل مسبقًا)")
+
+        conn.commit()
+
+        # استعادة المساحة التي كانت تشغلها النصوص في صفحات جدول الرسائل
+        print("ضغط ملف قاعدة البيانات...")
+        conn.execute("VACUUM")
+
+        print("تم تحديث مخطط قاعدة البيانات بنجاح!")
+        return True
+
+    except Exception as e:
+        # التراجع عن التغييرات في حالة حدوث خطأ
+        conn.rollback()
+        print(f"حدث خطأ أثناء تحديث مخطط قاعدة البيانات: {str(e)}")
+        return False
+
+    finally:
+        # إغلاق الاتصال بقاعدة البيانات
+        conn.close()
+
+if __name__ == "__main__":
+    # إنشاء مجلد instance إذا لم يكن موجودًا
+    if not os.path.exists(app.instance_path):
+        os.makedirs(app.instance_path)
+
+    # تحديث مخطط قاعدة البيانات
+    success = update_database_schema()
+
+    if success:
+        print("تم تنفيذ العملية بنجاح!")
+    else:
+        print("فشلت العملية!")
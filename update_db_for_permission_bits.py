@@ -0,0 +1,80 @@
+from app import app, db, Role, bump_reference_data_version
+import sqlite3
+import os
+
+def update_database_schema():
+    """تحديث قاعدة البيانات لإضافة تمثيل الصلاحيات كمجموعة بتات للأدوار"""
+
+    # الحصول على مسار قاعدة البيانات
+    db_path = os.path.join(app.instance_path, 'correspondence.db')
+
+    # التحقق من وجود قاعدة البيانات
+    if not os.path.exists(db_path):
+        print(f"خطأ: قاعدة البيانات غير موجودة في المسار {db_path}")
+        return False
+
+    print(f"جاري تحديث قاعدة البيانات في {db_path}")
+
+    # الاتصال بقاعدة البيانات
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    try:
+        # إضافة عمود bit إلى جدول الصلاحيات
+        cursor.execute("PRAGMA table_info(permission)")
+        columns = [column[1] for column in cursor.fetchall()]
+
+        if 'bit' not in columns:
+            print("إضافة العمود bit إلى جدول permission...")
+            cursor.execute("ALTER TABLE permission ADD COLUMN bit INTEGER")
+        else:
+            print("العمود bit موجود بالفعل في جدول permission")
+
+        print("إنشاء الفهرس ix_permission_bit...")
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS ix_permission_bit ON permission (bit)")
+
+        # إضافة عمود permission_bits إلى جدول الأدوار
+        cursor.execute("PRAGMA table_info(role)")
+        columns = [column[1] for column in cursor.fetchall()]
+
+        if 'permission_bits' not in columns:
+            print("إضافة العمود permission_bits إلى جدول role...")
+            cursor.execute("ALTER TABLE role ADD COLUMN permission_bits BIGINT NOT NULL DEFAULT 0")
+        else:
+            print("العمود permission_bits موجود بالفعل في جدول role")
+
+        conn.commit()
+        print("تم تحديث مخطط قاعدة البيانات بنجاح!")
+
+    except Exception as e:
+        # التراجع عن التغييرات في حالة حدوث خطأ
+        conn.rollback()
+        print(f"حدث خطأ أثناء تحديث مخطط قاعدة البيانات: {str(e)}")
+        return False
+
+    finally:
+        # إغلاق الاتصال بقاعدة البيانات
+        conn.close()
+
+    with app.app_context():
+        # تعيين مواقع البتات واشتقاق بتات الأدوار من role_permissions
+        bump_reference_data_version()
+        db.session.commit()
+
+        for role in Role.query.order_by(Role.id).all():
+            print(f"الدور {role.name}: {bin(role.permission_bits or 0)}")
+
+    return True
+
+if __name__ == "__main__":
+    # إنشاء مجلد instance إذا لم يكن موجودًا
+    if not os.path.exists(app.instance_path):
+        os.makedirs(app.instance_path)
+
+    # تحديث مخطط قاعدة البيانات
+    success = update_database_schema()
+
+    if success:
+        print("تم تنفيذ العملية بنجاح!")
+    else:
+        print("فشلت العملية!")
@@ -0,0 +1,70 @@
+from app import app
+import sqlite3
+import os
+
+def update_database_schema():
+    """تحديث قاعدة البيانات لتخزين أحداث القراءة المجمعة بشكل مختصر"""
+
+    # الحصول على مسار قاعدة البيانات
+    db_path = os.path.join(app.instance_path, 'correspondence.db')
+
+    # التحقق من وجود قاعدة البيانات
+    if not os.path.exists(db_path):
+        print(f"خطأ: قاعدة البيانات غير موجودة في المسار {db_path}")
+        return False
+
+    print(f"جاري تحديث قاعدة البيانات في {db_path}")
+
+    # الاتصال بقاعدة البيانات
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    try:
+        # إنشاء جدول أحداث القراءة
+        print("إنشاء جدول message_read_event...")
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS message_read_event (
+                message_id INTEGER NOT NULL REFERENCES message(id),
+                user_id INTEGER NOT NULL REFERENCES user(id),
+                read_at DATETIME NOT NULL,
+                PRIMARY KEY (message_id, user_id)
+            )
+        """)
+
+        # نقل القراءات المسجلة سابقًا كسجلات تغيير حالة إلى الجدول المختصر
+        print("نقل أحداث القراءة من سجل تغييرات الحالة...")
+        cursor.execute("""
+            INSERT OR IGNORE INTO message_read_event (message_id, user_id, read_at)
+            SELECT message_id, COALESCE(recipient_id, changed_by_id), MIN(change_date)
+            FROM message_status_change
+            WHERE new_status = 'read' AND old_status = 'new' AND change_date IS NOT NULL
+            GROUP BY message_id, COALESCE(recipient_id, changed_by_id)
+        """)
+        print(f"تم نقل {cursor.rowcount} حدث قراءة")
+
+        conn.commit()
+        print("تم تحديث مخطط قاعدة البيانات بنجاح!")
+        return True
+
+    except Exception as e:
+        # التراجع عن التغييرات في حالة حدوث خطأ
+        conn.rollback()
+        print(f"حدث خطأ أثناء تحديث مخطط قاعدة البيانات: {str(e)}")
+        return False
+
+    finally:
+        # إغلاق الاتصال بقاعدة البيانات
+        conn.close()
+
+if __name__ == "__main__":
+    # إنشاء مجلد instance إذا لم يكن موجودًا
+    if not os.path.exists(app.instance_path):
+        os.makedirs(app.instance_path)
+
+    # تحديث مخطط قاعدة البيانات
+    success = update_database_schema()
+
+    if success:
+        print("تم تنفيذ العملية بنجاح!")
+    else:
+        print("فشلت العملية!")
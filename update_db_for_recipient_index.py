@@ -0,0 +1,64 @@
+from app import app
+import sqlite3
+import os
+
+def update_database_schema():
+    """تحديث قاعدة البيانات لدعم التحديث التزايدي لفهرس المستلمين"""
+
+    # الحصول على مسار قاعدة البيانات
+    db_path = os.path.join(app.instance_path, 'correspondence.db')
+
+    # التحقق من وجود قاعدة البيانات
+    if not os.path.exists(db_path):
+        print(f"خطأ: قاعدة البيانات غير موجودة في المسار {db_path}")
+        return False
+
+    print(f"جاري تحديث قاعدة البيانات في {db_path}")
+
+    # الاتصال بقاعدة البيانات
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    try:
+        # إضافة عمود تاريخ آخر تعديل إلى جدول المستخدمين
+        cursor.execute("PRAGMA table_info(user)")
+        columns = [column[1] for column in cursor.fetchall()]
+
+        if 'updated_at' not in columns:
+            print("إضافة العمود updated_at إلى جدول user...")
+            cursor.execute("ALTER TABLE user ADD COLUMN updated_at DATETIME")
+        else:
+            print("العمود updated_at موجود بالفعل في جدول user")
+
+        # تعبئة العمود للمستخدمين الحاليين
+        cursor.execute("UPDATE user SET updated_at = COALESCE(created_at, CURRENT_TIMESTAMP) WHERE updated_at IS NULL")
+
+        print("إنشاء الفهرس ix_user_updated_at...")
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_user_updated_at ON user (updated_at)")
+
+        conn.commit()
+        print("تم تحديث مخطط قاعدة البيانات بنجاح!")
+        return True
+
+    except Exception as e:
+        # التراجع عن التغييرات في حالة حدوث خطأ
+        conn.rollback()
+        print(f"حدث خطأ أثناء تحديث مخطط قاعدة البيانات: {str(e)}")
+        return False
+
+    finally:
+        # إغلاق الاتصال بقاعدة البيانات
+        conn.close()
+
+if __name__ == "__main__":
+    # إنشاء مجلد instance إذا لم يكن موجودًا
+    if not os.path.exists(app.instance_path):
+        os.makedirs(app.instance_path)
+
+    # تحديث مخطط قاعدة البيانات
+    success = update_database_schema()
+
+    if success:
+        print("تم تنفيذ العملية بنجاح!")
+    else:
+        print("فشلت العملية!")
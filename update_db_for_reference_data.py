@@ -0,0 +1,31 @@
+from app import app, db, ReferenceDataVersion, bump_reference_data_version
+import os
+
+def update_database_schema():
+    """تحديث قاعدة البيانات لإضافة جدول إصدار البيانات المرجعية"""
+
+    with app.app_context():
+        # إنشاء جدول reference_data_version إذا لم يكن موجودًا
+        db.create_all()
+
+        # إنشاء صف الإصدار أو زيادته حتى تعيد العمليات تحميل اللقطة
+        bump_reference_data_version()
+        db.session.commit()
+
+        version = ReferenceDataVersion.query.get(1)
+        print(f"إصدار البيانات المرجعية الحالي: {version.version}")
+
+    return True
+
+if __name__ == "__main__":
+    # إنشاء مجلد instance إذا لم يكن موجودًا
+    if not os.path.exists(app.instance_path):
+        os.makedirs(app.instance_path)
+
+    # تحديث مخطط قاعدة البيانات
+    success = update_database_schema()
+
+    if success:
+        print("تم تنفيذ العملية بنجاح!")
+    else:
+        print("فشلت العملية!")
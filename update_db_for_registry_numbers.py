@@ -0,0 +1,78 @@
+from app import app, db
+import sqlite3
+import os
+
+def update_database_schema():
+    """تحديث قاعدة البيانات لدعم أرقام القيد الرسمية لكل قسم وسنة"""
+
+    # الحصول على مسار قاعدة البيانات
+    db_path = os.path.join(app.instance_path, 'correspondence.db')
+
+    # التحقق من وجود قاعدة البيانات
+    if not os.path.exists(db_path):
+        print(f"خطأ: قاعدة البيانات غير موجودة في المسار {db_path}")
+        return False
+
+    print(f"جاري تحديث قاعدة البيانات في {db_path}")
+
+    # الاتصال بقاعدة البيانات
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    try:
+        # إضافة أعمدة رقم القيد إلى جدول الرسائل
+        cursor.execute("PRAGMA table_info(message)")
+        columns = [column[1] for column in cursor.fetchall()]
+
+        new_columns = [
+            ("registry_number", "VARCHAR(50)"),
+            ("registry_department_id", "INTEGER"),
+            ("registry_year", "SMALLINT"),
+            ("registry_sequence", "INTEGER"),
+        ]
+
+        for column_name, column_type in new_columns:
+            if column_name not in columns:
+                print(f"إضافة العمود {column_name} إلى جدول message...")
+                cursor.execute(f"ALTER TABLE message ADD COLUMN {column_name} {column_type}")
+            else:
+                print(f"العمود {column_name} موجود بالفعل في جدول message")
+
+        # فهارس فريدة تمنع تكرار أرقام القيد
+        print("إنشاء الفهرس ix_message_registry_number...")
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS ix_message_registry_number ON message (registry_number)")
+        print("إنشاء الفهرس ix_message_registry_sequence...")
+        cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS ix_message_registry_sequence "
+                       "ON message (registry_department_id, registry_year, registry_sequence)")
+
+        conn.commit()
+
+    except Exception as e:
+        # التراجع عن التغييرات في حالة حدوث خطأ
+        conn.rollback()
+        print(f"حدث خطأ أثناء تحديث مخطط قاعدة البيانات: {str(e)}")
+        return False
+
+    finally:
+        # إغلاق الاتصال بقاعدة البيانات
+        conn.close()
+
+    with app.app_context():
+        # إنشاء جدولي registry_sequence و registry_block إذا لم يكونا موجودين
+        db.create_all()
+
+    print("تم تحديث مخطط قاعدة البيانات بنجاح!")
+    return True
+
+if __name__ == "__main__":
+    # إنشاء مجلد instance إذا لم يكن موجودًا
+    if not os.path.exists(app.instance_path):
+        os.makedirs(app.instance_path)
+
+    # تحديث مخطط قاعدة البيانات
+    success = update_database_schema()
+
+    if success:
+        print("تم تنفيذ العملية بنجاح!")
+    else:
+        print("فشلت العملية!")
@@ -0,0 +1,77 @@
+from app import app
+import sqlite3
+import os
+
+def update_database_schema():
+    """تحديث قاعدة البيانات لتخزين HTML المحول والمنقى لنصوص الرسائل والبريد الشخصي"""
+
+    # الحصول على مسار قاعدة البيانات
+    db_path = os.path.join(app.instance_path, 'correspondence.db')
+
+    # التحقق من وجود قاعدة البيانات
+    if not os.path.exists(db_path):
+        print(f"خطأ: قاعدة البيانات غير موجودة في المسار {db_path}")
+        return False
+
+    print(f"جاري تحديث قاعدة البيانات في {db_path}")
+
+    # الاتصال بقاعدة البيانات
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    try:
+        # أعمدة HTML المحول مسبقًا لنصوص الرسائل والبريد الشخصي
+        # (تبقى فارغة للسجلات الحالية ويتم تحويلها عند أول عرض لها)
+        tables = [
+            ("message_body", [
+                ("html_encoding", "VARCHAR(10)"),
+                ("html_data", "BLOB"),
+                ("html_version", "INTEGER"),
+            ]),
+            ("personal_mail", [
+                ("content_html", "TEXT"),
+                ("content_html_version", "INTEGER"),
+            ]),
+        ]
+
+        for table_name, new_columns in tables:
+            cursor.execute(f"PRAGMA table_info({table_name})")
+            columns = [column[1] for column in cursor.fetchall()]
+
+            if not columns:
+                print(f"الجدول {table_name} غير موجود؛ يرجى تشغيل سكربتات التحديث السابقة أولًا")
+                continue
+
+            for column_name, column_type in new_columns:
+                if column_name not in columns:
+                    print(f"إضافة العمود {column_name} إلى جدول {table_name}...")
+                    cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}")
+                else:
+                    print(f"العمود {column_name} موجود بالفعل في جدول {table_name}")
+
+        conn.commit()
+        print("تم تحديث مخطط قاعدة البيانات بنجاح!")
+        return True
+
+    except Exception as e:
+        # التراجع عن التغييرات في حالة حدوث خطأ
+        conn.rollback()
+        print(f"حدث خطأ أثناء تحديث مخطط قاعدة البيانات: {str(e)}")
+        return False
+
+    finally:
+        # إغلاق الاتصال بقاعدة البيانات
+        conn.close()
+
+if __name__ == "__main__":
+    # إنشاء مجلد instance إذا لم يكن موجودًا
+    if not os.path.exists(app.instance_path):
+        os.makedirs(app.instance_path)
+
+    # تحديث مخطط قاعدة البيانات
+    success = update_database_schema()
+
+    if success:
+        print("تم تنفيذ العملية بنجاح!")
+    else:
+        print("فشلت العملية!")
@@ -0,0 +1,73 @@
+from app import app, db
+import sqlite3
+import os
+
+def update_database_schema():
+    """تحديث قاعدة البيانات لدعم الإرسال المجدول للرسائل"""
+
+    # الحصول على مسار قاعدة البيانات
+    db_path = os.path.join(app.instance_path, 'correspondence.db')
+
+    # التحقق من وجود قاعدة البيانات
+    if not os.path.exists(db_path):
+        print(f"خطأ: قاعدة البيانات غير موجودة في المسار {db_path}")
+        return False
+
+    print(f"جاري تحديث قاعدة البيانات في {db_path}")
+
+    # الاتصال بقاعدة البيانات
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    try:
+        # إضافة عمود موعد الإرسال إلى جدول الرسائل
+        cursor.execute("PRAGMA table_info(message)")
+        columns = [column[1] for column in cursor.fetchall()]
+
+        if 'send_at' not in columns:
+            print("إضافة العمود send_at إلى جدول message...")
+            cursor.execute("ALTER TABLE message ADD COLUMN send_at DATETIME")
+        else:
+            print("العمود send_at موجود بالفعل في جدول message")
+
+        # إضافة عمود عدد المحاولات إلى قائمة الإرسال المجدول إذا كانت موجودة مسبقًا
+        cursor.execute("PRAGMA table_info(scheduled_send)")
+        columns = [column[1] for column in cursor.fetchall()]
+
+        if columns and 'attempts' not in columns:
+            print("إضافة العمود attempts إلى جدول scheduled_send...")
+            cursor.execute("ALTER TABLE scheduled_send ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+        elif columns:
+            print("العمود attempts موجود بالفعل في جدول scheduled_send")
+
+        conn.commit()
+
+    except Exception as e:
+        # التراجع عن التغييرات في حالة حدوث خطأ
+        conn.rollback()
+        print(f"حدث خطأ أثناء تحديث مخطط قاعدة البيانات: {str(e)}")
+        return False
+
+    finally:
+        # إغلاق الاتصال بقاعدة البيانات
+        conn.close()
+
+    with app.app_context():
+        # إنشاء جدول scheduled_send (قائمة الإرسال المجدول) إذا لم يكن موجودًا
+        db.create_all()
+
+    print("تم تحديث مخطط قاعدة البيانات بنجاح!")
+    return True
+
+if __name__ == "__main__":
+    # إنشاء مجلد instance إذا لم يكن موجودًا
+    if not os.path.exists(app.instance_path):
+        os.makedirs(app.instance_path)
+
+    # تحديث مخطط قاعدة البيانات
+    success = update_database_schema()
+
+    if success:
+        print("تم تنفيذ العملية بنجاح!")
+    else:
+        print("فشلت العملية!")
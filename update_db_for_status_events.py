@@ -0,0 +1,124 @@
+from app import app, db, MESSAGE_STATUS_CODES, utc_to_local
+from datetime import datetime
+import sqlite3
+import os
+
+def parse_date(value):
+    """تحويل التاريخ المخزن نصيًا في SQLite إلى datetime"""
+    if value is None or isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value)
+
+def update_database_schema():
+    """تحديث قاعدة البيانات لإضافة أحداث الحالة المضغوطة وملخص زمن البقاء في كل حالة"""
+
+    # الحصول على مسار قاعدة البيانات
+    db_path = os.path.join(app.instance_path, 'correspondence.db')
+
+    # التحقق من وجود قاعدة البيانات
+    if not os.path.exists(db_path):
+        print(f"خطأ: قاعدة البيانات غير موجودة في المسار {db_path}")
+        return False
+
+    print(f"جاري تحديث قاعدة البيانات في {db_path}")
+
+    with app.app_context():
+        # إنشاء جدولي message_status_event و message_status_time إذا لم يكونا موجودين
+        db.create_all()
+
+    # الاتصال بقاعدة البيانات
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    try:
+        # نسخ سجل تغييرات الحالة القديم برموز صغيرة
+        # (القراءات التلقائية new -> read موجودة في message_read_event ولا تنسخ)
+        cursor.execute("SELECT COUNT(*) FROM message_status_event")
+        if cursor.fetchone()[0] == 0:
+            print("نسخ سجل تغييرات الحالة إلى جدول message_status_event...")
+            cursor.execute("SELECT id, message_id, recipient_id, old_status, new_status, change_date, changed_by_id, notes "
+                           "FROM message_status_change ORDER BY id")
+            events = [
+                (message_id, recipient_id, MESSAGE_STATUS_CODES[old_status], MESSAGE_STATUS_CODES[new_status],
+                 change_date, changed_by_id, notes or None)
+                for _, message_id, recipient_id, old_status, new_status, change_date, changed_by_id, notes in cursor.fetchall()
+                if old_status in MESSAGE_STATUS_CODES and new_status in MESSAGE_STATUS_CODES
+                and not (old_status == 'new' and new_status == 'read')
+            ]
+            cursor.executemany(
+                "INSERT INTO message_status_event (message_id, recipient_id, old_code, new_code, changed_at, changed_by_id, notes) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                events
+            )
+            print(f"تم نسخ {len(events)} حدث")
+        else:
+            print("جدول message_status_event يحتوي على بيانات بالفعل")
+
+        # إعادة بناء ملخص زمن البقاء من أحداث الحالة وأحداث القراءة
+        print("إعادة بناء ملخص زمن البقاء في كل حالة...")
+        cursor.execute("SELECT id, recipient_id, date FROM message")
+        messages = {message_id: (recipient_id, parse_date(date)) for message_id, recipient_id, date in cursor.fetchall()}
+
+        transitions = {}
+        cursor.execute("SELECT message_id, recipient_id, new_code, changed_at FROM message_status_event")
+        for message_id, recipient_id, new_code, changed_at in cursor.fetchall():
+            if message_id not in messages:
+                continue
+            key = (message_id, recipient_id or messages[message_id][0])
+            transitions.setdefault(key, []).append((parse_date(changed_at), new_code))
+        cursor.execute("SELECT message_id, user_id, read_at FROM message_read_event")
+        for message_id, user_id, read_at in cursor.fetchall():
+            if message_id in messages:
+                transitions.setdefault((message_id, user_id), []).append((parse_date(read_at), MESSAGE_STATUS_CODES['read']))
+
+        rows = []
+        for (message_id, recipient_id), changes in transitions.items():
+            if recipient_id is None:
+                continue
+            current, entered_at = MESSAGE_STATUS_CODES['new'], utc_to_local(messages[message_id][1])
+            seconds = {}
+            for changed_at, new_code in sorted(changes, key=lambda change: change[0]):
+                if new_code == current:
+                    continue
+                elapsed = int((changed_at - entered_at).total_seconds()) if entered_at else 0
+                seconds[current] = seconds.get(current, 0) + max(elapsed, 0)
+                current, entered_at = new_code, changed_at
+            seconds.setdefault(current, 0)
+            for status_code, total in seconds.items():
+                rows.append((message_id, recipient_id, status_code, total,
+                             entered_at if status_code == current else None))
+
+        cursor.execute("DELETE FROM message_status_time")
+        cursor.executemany(
+            "INSERT INTO message_status_time (message_id, recipient_id, status_code, seconds, entered_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(m, r, c, s, e.isoformat(sep=' ') if e else None) for m, r, c, s, e in rows]
+        )
+        print(f"تم إنشاء {len(rows)} صف في ملخص زمن البقاء")
+
+        conn.commit()
+        print("تم تحديث مخطط قاعدة البيانات بنجاح!")
+        return True
+
+    except Exception as e:
+        # التراجع عن التغييرات في حالة حدوث خطأ
+        conn.rollback()
+        print(f"حدث خطأ أثناء تحديث مخطط قاعدة البيانات: {str(e)}")
+        return False
+
+    finally:
+        # إغلاق الاتصال بقاعدة البيانات
+        conn.close()
+
+if __name__ == "__main__":
+    # إنشاء مجلد instance إذا لم يكن موجودًا
+    if not os.path.exists(app.instance_path):
+        os.makedirs(app.instance_path)
+
+    # تحديث مخطط قاعدة البيانات
+    success = update_database_schema()
+
+    if success:
+        print("تم تنفيذ العملية بنجاح!")
+    else:
+        print("فشلت العملية!")
@@ -0,0 +1,82 @@
+from app import app
+import sqlite3
+import os
+
+def update_database_schema():
+    """تحديث قاعدة البيانات لدعم التصفية والفرز في إدارة المستخدمين"""
+
+    # الحصول على مسار قاعدة البيانات
+    db_path = os.path.join(app.instance_path, 'correspondence.db')
+
+    # التحقق من وجود قاعدة البيانات
+    if not os.path.exists(db_path):
+        print(f"خطأ: قاعدة البيانات غير موجودة في المسار {db_path}")
+        return False
+
+    print(f"جاري تحديث قاعدة البيانات في {db_path}")
+
+    # الاتصال بقاعدة البيانات
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+
+    try:
+        # إضافة عمود آخر تسجيل دخول إلى جدول المستخدمين
+        cursor.execute("PRAGMA table_info(user)")
+        columns = [column[1] for column in cursor.fetchall()]
+
+        if 'last_login_at' not in columns:
+            print("إضافة العمود last_login_at إلى جدول user...")
+            cursor.execute("ALTER TABLE user ADD COLUMN last_login_at DATETIME")
+        else:
+            print("العمود last_login_at موجود بالفعل في جدول user")
+
+        # فهارس التصفية والفرز
+        indexes = [
+            ("ix_user_department_id", "user", "department_id"),
+            ("ix_user_role_id", "user", "role_id"),
+            ("ix_user_is_active", "user", "is_active"),
+            ("ix_user_full_name", "user", "full_name"),
+            ("ix_user_last_login_at", "user", "last_login_at"),
+            ("ix_user_login_log_user_date", "user_login_log", "user_id, login_date"),
+        ]
+
+        for index_name, table_name, columns in indexes:
+            print(f"إنشاء الفهرس {index_name}...")
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({columns})")
+
+        # تعبئة آخر تسجيل دخول من سجل الدخول
+        print("تعبئة آخر تسجيل دخول للمستخدمين...")
+        cursor.execute("""
+            UPDATE user SET last_login_at = (
+                SELECT MAX(login_date) FROM user_login_log
+                WHERE user_login_log.user_id = user.id AND user_login_log.status = 'success'
+            )
+            WHERE last_login_at IS NULL
+        """)
+
+        conn.commit()
+        print("تم تحديث مخطط قاعدة البيانات بنجاح!")
+        return True
+
+    except Exception as e:
+        # التراجع عن التغييرات في حالة حدوث خطأ
+        conn.rollback()
+        print(f"حدث خطأ أثناء تحديث مخطط قاعدة البيانات: {str(e)}")
+        return False
+
+    finally:
+        # إغلاق الاتصال بقاعدة البيانات
+        conn.close()
+
+if __name__ == "__main__":
+    # إنشاء مجلد instance إذا لم يكن موجودًا
+    if not os.path.exists(app.instance_path):
+        os.makedirs(app.instance_path)
+
+    # تحديث مخطط قاعدة البيانات
+    success = update_database_schema()
+
+    if success:
+        print("تم تنفيذ العملية بنجاح!")
+    else:
+        print("فشلت العملية!")
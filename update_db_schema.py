@@ -1,4 +1,4 @@
-from app import app, db, Permission
+from app import app, db, Permission, bump_reference_data_version
 
 def update_permission_display_names():
     """تحديث أسماء العرض للصلاحيات في قاعدة البيانات"""
@@ -26,7 +26,8 @@ def update_permission_display_names():
                 permission.display_name = permission_names[permission.name]
                 print(f"تحديث صلاحية {permission.name} إلى {permission.display_name}")
         
-        # حفظ التغييرات
+        # حفظ التغييرات وإعلام العمليات بتغير البيانات المرجعية
+        bump_reference_data_version()
         db.session.commit()
         print("تم تحديث أسماء العرض للصلاحيات بنجاح")
 
@@ -1,4 +1,4 @@
-from app import app, db, PermissionGroup, Permission
+from app import app, db, PermissionGroup, Permission, bump_reference_data_version
 import os
 
 def update_permission_groups():
@@ -63,7 +63,7 @@ def update_permission_groups():
                 'order': 5,
                 'permissions': [
                     'manage_messages', 'view_all_messages', 'delete_messages',
-                    'archive_messages'
+                    'archive_messages', 'send_broadcast'
                 ]
             },
             # مجموعة إدارة حالة الرسائل
@@ -147,7 +147,8 @@ def update_permission_groups():
                 permission.is_critical = True
                 print(f"تم تحديد الصلاحية '{permission_name}' كصلاحية حساسة")
         
-        # حفظ التغييرات
+        # حفظ التغييرات وإعلام العمليات بتغير البيانات المرجعية
+        bump_reference_data_version()
         db.session.commit()
         print("تم حفظ جميع التغييرات بنجاح!")
 
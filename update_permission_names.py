@@ -72,6 +72,11 @@ def update_permission_names():
         # حفظ التغييرات
         conn.commit()
         print_flush("تم تحديث أسماء الصلاحيات بنجاح!")
+
+        # زيادة إصدار البيانات المرجعية وتعيين بتات الصلاحيات الجديدة حتى تعيد العمليات تحميلها
+        from app import refresh_reference_data
+        if not refresh_reference_data():
+            print_flush("تعذر تحديث إصدار البيانات المرجعية؛ يرجى تشغيل update_db_for_permission_bits.py")
         return True
 
     except Exception as e:
@@ -1,4 +1,4 @@
-from app import app, db, Permission, Role
+from app import app, db, Permission, Role, bump_reference_data_version
 import os
 
 def update_permissions():
@@ -38,6 +38,7 @@ def update_permissions():
             ('view_all_messages', 'عرض جميع الرسائل', 'عرض جميع الرسائل في النظام'),
             ('delete_messages', 'حذف الرسائل', 'حذف الرسائل'),
             ('archive_messages', 'أرشفة الرسائل', 'أرشفة الرسائل'),
+            ('send_broadcast', 'إرسال تعميم عام', 'إرسال رسالة إلى جميع المستخدمين النشطين'),
             
             # صلاحيات إدارة حالة الرسائل
             ('change_message_status', 'تغيير حالة الرسائل', 'تغيير حالة الرسائل'),
@@ -82,7 +83,8 @@ def update_permissions():
             admin_role.permissions = all_permissions
             print(f"تم تحديث صلاحيات دور المشرف بإجمالي {len(all_permissions)} صلاحية")
         
-        # حفظ التغييرات
+        # حفظ التغييرات وإعلام العمليات بتغير البيانات المرجعية
+        bump_reference_data_version()
         db.session.commit()
         print("تم حفظ جميع التغييرات بنجاح!")
 
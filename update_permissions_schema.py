@@ -1,4 +1,4 @@
-from app import app
+from app import app, refresh_reference_data
 import sqlite3
 import os
 
@@ -115,6 +115,10 @@ def update_database_schema():
         # حفظ التغييرات
         conn.commit()
         print("تم تحديث مخطط قاعدة البيانات بنجاح!")
+
+        # زيادة إصدار البيانات المرجعية وتعيين بتات الصلاحيات الجديدة حتى تعيد العمليات تحميلها
+        if not refresh_reference_data():
+            print("تعذر تحديث إصدار البيانات المرجعية؛ يرجى تشغيل update_db_for_permission_bits.py")
         return True
 
     except Exception as e:
@@ -165,6 +165,11 @@ def update_database():
         conn.commit()
         print("تم تحديث قاعدة البيانات بنجاح!")
 
+        # زيادة إصدار البيانات المرجعية وتعيين بتات الصلاحيات الجديدة حتى تعيد العمليات تحميلها
+        from app import refresh_reference_data
+        if not refresh_reference_data():
+            print("تعذر تحديث إصدار البيانات المرجعية؛ يرجى تشغيل update_db_for_permission_bits.py")
+
         # إغلاق الاتصال
         conn.close()
         return True